@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import os
+import time
 import numpy as np
-from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import QObject, QSettings, pyqtSignal, pyqtSlot
 import matplotlib.pyplot as plt
 from wait import wait_ms, wait_signal
 
@@ -11,32 +13,140 @@ from wait import wait_ms, wait_signal
 ## When the maximum IQ is found, the focus is to the value where max IQ occured.
 ## Then, the procedure is repeated N_n times, where in every iteration the grid spacing is halved.
 ##
+## The search strategies below only interact with the hardware through two callbacks:
+##  move(p, settle_ms) moves the focus actuator to p and waits settle_ms for the image to settle
+##  measure() returns the next image quality value
+## so that they can be replayed offline, see autoFocusBenchmark.py
+##
 ## TODO: extend to 2 dimensional search by including optimization of the rotation angle
 
 
+def average_quality(measure, avg_H):
+    # average a few image quality values
+    H = 0
+    for j in range(avg_H):
+        H += measure()
+    return H/avg_H
+
+
+def grid_search(P_centre, move, measure, N_p=5, dP=.5, avg_H=3, R=3, log=None, plot=None):
+    """
+    Search a grid of 2*N_p points with spacing dP around P_centre, and repeat R times
+    around the maximum with a finer grid.
+    """
+    for r in range(R):
+        P = P_centre + (dP/(r+1))*(np.arange(2*N_p, dtype=float) - N_p)
+        H = np.zeros_like(P)
+
+        move(P[0], 500)  # Move to starting point of grid search
+
+        for i,p in enumerate(P):
+            move(p, 100)
+            H[i] = average_quality(measure, avg_H)
+            if plot is not None:
+                plot(p, H[i])
+        # wrap up
+        max_ind = np.argmax(H)
+        P_centre = P[max_ind] # set new grid centre point
+        if log is not None:
+            log(P_centre)
+    return round(P_centre, 2)
+
+
+def hill_climb(P_centre, move, measure, N_p=5, dP=.5, avg_H=3, R=3, log=None, plot=None):
+    """
+    Step from P_centre in the direction of increasing quality, with step dP, for at most 2*N_p steps.
+    When the quality drops, reverse and halve the step, R times.
+    """
+    move(P_centre, 500)
+    H_best = average_quality(measure, avg_H)
+    if plot is not None:
+        plot(P_centre, H_best)
+    step = dP
+    for r in range(R):
+        improved = False
+        for i in range(2*N_p):
+            p = P_centre + step
+            move(p, 100)
+            H = average_quality(measure, avg_H)
+            if plot is not None:
+                plot(p, H)
+            if H > H_best:
+                P_centre, H_best, improved = p, H, True
+            elif improved or i > 0:
+                break
+            else:
+                step = -step  # first step went the wrong way, try the other direction
+        step = -step/2
+        if log is not None:
+            log(P_centre)
+    move(P_centre, 100)
+    return round(P_centre, 2)
+
+
+def golden_section(P_centre, move, measure, N_p=5, dP=.5, avg_H=3, R=3, log=None, plot=None):
+    """
+    Golden section search for the maximum in [P_centre - N_p*dP, P_centre + N_p*dP],
+    with 2*N_p*R evaluations at most. Assumes a unimodal quality curve.
+    """
+    g = (np.sqrt(5) - 1)/2
+    a, b = P_centre - N_p*dP, P_centre + N_p*dP
+    def evaluate(p):
+        move(p, 100)
+        H = average_quality(measure, avg_H)
+        if plot is not None:
+            plot(p, H)
+        return H
+    move(a, 500)
+    c, d = b - g*(b - a), a + g*(b - a)
+    H_c, H_d = evaluate(c), evaluate(d)
+    for i in range(2*N_p*R - 2):
+        if H_c > H_d:
+            b, d, H_d = d, c, H_c
+            c = b - g*(b - a)
+            H_c = evaluate(c)
+        else:
+            a, c, H_c = c, d, H_d
+            d = a + g*(b - a)
+            H_d = evaluate(d)
+        if log is not None and (i + 3) % (2*N_p) == 0:
+            log((a + b)/2)
+    return round((a + b)/2, 2)
+
+
+strategies = {'grid': grid_search, 'hill': hill_climb, 'golden': golden_section}
+
 
 class AutoFocus(QObject):
 ##    Gridsearch of a hyperparameter H (image quality) over a process variable P (focus).
 ##    Start signal initiates a search around a given point P_centre, with gridsize N_p and gridspacing dP.
 ##    The search is repeated N_n times, where the gridspacing is halved with each step.
+##    The search parameters and strategy are read from the autofocus section in settings.ini.
     setFocus = pyqtSignal(float)  # Focus signal
     postMessage = pyqtSignal(str)
     focussed = pyqtSignal(float)
     rPositionReached = pyqtSignal() # repeat signal
     rImageQualityUpdated = pyqtSignal() # repeat signal
-    
+    busy = False # while a search runs
+
     def __init__(self,display=False):
         super().__init__()
         self.display = display
         self.k = 0 # plot position counter
-        
+        self.settings = QSettings("settings.ini", QSettings.IniFormat)
+        self.N_p = self.settings.value('autofocus/N_p', 5, type=int) # half of total grid points
+        self.dP = self.settings.value('autofocus/dP', .5, type=float) # initial actuater step size
+        self.avg_H = self.settings.value('autofocus/avg_H', 3, type=int) # number of quality gauges to average
+        self.R = self.settings.value('autofocus/R', 3, type=int) # iterations
+        self.strategy = self.settings.value('autofocus/strategy', 'grid')
+        if self.strategy not in strategies:
+            raise ValueError("unknown autofocus strategy {}".format(self.strategy))
+        # record the (focus position, image quality) samples, for replay in autoFocusBenchmark.py
+        self.record = self.settings.value('autofocus/record', False, type=bool)
+        self.samples = []
+
     @pyqtSlot(float)
     def start(self, P_centre=0):
-        N_p = 5 # half of total grid points
-        dP = .5 # initial actuater step size
-        avg_H = 3 # number of quality gauges to average
-        R = 3 # iterations
-
         self.postMessage.emit("{}: info; running".format(self.__class__.__name__))
 
         if self.display and (self.k == 0): # we have not plotted before
@@ -49,54 +159,65 @@ class AutoFocus(QObject):
             self.ax2.set_ylabel("Voice coil value")
             plt.show(block=False)
 
-        for r in range(R):        
-            P = P_centre + (dP/(r+1))*(np.arange(2*N_p, dtype=float) - N_p)
-            H = np.zeros_like(P)
-
-            self.setFocus.emit(P[0])  # Move to starting point of grid search
-    ##        wait_signal(self.rPositionReached, 10000)
-            wait_ms(500)        
-            
-            for i,p in enumerate(P):
-                self.setFocus.emit(p)
-    ##            wait_signal(self.rPositionReached, 10000)
-                wait_ms(100)
-                # average a few image quality values
-                H[i] = 0
-                for j in range(avg_H):
-                    wait_signal(self.rImageQualityUpdated, 10000)
-                    H[i] += self.imgQual
-                H[i] /= avg_H
-                # plot measurement
-                if self.display:
-                    # draw grid lines
-                    self.graph1 = self.ax1.plot(self.k, H[i], 'bo')[0]
-                    self.graph2 = self.ax2.plot(self.k, p, 'bo')[0]
-                    # We need to draw *and* flush
-                    self.fig.canvas.draw()
-                    self.fig.canvas.flush_events()
-                    self.k += 1
-            # wrap up        
-            max_ind = np.argmax(H)
-            P_centre = P[max_ind] # set new grid centre point
-            self.postMessage.emit("{}: info; current focus position = {}".format(self.__class__.__name__, round(P_centre,2)))
-            
-            
-        value = round(P_centre,2)
+        self.samples = []
+        self.busy = True
+        try:
+            value = strategies[self.strategy](P_centre, self.move, self.measure,
+                                              N_p=self.N_p, dP=self.dP, avg_H=self.avg_H, R=self.R,
+                                              log=self.log, plot=self.plot)
+        finally:
+            self.busy = False
+        if self.record:
+            self.saveSamples()
+
         self.setFocus.emit(value)  # set next focus
 ##        wait_signal(self.rPositionReached, 10000)
         self.focussed.emit(value) # publish focus
 
+    def move(self, p, settle_ms):
+        self.position = p
+        self.setFocus.emit(p)
+##        wait_signal(self.rPositionReached, 10000)
+        wait_ms(settle_ms)
+
+    def measure(self):
+        wait_signal(self.rImageQualityUpdated, 10000)
+        if self.record:
+            self.samples.append((self.position, self.imgQual))
+        return self.imgQual
+
+    def log(self, P_centre):
+        self.postMessage.emit("{}: info; current focus position = {}".format(self.__class__.__name__, round(P_centre,2)))
+
+    def plot(self, p, H):
+        # plot measurement
+        if self.display:
+            # draw grid lines
+            self.graph1 = self.ax1.plot(self.k, H, 'bo')[0]
+            self.graph2 = self.ax2.plot(self.k, p, 'bo')[0]
+            # We need to draw *and* flush
+            self.fig.canvas.draw()
+            self.fig.canvas.flush_events()
+            self.k += 1
+
+    def saveSamples(self):
+        filename = os.path.sep.join([self.settings.value('temp_folder'), 'autofocus_{:016d}.csv'.format(round(time.time() * 1000))])
+        try:
+            np.savetxt(filename, np.array(self.samples), delimiter=',', header='position,quality', comments='')
+            self.postMessage.emit("{}: info; focus samples written to {}".format(self.__class__.__name__, filename))
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
     @pyqtSlot(float)
     def imageQualityUpdate(self, imgQual):
         self.imgQual = imgQual
         self.rImageQualityUpdated.emit()
-          
+
     @pyqtSlot()
     def stop(self):
         try:
             if self.display:
-                plt.close()                
+                plt.close()
             self.postMessage.emit("{}: info; stopping worker".format(self.__class__.__name__))
             self.running = False
         except Exception as err:
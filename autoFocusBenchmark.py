@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Offline autofocus benchmark.
+
+The autofocus search strategies are replayed against (focus position -> image quality) curves,
+without a microscope. A curve is either recorded by AutoFocus (set record=true in the autofocus
+section of settings.ini, samples go to temp_folder/autofocus_*.csv), or synthetic.
+Measurement noise and actuator hysteresis (backlash) are added during the replay.
+For every strategy and parameter combination the number of moves, samples, the acquisition time,
+the computation time and the final focus error are reported, and written to a JSON file.
+
+Usage: python3 autoFocusBenchmark.py [--curve autofocus_x.csv] [--strategies grid,hill] [--N_p 3,5] [--dP 0.25,0.5]
+"""
+import sys
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from autoFocus import strategies
+
+
+class FocusCurve:
+    """
+    Image quality as a function of focus position, linearly interpolated between samples.
+    Repeated positions, as recorded by the grid search, are averaged.
+    """
+    def __init__(self, positions, qualities):
+        positions, qualities = np.asarray(positions, dtype=float), np.asarray(qualities, dtype=float)
+        self.positions, inverse = np.unique(positions, return_inverse=True)
+        self.qualities = np.bincount(inverse, weights=qualities)/np.bincount(inverse)
+        self.peak = self.positions[np.argmax(self.qualities)]
+
+    @classmethod
+    def from_csv(cls, filename):
+        data = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+        return cls(data[:, 0], data[:, 1])
+
+    @classmethod
+    def synthetic(cls, peak=6.76, width=0.3, base=5.0, amplitude=100.0, span=5.0):
+        # Lorentzian peak on a background, similar to the variance of Laplacian
+        positions = np.linspace(peak - span, peak + span, 1001)
+        return cls(positions, base + amplitude/(1 + ((positions - peak)/width)**2))
+
+    def __call__(self, p):
+        return np.interp(p, self.positions, self.qualities)
+
+
+class Replay:
+    """
+    Replays a focus curve through the move/measure interface of the autofocus strategies.
+    The actuator has a backlash: after a reversal, the commanded position has to travel the
+    backlash before the real position follows. Quality values get relative Gaussian noise.
+    Acquisition time is the settling time of every move, plus a frame period per sample.
+    """
+    def __init__(self, curve, noise=0.02, backlash=0.05, frame_rate=10, rng=None):
+        self.curve = curve
+        self.noise = noise
+        self.backlash = backlash
+        self.frame_period = 1.0/frame_rate
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.position = None
+        self.moves = self.samples = 0
+        self.time_s = 0.0
+
+    def move(self, p, settle_ms):
+        if self.position is None:
+            self.position = p
+        elif p > self.position + self.backlash/2:
+            self.position = p - self.backlash/2
+        elif p < self.position - self.backlash/2:
+            self.position = p + self.backlash/2
+        self.moves += 1
+        self.time_s += settle_ms/1000
+
+    def measure(self):
+        self.samples += 1
+        self.time_s += self.frame_period
+        return self.curve(self.position)*(1 + self.noise*self.rng.standard_normal())
+
+
+def run_trials(curve, strategy, params, trials, start_range, noise, backlash, frame_rate, seed):
+    rng = np.random.default_rng(seed)
+    errors, moves, samples, times, cpu_times = [], [], [], [], []
+    for trial in range(trials):
+        replay = Replay(curve, noise=noise, backlash=backlash, frame_rate=frame_rate, rng=rng)
+        replay.move(curve.peak + rng.uniform(-start_range, start_range), 0)  # arbitrary previous position
+        replay.moves = 0
+        start = replay.position
+        t = time.perf_counter()
+        value = strategies[strategy](start, replay.move, replay.measure, **params)
+        cpu_times.append(time.perf_counter() - t)
+        replay.move(value, 0)  # AutoFocus sets the final focus
+        errors.append(abs(replay.position - curve.peak))
+        moves.append(replay.moves)
+        samples.append(replay.samples)
+        times.append(replay.time_s)
+    return {'strategy': strategy,
+            'params': params,
+            'mean_error': round(float(np.mean(errors)), 4),
+            'p95_error': round(float(np.percentile(errors, 95)), 4),
+            'moves': round(float(np.mean(moves)), 1),
+            'samples': round(float(np.mean(samples)), 1),
+            'time_s': round(float(np.mean(times)), 2),
+            'cpu_ms': round(1e3*float(np.mean(cpu_times)), 3)}
+
+
+def list_of(type_):
+    return lambda s: [type_(v) for v in s.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark autofocus search strategies offline")
+    parser.add_argument("--curve", action="append", help="recorded focus curve (csv), may be repeated, synthetic if omitted")
+    parser.add_argument("--strategies", type=list_of(str), default=list(strategies.keys()))
+    parser.add_argument("--N_p", type=list_of(int), default=[5], help="half of the number of grid points")
+    parser.add_argument("--dP", type=list_of(float), default=[.5], help="initial step size")
+    parser.add_argument("--avg_H", type=list_of(int), default=[3], help="number of quality values to average")
+    parser.add_argument("--R", type=list_of(int), default=[3], help="number of iterations")
+    parser.add_argument("--noise", type=float, default=0.02, help="relative quality noise")
+    parser.add_argument("--backlash", type=float, default=0.05, help="actuator backlash [voice coil %%]")
+    parser.add_argument("--start_range", type=float, default=1.0, help="maximum initial focus error [voice coil %%]")
+    parser.add_argument("--frame_rate", type=float, default=10, help="frame rate of the quality values [fps]")
+    parser.add_argument("--trials", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="autofocus_bench.json", help="JSON results file")
+    args = parser.parse_args()
+
+    curves = {name: FocusCurve.from_csv(name) for name in args.curve} if args.curve else {'synthetic': FocusCurve.synthetic()}
+    report = {'time': round(time.time()), 'args': vars(args), 'results': {}}
+    for name, curve in curves.items():
+        results = []
+        for strategy, N_p, dP, avg_H, R in itertools.product(args.strategies, args.N_p, args.dP, args.avg_H, args.R):
+            if strategy not in strategies:
+                sys.exit("unknown strategy {}, choose from {}".format(strategy, ', '.join(strategies)))
+            params = {'N_p': N_p, 'dP': dP, 'avg_H': avg_H, 'R': R}
+            results.append(run_trials(curve, strategy, params, args.trials, args.start_range,
+                                      args.noise, args.backlash, args.frame_rate, args.seed))
+        results.sort(key=lambda r: (r['mean_error'], r['time_s']))
+        report['results'][name] = results
+        print("curve {}, peak at {:.2f}".format(name, curve.peak))
+        for r in results:
+            print("{:>7} N_p={N_p} dP={dP} avg_H={avg_H} R={R}: error={:.3f} (p95 {:.3f}), moves={:.0f}, samples={:.0f}, time={:.1f} s".format(
+                r['strategy'], r['mean_error'], r['p95_error'], r['moves'], r['samples'], r['time_s'], **r['params']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(args.output))
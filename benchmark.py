@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the image processing chain.
+
+Recorded frames (a folder of images, e.g. one of the offset folders of an experiment) or synthetic
+counting chamber frames are replayed through ImageEnhancer.start, ImageSegmenter.start and each
+ImageProcessor focus target, at one or more frame sizes.
+Per stage the p50/p95/p99 latency, mean latency and throughput are reported, together with the CPU
+time per frame (all threads, OpenCV may use several), the RSS after the stage and its growth during
+the stage. RSS is process-wide, the peak RSS of the process is reported at the end. Results are
+written to a JSON file so that regressions can be compared between commits.
+
+Usage: python3 benchmark.py [--frames folder] [--sizes 640x480,1640x1232] [--output bench.json]
+"""
+import os
+import glob
+import json
+import time
+import platform
+import resource
+import argparse
+import subprocess
+import cv2
+import numpy as np
+from PyQt5.QtCore import QSettings
+from imageEnhancer import ImageEnhancer
+from imageSegmenter import ImageSegmenter
+from imageProcessor import ImageProcessor
+
+focus_targets = ["Centre RoI", "Grid", "RoIs on Grid"]
+
+
+def frame_size_from_string(frameSizeStr):
+    (width, height) = frameSizeStr.split('x')
+    return (int(width), int(height))
+
+
+def load_frames(folder, count):
+    """ Load up to count recorded frames, sorted by (timestamp) file name, as grayscale images. """
+    files = sorted(glob.glob(os.path.join(folder, '*.png')) + glob.glob(os.path.join(folder, '*.jpg')))[:count]
+    if len(files) == 0:
+        raise ValueError("no frames found in {}".format(folder))
+    return [cv2.imread(f, cv2.IMREAD_GRAYSCALE) for f in files]
+
+
+def synthetic_frames(frame_size, count, seed=0):
+    """ Synthetic counting chamber frames, sweeping through focus as during autofocus. """
+    from simulator import counting_chamber_grid, blurred_frame
+    rng = np.random.default_rng(seed)
+    grid = counting_chamber_grid(frame_size, pitch=max(int(50*frame_size[0]/640), 10))
+    return [blurred_frame(grid, focus_error, rng=rng) for focus_error in np.linspace(-1, 1, count)]
+
+
+def latency_stats(samples_s):
+    """ Summarize latencies [s] as milliseconds, and the throughput in frames per second. """
+    samples_ms = 1e3*np.asarray(samples_s)
+    return {'n': int(samples_ms.size),
+            'mean_ms': round(float(samples_ms.mean()), 3),
+            'p50_ms': round(float(np.percentile(samples_ms, 50)), 3),
+            'p95_ms': round(float(np.percentile(samples_ms, 95)), 3),
+            'p99_ms': round(float(np.percentile(samples_ms, 99)), 3),
+            'max_ms': round(float(samples_ms.max()), 3),
+            'throughput_fps': round(float(1e3*samples_ms.size/samples_ms.sum()), 2)}
+
+
+def time_stage(function, frames, repeat, warmup=3):
+    """ Call function on every frame, repeat times, and return the latency of every call [s]. """
+    for frame in frames[:warmup]:
+        function(frame)
+    samples = []
+    for r in range(repeat):
+        for frame in frames:
+            t = time.perf_counter()
+            function(frame)
+            samples.append(time.perf_counter() - t)
+    return samples
+
+
+def new_enhancer(settings):
+    """ Image enhancer, configured as in main.py """
+    enhancer = ImageEnhancer()
+    enhancer.setRotateAngle(float(settings.value('mainwindow/rotate', 0.0)))
+    enhancer.setGamma(float(settings.value('mainwindow/gamma', 1.0)))
+    enhancer.setClaheClipLimit(float(settings.value('mainwindow/clahe', 0.0)))
+    enhancer.setBlend(0.25)
+    enhancer.setKsize(5)
+    enhancer.postMessage.connect(print)
+    return enhancer
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1)
+
+
+def rss_mb():
+    # current resident set of the process, the second field of statm is in pages
+    with open('/proc/self/statm') as f:
+        return round(int(f.read().split()[1])*resource.getpagesize()/2**20, 1)
+
+
+def cpu_s():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure_stage(function, frames, repeat):
+    """ Latency statistics of a stage, with its CPU time per frame and the RSS after the stage. """
+    rss, cpu = rss_mb(), cpu_s()
+    stats = latency_stats(time_stage(function, frames, repeat))
+    calls = stats['n'] + len(frames[:3]) # with the warmup calls of time_stage
+    stats['cpu_ms'] = round(1e3*(cpu_s() - cpu)/calls, 3)
+    stats['rss_mb'] = rss_mb()
+    stats['rss_growth_mb'] = round(stats['rss_mb'] - rss, 1)
+    return stats
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def benchmark(frames, frame_size, settings, repeat):
+    # every stage gets fresh objects, since crop rectangles and RoIs are initialised on the first frame
+    frames = [cv2.resize(f, frame_size, interpolation=cv2.INTER_AREA) if f.shape[1::-1] != frame_size else f for f in frames]
+    results = {}
+
+    enhancer = new_enhancer(settings)
+    results['enhance'] = measure_stage(enhancer.start, frames, repeat)
+
+    enhanced = [new_enhancer(settings).start(f).copy() for f in frames]
+    segmenter = ImageSegmenter()
+    segmenter.postMessage.connect(print)
+    results['segment'] = measure_stage(segmenter.start, enhanced, repeat)
+
+    for index, name in enumerate(focus_targets):
+        processor = ImageProcessor()
+        processor.enhancer = new_enhancer(settings)
+        processor.setFocusTarget(index)
+        # process does not copy, so feed copies to keep the overlays out of the next repetition
+        results['target_{}'.format(index)] = dict(measure_stage(lambda f: processor.process(f.copy()), frames, repeat),
+                                                  focus_target=name)
+    return results
+
+
+if __name__ == "__main__":
+    settings = QSettings("settings.ini", QSettings.IniFormat)
+    parser = argparse.ArgumentParser(description="Benchmark the image processing chain")
+    parser.add_argument("--frames", help="folder with recorded frames, synthetic frames are used if omitted")
+    parser.add_argument("--sizes", default=settings.value('frame_size'), help="comma separated frame sizes, default from settings.ini")
+    parser.add_argument("--count", type=int, default=50, help="number of frames")
+    parser.add_argument("--repeat", type=int, default=3, help="number of passes over the frames")
+    parser.add_argument("--output", default="bench_output.json", help="JSON results file")
+    args = parser.parse_args()
+
+    report = {'commit': git_commit(),
+              'time': round(time.time()),
+              'machine': platform.machine(),
+              'python': platform.python_version(),
+              'opencv': cv2.__version__,
+              'source': args.frames if args.frames else 'synthetic',
+              'sizes': {}}
+    recorded = load_frames(args.frames, args.count) if args.frames else None
+    for size_str in args.sizes.split(','):
+        frame_size = frame_size_from_string(size_str.strip())
+        frames = recorded if recorded is not None else synthetic_frames(frame_size, args.count)
+        report['sizes'][size_str.strip()] = benchmark(frames, frame_size, settings, args.repeat)
+        for stage, stats in report['sizes'][size_str.strip()].items():
+            print("{} {:>9}: p50={:8.2f} ms, p95={:8.2f} ms, p99={:8.2f} ms, {:7.1f} fps, cpu={:8.2f} ms, RSS={:6.1f} MB ({:+.1f})".format(
+                size_str.strip(), stage, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['throughput_fps'],
+                stats['cpu_ms'], stats['rss_mb'], stats['rss_growth_mb']))
+    report['peak_rss_mb'] = peak_rss_mb()
+    print("peak RSS: {} MB".format(report['peak_rss_mb']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(args.output))
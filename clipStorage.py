@@ -0,0 +1,95 @@
+"""@package docstring
+Ring-buffered clip storage with a size budget.
+
+Long clips are recorded as a series of MP4 segments, see SegmentedH264Output. Every finished
+segment is pushed to the SegmentUploader, which uploads and deletes the segments in a background
+thread while recording continues. The uploader keeps account of the bytes that are on the
+(tmpfs) storage; the recorder waits for space when the budget would be exceeded.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+import traceback
+from collections import deque
+
+
+class SegmentUploader:
+    """
+    Uploads segments in order, using the upload function that was pushed with every segment.
+    upload(filename) returns True on success, after which the segment is deleted.
+    A failed upload is retried first, after retry_delay seconds, doubling up to max_retry_delay,
+    the segment keeps counting in the budget. Call stop to upload the pending segments before exit.
+    """
+    def __init__(self, budget, log=print, retry_delay=10, max_retry_delay=300):
+        self.budget = budget  # [bytes]
+        self.log = log
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.used = 0  # bytes of segments that are waiting or being uploaded
+        self.queue = deque()
+        self.uploading = False
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+
+    def push(self, filename, upload):
+        size = os.path.getsize(filename)
+        with self.condition:
+            self.used += size
+            self.queue.append((filename, size, upload))
+            self.condition.notify_all()
+
+    def waitForSpace(self, size, timeout):
+        """ Block until size bytes fit in the budget, return False on timeout. """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.used + size <= self.budget, timeout)
+
+    def pending(self):
+        with self.condition:
+            return len(self.queue)
+
+    def run(self):
+        delay = self.retry_delay
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.stopped)
+                if self.stopped:
+                    return
+                filename, size, upload = self.queue.popleft()
+                self.uploading = True
+            try:
+                uploaded = upload(filename)
+            except Exception as err:
+                traceback.print_exc()
+                uploaded = False
+            if uploaded:
+                os.remove(filename)
+                delay = self.retry_delay
+            with self.condition:
+                self.uploading = False
+                if uploaded:
+                    self.used -= size
+                else:
+                    # retry before the later segments, so that they stay in order
+                    self.queue.appendleft((filename, size, upload))
+                self.condition.notify_all()
+            if not uploaded:
+                self.log("{}: error; upload of {} failed, retry in {} s".format(self.__class__.__name__, filename, delay))
+                with self.condition:
+                    self.condition.wait_for(lambda: self.stopped, delay)
+                delay = min(2*delay, self.max_retry_delay)
+
+    def stop(self, timeout=60):
+        """ Wait at most timeout seconds for the pending uploads, then stop; segments that are left stay on storage. """
+        t_end = time.monotonic() + timeout
+        with self.condition:
+            self.condition.wait_for(lambda: not self.queue and not self.uploading, timeout)
+            self.stopped = True
+            self.condition.notify_all()
+            left = [filename for filename, size, upload in self.queue]
+        self.thread.join(max(t_end - time.monotonic(), 0))
+        if left:
+            self.log("{}: error; {} segment(s) not uploaded: {}".format(self.__class__.__name__, len(left), ', '.join(left)))
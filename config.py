@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+## Configuration
+# Typed and validated settings, parsed once from an INI file, instead of QSettings lookups in
+# per-round and per-frame paths. A schema maps every key to a Field with a parser, a default and
+# an optional check; all keys are parsed when the file is loaded, and all invalid keys are
+# reported at once, in a ConfigError. reload() parses the file again, and emits changed with the
+# keys whose value changed. Keys are as in QSettings, e.g. 'acquisition/offsets'.
+#
+import time
+from PyQt5.QtCore import QObject, QSettings, pyqtSignal, pyqtSlot
+
+REQUIRED = object()
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Field:
+    def __init__(self, parse, default=None, check=None):
+        self.parse = parse
+        self.default = default # None for an optional key without default, REQUIRED for a required key
+        self.check = check
+
+
+# Parsers of the raw values of QSettings, that are strings, or lists of strings for comma separated values
+def boolean(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', '1', 'yes'):
+        return True
+    if str(value).lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError("not a boolean: {}".format(value))
+
+def text(value):
+    if isinstance(value, list):
+        return ','.join(value)
+    return str(value)
+
+def text_list(value):
+    return [str(v).strip() for v in value] if isinstance(value, list) else [str(value).strip()]
+
+def real_list(value):
+    return [float(v) for v in text_list(value)]
+
+def hms(value):
+    ''' HH:MM:SS to seconds '''
+    t = time.strptime(str(value), '%H:%M:%S')
+    return (t.tm_hour*60 + t.tm_min)*60 + t.tm_sec
+
+def duration(value):
+    ''' Nd,HH:MM:SS to seconds '''
+    days, hours = text_list(value)
+    return 24*3600*int(days.split('d')[0]) + hms(hours)
+
+def frame_size(value):
+    ''' WxH to (W, H) '''
+    width, height = str(value).split('x')
+    return (int(width), int(height))
+
+def choice(*values):
+    def parse(value):
+        if str(value) not in values:
+            raise ValueError("{} is not one of {}".format(value, ', '.join(values)))
+        return str(value)
+    return parse
+
+def positive(value):
+    return value > 0
+
+
+TIMELAPSE = {
+    'filetype': Field(choice('timelapse'), REQUIRED),
+    'id': Field(text, REQUIRED),
+    'shutdown': Field(boolean, False),
+    'temperature': Field(float, None, lambda v: 0 < v < 60),
+    'connections/email': Field(text),
+    'connections/storage': Field(choice('rclone', 'wbedav')), # sic, as in the experiment files
+    'acquisition/autofocus': Field(boolean, False),
+    'acquisition/focustarget': Field(int, 0, lambda v: v in (0, 1, 2)),
+    'acquisition/snapshot': Field(boolean, False),
+    'acquisition/high_res_snapshot': Field(boolean, False),
+    'acquisition/videoclip': Field(boolean, False),
+    'acquisition/clip_length': Field(int, 10, positive),
+    'acquisition/segmented': Field(boolean, False),
+    'acquisition/delta_storage': Field(boolean, False),
+    'acquisition/offsets': Field(text_list, ['0.0'], lambda v: all(-100 <= float(o) <= 100 for o in v)),
+    'run/duration': Field(duration, REQUIRED, positive),
+    'run/wait': Field(hms, REQUIRED),
+    'run/adaptive': Field(boolean, False),
+    'run/wait_min': Field(hms),
+    'run/wait_max': Field(hms),
+    'run/activity_low': Field(float, 0.01),
+    'run/activity_high': Field(float, 0.05),
+    'run/behind': Field(choice('skip', 'compress'), 'skip'),
+    'run/stability_window': Field(int, 60, positive),
+    'run/stability_tolerance': Field(float, 0.25, positive),
+    'run/stability_timeout': Field(int, 600, positive),
+}
+
+CAMERA = {
+    'frame_size': Field(frame_size, REQUIRED),
+    'camera/monochrome': Field(boolean, False),
+    'camera/sensor_mode': Field(int, REQUIRED, lambda v: 0 <= v <= 7),
+    'camera/frame_rate': Field(int, REQUIRED, lambda v: 0 < v <= 90),
+    'camera/pause_frame_rate': Field(float, 1.0, lambda v: 0 < v <= 90), # within the range of the sensor mode
+    'camera/video_frame_size': Field(frame_size, REQUIRED),
+    'camera/high_res_frame_size': Field(frame_size, (1640, 1232)),
+    'camera/metric_frame_size': Field(frame_size), # while the high resolution stream runs, frame_size when absent
+    'camera/hardware_roi': Field(boolean, False),
+    'camera/effect': Field(text, 'none'),
+    'camera/iso': Field(int, 100, lambda v: 0 <= v <= 1600),
+    'camera/video_denoise': Field(boolean, False),
+    'camera/session_max_age': Field(int, 0, lambda v: v >= 0),
+    'storage/segment_folder': Field(text, 'tmp/clips'),
+    'storage/tmpfs_budget_mb': Field(float, 32, positive),
+    'storage/segment_size_mb': Field(float, 8, positive),
+}
+
+CONNECTIONS = {
+    'smtp/host': Field(text),
+    'smtp/port': Field(int, 400, positive),
+    'smtp/login': Field(text),
+    'smtp/password': Field(text),
+    'smtp/ssl': Field(boolean, True),
+    'rclone/storage_path': Field(text),
+    'webdav/hostname': Field(text),
+    'webdav/login': Field(text),
+    'webdav/password': Field(text),
+    'webdav/storage_path': Field(text),
+}
+
+
+class Config(QObject):
+    """
+    Values of the keys of schema in file_name, config['run/wait'], None for an absent optional key.
+    Raises ConfigError when a value is invalid, or a required key is absent.
+    """
+    changed = pyqtSignal(list) # keys
+    postMessage = pyqtSignal(str)
+
+    def __init__(self, file_name, schema):
+        super().__init__()
+        self.file_name = file_name
+        self.schema = schema
+        self.values = self.parse()
+
+    def parse(self):
+        settings = QSettings(self.file_name, QSettings.IniFormat)
+        values, errors = {}, []
+        for key, field in self.schema.items():
+            raw = settings.value(key)
+            if raw is None or raw == '':
+                if field.default is REQUIRED:
+                    errors.append("{} is missing".format(key))
+                values[key] = None if field.default is REQUIRED else field.default
+                continue
+            try:
+                values[key] = field.parse(raw)
+            except (ValueError, TypeError) as err:
+                errors.append("{}={} is invalid, {}".format(key, raw, err))
+                continue
+            if field.check is not None and not field.check(values[key]):
+                errors.append("{}={} is out of range".format(key, raw))
+        if errors:
+            raise ConfigError("{}: {}".format(self.file_name, '; '.join(errors)))
+        return values
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def contains(self, key):
+        return self.values[key] is not None
+
+    @pyqtSlot()
+    def reload(self):
+        """ Parse the file again, on errors the current values are kept. """
+        try:
+            values = self.parse()
+        except ConfigError as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+            return
+        keys = [key for key in values if values[key] != self.values[key]]
+        self.values = values
+        if keys:
+            self.postMessage.emit("{}: info; {} changed: {}".format(self.__class__.__name__, self.file_name, ', '.join(keys)))
+            self.changed.emit(keys)
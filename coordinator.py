@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Coordinator for running several microscopes from one host.
+
+Every unit runs headless.py with --coordinator host:port, and connects to the coordinator.
+The coordinator starts the experiment of every unit that joins, staggered by stagger seconds,
+and hands out capture windows: a unit asks for a window before every round, and releases it
+when the round, including its uploads, is finished. A unit that gives up waiting cancels its
+request; requests and grants carry a request id, so that a late grant is not taken for the next one. At most max_active units run a round at the
+same time, so that network and storage load are spread. Log messages and progress of all units
+are collected in a single log file and a JSON status file.
+
+Protocol: JSON objects, one per line, over TCP.
+    unit -> coordinator: {"type": "hello", "unit": id}, {"type": "log", "message": s},
+                         {"type": "progress", "value": percentage}, {"type": "request", "id": n},
+                         {"type": "cancel", "id": n}, {"type": "release"}
+    coordinator -> unit: {"type": "start", "delay_s": s}, {"type": "grant", "id": n}
+
+Usage: python3 coordinator.py [--port 5555] [--stagger 30] [--max_active 1] [--simulated_units 3]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import numpy as np
+from collections import deque
+from PyQt5.QtCore import QObject, QCoreApplication, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtNetwork import QTcpServer, QTcpSocket, QHostAddress
+
+
+def send(sock, message):
+    sock.write((json.dumps(message) + '\n').encode())
+
+
+def receive(sock):
+    """ Complete messages received on sock. """
+    messages = []
+    while sock.canReadLine():
+        line = bytes(sock.readLine()).decode().strip()
+        if line:
+            messages.append(json.loads(line))
+    return messages
+
+
+class Coordinator(QObject):
+    postMessage = pyqtSignal(str)
+
+    def __init__(self, port=5555, stagger=30, max_active=1, log_file_name='coordinator.log', status_file_name='coordinator.json'):
+        super().__init__()
+        self.stagger = stagger
+        self.max_active = max_active
+        self.log_file_name = log_file_name
+        self.status_file_name = status_file_name
+        self.units = {}  # socket -> unit state
+        self.queue = deque()  # sockets waiting for a window
+        self.active = set()  # sockets that hold a window
+        self.joined = 0
+        self.server = QTcpServer(self)
+        self.server.newConnection.connect(self.connectUnit)
+        if not self.server.listen(QHostAddress.Any, port):
+            raise RuntimeError("cannot listen on port {}: {}".format(port, self.server.errorString()))
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.writeStatus)
+        self.timer.start(10000)
+        self.postMessage.connect(self.append)
+
+    @pyqtSlot()
+    def connectUnit(self):
+        while self.server.hasPendingConnections():
+            sock = self.server.nextPendingConnection()
+            self.units[sock] = {'unit': None, 'progress': 0, 'rounds': 0, 'waited_s': 0.0, 'requested': None, 'request_id': None}
+            sock.readyRead.connect(lambda sock=sock: self.receive(sock))
+            sock.disconnected.connect(lambda sock=sock: self.disconnectUnit(sock))
+
+    def disconnectUnit(self, sock):
+        unit = self.units.pop(sock, None)
+        if sock in self.queue:
+            self.queue.remove(sock)
+        self.active.discard(sock)
+        self.postMessage.emit("{}: info; unit {} disconnected".format(self.__class__.__name__, unit['unit'] if unit else '?'))
+        sock.deleteLater()
+        self.grant()
+
+    def receive(self, sock):
+        unit = self.units[sock]
+        try:
+            for message in receive(sock):
+                if message['type'] == 'hello':
+                    unit['unit'] = message['unit']
+                    # stagger the start of the experiments, and hence the rounds
+                    delay_s = self.stagger*self.joined
+                    self.joined += 1
+                    send(sock, {'type': 'start', 'delay_s': delay_s})
+                    self.postMessage.emit("{}: info; unit {} joined, starts in {} s".format(self.__class__.__name__, unit['unit'], delay_s))
+                elif message['type'] == 'log':
+                    self.append("{}; {}".format(unit['unit'], message['message']))
+                elif message['type'] == 'progress':
+                    unit['progress'] = message['value']
+                elif message['type'] == 'request':
+                    # a new request replaces a request that is still waiting
+                    if sock in self.queue:
+                        self.queue.remove(sock)
+                    unit['requested'] = time.monotonic()
+                    unit['request_id'] = message.get('id')
+                    self.queue.append(sock)
+                    self.grant()
+                elif message['type'] == 'cancel':
+                    # the unit gave up waiting, drop the request, or the window when the grant crossed the cancel
+                    if message.get('id') == unit['request_id']:
+                        if sock in self.queue:
+                            self.queue.remove(sock)
+                        self.active.discard(sock)
+                        unit['request_id'] = None
+                        self.postMessage.emit("{}: info; unit {} cancelled its request".format(self.__class__.__name__, unit['unit']))
+                        self.grant()
+                elif message['type'] == 'release':
+                    # only count the release of a granted window, not a duplicate or stale one
+                    if sock in self.active:
+                        self.active.discard(sock)
+                        unit['rounds'] += 1
+                        self.grant()
+        except (ValueError, KeyError) as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
+    def grant(self):
+        # first come, first served
+        while self.queue and len(self.active) < self.max_active:
+            sock = self.queue.popleft()
+            unit = self.units[sock]
+            unit['waited_s'] = round(unit['waited_s'] + time.monotonic() - unit['requested'], 1)
+            self.active.add(sock)
+            send(sock, {'type': 'grant', 'id': unit['request_id']})
+
+    @pyqtSlot(str)
+    def append(self, s):
+        print(s)
+        with open(self.log_file_name, 'a+') as log_file:
+            log_file.write(str(round(time.time(),1)) + ";" + s.rstrip('\n') + '\n')
+
+    @pyqtSlot()
+    def writeStatus(self):
+        status = {'time': round(time.time(), 1),
+                  'active': [self.units[sock]['unit'] for sock in self.active],
+                  'waiting': [self.units[sock]['unit'] for sock in self.queue],
+                  'units': {u['unit']: {k: v for k, v in u.items() if k not in ('unit', 'requested')} for u in self.units.values()}}
+        # write to a temporary file first, so readers never see a partial file
+        with open(self.status_file_name + '.tmp', 'w') as f:
+            json.dump(status, f, indent=1)
+        os.replace(self.status_file_name + '.tmp', self.status_file_name)
+
+
+class CoordinatorClient(QObject):
+    """
+    Unit side of the protocol, used by headless.py. Connect the postMessage signals to log,
+    TimeLapse.progressUpdate to progress, and TimeLapse.requestWindow/releaseWindow/cancelWindow and
+    windowGranted to the corresponding TimeLapse slots and signals.
+    """
+    postMessage = pyqtSignal(str)
+    start = pyqtSignal(float)  # delay [s]
+    windowGranted = pyqtSignal()
+
+    def __init__(self, address, unit=None):
+        super().__init__()
+        host, port = address.split(':')
+        self.unit = unit if unit is not None else socket.gethostname()
+        self.request_id = 0
+        self.sock = QTcpSocket(self)
+        self.sock.readyRead.connect(self.receive)
+        self.sock.connected.connect(lambda: send(self.sock, {'type': 'hello', 'unit': self.unit}))
+        self.sock.connectToHost(host, int(port))
+        if not self.sock.waitForConnected(5000):
+            raise RuntimeError("cannot connect to coordinator at {}: {}".format(address, self.sock.errorString()))
+
+    @pyqtSlot()
+    def receive(self):
+        try:
+            for message in receive(self.sock):
+                if message['type'] == 'start':
+                    self.postMessage.emit("{}: info; experiment starts in {} s".format(self.__class__.__name__, message['delay_s']))
+                    self.start.emit(message['delay_s'])
+                elif message['type'] == 'grant':
+                    if message.get('id') == self.request_id:
+                        self.windowGranted.emit()
+                    else:
+                        self.postMessage.emit("{}: info; stale grant {} ignored".format(self.__class__.__name__, message.get('id')))
+        except (ValueError, KeyError) as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
+    @pyqtSlot(str)
+    def log(self, s):
+        send(self.sock, {'type': 'log', 'message': s})
+
+    @pyqtSlot(int)
+    def progress(self, value):
+        send(self.sock, {'type': 'progress', 'value': value})
+
+    @pyqtSlot()
+    def requestWindow(self):
+        self.request_id += 1
+        send(self.sock, {'type': 'request', 'id': self.request_id})
+
+    @pyqtSlot()
+    def cancelWindow(self):
+        send(self.sock, {'type': 'cancel', 'id': self.request_id})
+
+    @pyqtSlot()
+    def releaseWindow(self):
+        send(self.sock, {'type': 'release'})
+        self.sock.flush()
+
+
+class SimulatedUnit(QObject):
+    """
+    Stand-in for a microscope, to test the coordinator: every period it asks for a window,
+    and holds it for a random round duration. For a full simulated unit, run headless.py --simulate.
+    """
+    def __init__(self, address, unit, period=20, round_s=(2, 8), rounds=5, rng=None):
+        super().__init__()
+        self.client = CoordinatorClient(address, unit)
+        self.period = period
+        self.round_s = round_s
+        self.rounds = rounds
+        self.round = 0
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.client.start.connect(lambda delay_s: QTimer.singleShot(round(1000*delay_s), self.run))
+        self.client.windowGranted.connect(self.capture)
+
+    def run(self):
+        self.client.requestWindow()
+        if self.round + 1 < self.rounds:
+            QTimer.singleShot(1000*self.period, self.run)
+
+    def capture(self):
+        duration = self.rng.uniform(*self.round_s)
+        self.client.log("{}: info; round {} takes {:.1f} s".format(self.__class__.__name__, self.round, duration))
+        QTimer.singleShot(round(1000*duration), self.finish)
+
+    def finish(self):
+        self.round += 1
+        self.client.progress(round(100*self.round/self.rounds))
+        self.client.releaseWindow()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Coordinate the experiments of several units")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--stagger", type=float, default=30, help="delay between the starts of successive units [s]")
+    parser.add_argument("--max_active", type=int, default=1, help="number of units that may run a round at the same time")
+    parser.add_argument("--log", default="coordinator.log", help="aggregated log file")
+    parser.add_argument("--status", default="coordinator.json", help="JSON status file")
+    parser.add_argument("--simulated_units", type=int, default=0, help="number of simulated units to run in-process")
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    try:
+        coordinator = Coordinator(args.port, args.stagger, args.max_active, args.log, args.status)
+    except RuntimeError as err:
+        sys.exit(str(err))
+    units = [SimulatedUnit('localhost:{}'.format(args.port), 'sim{}'.format(i)) for i in range(args.simulated_units)]
+    app.exec_()
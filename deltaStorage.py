@@ -0,0 +1,197 @@
+"""@package docstring
+Delta-compressed storage of near-identical timelapse frames.
+
+Consecutive rounds at the same focus offset produce nearly identical images. DeltaWriter stores
+the first frame of an offset as a keyframe, and every next frame as the residual to that
+keyframe, i.e. (frame - keyframe) modulo 256, which is small where the sample did not change.
+Both are compressed losslessly with zstd, or with zlib when zstandard is not installed.
+Every frame is a separate .dlt file, that refers to its keyframe by name, so any frame is
+reconstructed from two files in the same folder, see read_frame.
+
+A new keyframe is stored after keyframe_interval frames, or when the residual no longer
+compresses to less than max_ratio of the keyframe, e.g. when the sample moved.
+
+File layout: header (magic, version, flags, codec, dtype, ndim), shape (ndim x uint32),
+keyframe name (uint16 length + utf-8), compressed payload.
+
+Benchmark against PNG: python3 deltaStorage.py [--frames folder] [--count 20]
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import glob
+import zlib
+import struct
+import argparse
+import cv2
+import numpy as np
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'RDLT'
+VERSION = 1
+KEYFRAME = 0x01
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+DEFAULT_LEVEL = {CODEC_ZLIB: 1, CODEC_ZSTD: 3}  # fast enough for every round on the Pi
+HEADER = struct.Struct('>4sBBBcB')
+EXTENSION = '.dlt'
+
+
+def compress(data, codec, level):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, min(level, 9))
+
+
+def decompress(data, codec):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed frames")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode(image, keyframe=None, keyframe_name='', codec=None, level=None):
+    """ Encode an image, as residual to keyframe when given, and return the file contents. """
+    if codec is None:
+        codec = CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+    if level is None:
+        level = DEFAULT_LEVEL[codec]
+    image = np.ascontiguousarray(image)
+    if keyframe is None:
+        flags, payload = KEYFRAME, image
+    else:
+        # modular difference, so that the residual has the size of the image and the inverse is exact
+        flags, payload = 0, image - keyframe
+    name = keyframe_name.encode()
+    return b''.join([HEADER.pack(MAGIC, VERSION, flags, codec, image.dtype.char.encode(), image.ndim),
+                     struct.pack('>{}I'.format(image.ndim), *image.shape),
+                     struct.pack('>H', len(name)), name,
+                     compress(payload.tobytes(), codec, level)])
+
+
+def decode(data):
+    """ Decode file contents, return (array, is keyframe, keyframe name). """
+    magic, version, flags, codec, dtype, ndim = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a delta frame")
+    offset = HEADER.size
+    shape = struct.unpack_from('>{}I'.format(ndim), data, offset)
+    offset += 4*ndim
+    (length,) = struct.unpack_from('>H', data, offset)
+    name = data[offset + 2:offset + 2 + length].decode()
+    array = np.frombuffer(decompress(data[offset + 2 + length:], codec), dtype=dtype.decode()).reshape(shape)
+    return array, bool(flags & KEYFRAME), name
+
+
+def read_frame(filename):
+    """ Reconstruct the frame stored in filename, its keyframe is read from the same folder. """
+    with open(filename, 'rb') as f:
+        array, is_keyframe, keyframe_name = decode(f.read())
+    if is_keyframe:
+        return array
+    with open(os.path.join(os.path.dirname(filename), keyframe_name), 'rb') as f:
+        keyframe = decode(f.read())[0]
+    return keyframe + array
+
+
+class DeltaWriter:
+    """
+    Writes the frames of a single focus offset. The current keyframe is not kept in memory, but
+    in keyframe_file, and read back for every frame, so that a writer per offset costs no memory
+    between rounds, also when the folder of the frames is cleared.
+    """
+    def __init__(self, keyframe_file, keyframe_interval=100, max_ratio=0.5, level=None):
+        self.keyframe_file = keyframe_file
+        self.keyframe_interval = keyframe_interval
+        self.max_ratio = max_ratio
+        self.level = level
+        self.keyframe_name = None
+        self.keyframe_size = 0
+        self.count = 0  # frames since the keyframe
+
+    def write(self, image, filename):
+        """ Write image to filename, return the number of bytes written. """
+        data = None
+        if self.keyframe_name is not None and self.count < self.keyframe_interval:
+            keyframe = read_frame(self.keyframe_file)
+            if keyframe.shape == image.shape and keyframe.dtype == image.dtype:
+                data = encode(image, keyframe, self.keyframe_name, level=self.level)
+                if len(data) > self.max_ratio*self.keyframe_size:
+                    data = None
+            del keyframe
+        if data is None:
+            data = encode(image, level=self.level)
+            with open(self.keyframe_file, 'wb') as f:
+                f.write(data)
+            self.keyframe_name = os.path.basename(filename)
+            self.keyframe_size = len(data)
+            self.count = 0
+        self.count += 1
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return len(data)
+
+    def convert(self, filename):
+        """ Replace an image file, e.g. a PNG snapshot, by a delta frame, return the new file name. """
+        image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError("cannot read image {}".format(filename))
+        delta_filename = os.path.splitext(filename)[0] + EXTENSION
+        self.write(image, delta_filename)
+        os.remove(filename)
+        return delta_filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare delta storage with PNG, on recorded or synthetic frames")
+    parser.add_argument("--frames", help="folder with frames of a single focus offset, synthetic if omitted")
+    parser.add_argument("--count", type=int, default=20, help="number of frames")
+    parser.add_argument("--size", default="1640x1232", help="size of synthetic frames")
+    parser.add_argument("--noise", type=float, default=2.0, help="sensor noise of synthetic frames")
+    parser.add_argument("--level", type=int, help="compression level, default 3 for zstd and 1 for zlib")
+    args = parser.parse_args()
+
+    if args.frames:
+        files = sorted(glob.glob(os.path.join(args.frames, '*.png')))[:args.count]
+        if len(files) == 0:
+            sys.exit("no frames found in {}".format(args.frames))
+        frames = [cv2.imread(f, cv2.IMREAD_UNCHANGED) for f in files]
+    else:
+        # the same field of view every round, only the sensor noise differs
+        from simulator import counting_chamber_grid, blurred_frame
+        width, height = (int(v) for v in args.size.split('x'))
+        rng = np.random.default_rng(0)
+        grid = counting_chamber_grid((width, height))
+        frames = [blurred_frame(grid, 0.1, noise=args.noise, rng=rng) for i in range(args.count)]
+
+    raw_size = sum(frame.nbytes for frame in frames)
+    t = time.perf_counter()
+    png_size = sum(len(cv2.imencode('.png', frame)[1]) for frame in frames)
+    png_time = time.perf_counter() - t
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    writer = DeltaWriter(os.path.join(folder, 'bench_keyframe' + EXTENSION), level=args.level)
+    delta_size = 0
+    t = time.perf_counter()
+    for i, frame in enumerate(frames):
+        delta_size += writer.write(frame, os.path.join(folder, 'bench_{:04d}{}'.format(i, EXTENSION)))
+    delta_time = time.perf_counter() - t
+    t = time.perf_counter()
+    for i, frame in enumerate(frames):
+        filename = os.path.join(folder, 'bench_{:04d}{}'.format(i, EXTENSION))
+        if not np.array_equal(read_frame(filename), frame):
+            sys.exit("frame {} is not reconstructed exactly".format(i))
+    read_time = time.perf_counter() - t
+    for filename in glob.glob(os.path.join(folder, 'bench_*' + EXTENSION)):
+        os.remove(filename)
+
+    print("{} frames of {}, codec {}".format(len(frames), 'x'.join(str(s) for s in frames[0].shape), 'zstd' if zstandard else 'zlib'))
+    print("png:   ratio {:.2f}, {:.1f} ms/frame".format(raw_size/png_size, 1e3*png_time/len(frames)))
+    print("delta: ratio {:.2f}, {:.1f} ms/frame, read {:.1f} ms/frame".format(raw_size/delta_size, 1e3*delta_time/len(frames),
+                                                                             1e3*read_time/len(frames)))
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""@package docstring
+Memory-mapped archive of timelapse frames.
+
+Scrubbing through an experiment stored as PNG files means opening and decoding a file per frame.
+An archive packs the frames as raw uint8 pixels into a single data file, with an index of the
+timestamp, focus offset, position and shape of every frame. Readers memory-map the data file
+and get a numpy view of a frame without copying or decoding; the OS caches the pages.
+
+Files: <name>.frames, the concatenated frames, every frame starts at a multiple of ALIGN bytes,
+and <name>.index.npy, a structured numpy array with one record per frame, sorted by timestamp.
+Frames are appended to the data file, the index is rewritten on close, so an archive that was not
+closed loses the frames after the last close, but is not corrupted.
+
+Convert PNG (and .dlt, see deltaStorage.py) offset folders of an experiment, the folder name is the
+focus offset, and compare scrubbing speed with the PNG files:
+    python3 frameArchive.py convert folder [folder ...] --output experiment [--benchmark]
+    python3 frameArchive.py info experiment
+"""
+import os
+import glob
+import time
+import argparse
+import cv2
+import numpy as np
+from deltaStorage import read_frame, EXTENSION
+
+ALIGN = 4096 # page size, so that every frame starts on a page of its own
+INDEX = np.dtype([('timestamp_ms', '<i8'), ('focus_offset', '<f4'), ('position', '<i8'),
+                  ('height', '<i4'), ('width', '<i4'), ('channels', '<i4')])
+
+
+def archive_files(name):
+    return name + '.frames', name + '.index.npy'
+
+
+def timestamp_from_filename(filename):
+    """ Millisecond timestamp from the file names of PiVideoStream.takeImage, -1 if there is none. """
+    stem = os.path.basename(filename)[:16]
+    return int(stem) if stem.isdigit() else -1
+
+
+class ArchiveWriter:
+    """
+    Appends frames to the archive name, an existing archive is extended.
+    """
+    def __init__(self, name):
+        self.data_file, self.index_file = archive_files(name)
+        self.records = list(np.load(self.index_file)) if os.path.isfile(self.index_file) else []
+        self.file = open(self.data_file, 'ab')
+
+    def append(self, image, timestamp_ms, focus_offset=np.nan):
+        position = -(-self.file.tell()//ALIGN)*ALIGN
+        self.file.write(bytes(position - self.file.tell()))
+        self.file.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+        height, width = image.shape[:2]
+        self.records.append((timestamp_ms, focus_offset, position, height, width, image.shape[2] if image.ndim > 2 else 1))
+
+    def close(self):
+        self.file.close()
+        index = np.array([tuple(r) for r in self.records], dtype=INDEX)
+        index = index[np.argsort(index['timestamp_ms'], kind='stable')]
+        # write to a temporary file first, so readers never see a partial index
+        with open(self.index_file + '.tmp', 'wb') as f:
+            np.save(f, index)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FrameArchive:
+    """
+    Read access to the archive name: archive[i] is a read-only view of frame i, in timestamp order.
+    """
+    def __init__(self, name):
+        data_file, index_file = archive_files(name)
+        self.index = np.load(index_file)
+        self.data = np.memmap(data_file, dtype=np.uint8, mode='r') if os.path.getsize(data_file) else np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        record = self.index[i]
+        height, width, channels = int(record['height']), int(record['width']), int(record['channels'])
+        frame = self.data[record['position']:record['position'] + height*width*channels]
+        return frame.reshape((height, width, channels) if channels > 1 else (height, width))
+
+    @property
+    def timestamps(self):
+        return self.index['timestamp_ms']
+
+    def at(self, timestamp_ms, focus_offset=None):
+        """ Index of the last frame at or before timestamp_ms, optionally of a single focus offset, None if there is none. """
+        indices = np.arange(len(self.index)) if focus_offset is None else self.offset(focus_offset)
+        i = np.searchsorted(self.timestamps[indices], timestamp_ms, side='right') - 1
+        return int(indices[i]) if i >= 0 else None
+
+    def offset(self, focus_offset):
+        """ Indices of the frames at focus_offset. """
+        return np.nonzero(np.isclose(self.index['focus_offset'], focus_offset))[0]
+
+
+def convert(folders, name):
+    """ Append the frames of the offset folders to the archive name, return the list of files. """
+    files = []
+    with ArchiveWriter(name) as writer:
+        for folder in folders:
+            try:
+                focus_offset = float(os.path.basename(os.path.normpath(folder)))
+            except ValueError:
+                focus_offset = np.nan
+            for filename in sorted(glob.glob(os.path.join(folder, '*.png')) + glob.glob(os.path.join(folder, '*' + EXTENSION))):
+                image = read_frame(filename) if filename.endswith(EXTENSION) else cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+                if image is None:
+                    print("cannot read {}, skipped".format(filename))
+                    continue
+                writer.append(image, timestamp_from_filename(filename), focus_offset)
+                files.append(filename)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory-mapped frame archive")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help="append PNG/.dlt offset folders to an archive")
+    convert_parser.add_argument("folders", nargs='+', help="offset folders, the folder name is the focus offset")
+    convert_parser.add_argument("--output", required=True, help="archive name, without extension")
+    convert_parser.add_argument("--benchmark", action="store_true", help="compare reading all frames with the PNG files")
+    info_parser = subparsers.add_parser('info', help="list the frames of an archive")
+    info_parser.add_argument("name", help="archive name, without extension")
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        t = time.perf_counter()
+        files = convert(args.folders, args.output)
+        print("{} frames converted in {:.1f} s to {}".format(len(files), time.perf_counter() - t, args.output))
+        if args.benchmark and files:
+            t = time.perf_counter()
+            for filename in files:
+                image = read_frame(filename) if filename.endswith(EXTENSION) else cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+            t_files = time.perf_counter() - t
+            archive = FrameArchive(args.output)
+            t = time.perf_counter()
+            for i in range(len(archive)):
+                mean = archive[i].mean() # touch every pixel, a view alone costs nothing
+            t_archive = time.perf_counter() - t
+            print("reading {} frames: files {:.1f} ms/frame, archive {:.2f} ms/frame".format(
+                len(files), 1e3*t_files/len(files), 1e3*t_archive/len(archive)))
+    else:
+        archive = FrameArchive(args.name)
+        for i, record in enumerate(archive.index):
+            print("{:6d} {:16d} offset {:6.2f} {}x{}x{}".format(i, record['timestamp_ms'], record['focus_offset'],
+                                                                 record['width'], record['height'], record['channels']))
+        print("{} frames, {:.1f} MB".format(len(archive), archive.data.nbytes/2**20))
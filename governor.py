@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+## Processing governor
+# Lowers the cost of live processing when SystemTemperatures raises its alarm, to keep the Pi
+# out of firmware throttling during long heated experiments, and restores full quality when the
+# alarm is removed. Under alarm the processor handles every decimation-th frame, the bilateral
+# filter is skipped, the focus metric uses the smallest Laplacian aperture, and with focus target 2
+# the grid is only segmented every segment_decimation-th processed frame.
+# The Laplacian aperture and the bilateral filter change the scale of the focus metric, so while an
+# autofocus search runs, which compares the metric between positions, they are changed only after
+# it finished. Decimation applies at once.
+#
+from PyQt5.QtCore import QObject, QSettings, pyqtSignal, pyqtSlot
+
+
+class ProcessingGovernor(QObject):
+    postMessage = pyqtSignal(str)
+
+    def __init__(self, imageProcessor, autoFocus=None):
+        super().__init__()
+        self.ip = imageProcessor
+        self.af = autoFocus
+        self.pending = None # (Laplacian ksize, bilateral ksize) to apply after the autofocus search
+        if autoFocus is not None:
+            autoFocus.focussed.connect(self.applyPending)
+        settings = QSettings("settings.ini", QSettings.IniFormat)
+        self.decimation = settings.value('governor/decimation', 2, type=int)
+        self.segment_decimation = settings.value('governor/segment_decimation', 5, type=int)
+        self.laplacian_ksize = settings.value('governor/laplacian_ksize', 1, type=int)
+        self.throttled = False
+        self.saved = None
+
+    @pyqtSlot()
+    def throttle(self):
+        if self.throttled:
+            return
+        try:
+            self.saved = (self.ip.decimation, self.ip.segmentDecimation, self.ip.laplacianKsize, self.ip.enhancer.ksize)
+            self.ip.setDecimation(self.decimation)
+            self.ip.setSegmentDecimation(self.segment_decimation)
+            self.setMetric(self.laplacian_ksize, 0)
+            self.throttled = True
+            self.postMessage.emit("{}: info; processing throttled, every {:d}th frame, no bilateral filter, Laplacian ksize {:d}".format(
+                self.__class__.__name__, self.decimation, self.laplacian_ksize))
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
+    @pyqtSlot()
+    def restore(self):
+        if not self.throttled:
+            return
+        try:
+            decimation, segment_decimation, laplacian_ksize, ksize = self.saved
+            self.ip.setDecimation(decimation)
+            self.ip.setSegmentDecimation(segment_decimation)
+            self.setMetric(laplacian_ksize, ksize)
+            self.throttled = False
+            self.postMessage.emit("{}: info; processing restored".format(self.__class__.__name__))
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
+    def setMetric(self, laplacian_ksize, ksize):
+        if self.af is not None and self.af.busy:
+            self.pending = (laplacian_ksize, ksize)
+            self.postMessage.emit("{}: info; focus metric change deferred until autofocus finished".format(self.__class__.__name__))
+        else:
+            self.pending = None
+            self.ip.setLaplacianKsize(laplacian_ksize)
+            self.ip.enhancer.setKsize(ksize)
+
+    @pyqtSlot(float)
+    def applyPending(self, focus):
+        if self.pending is not None:
+            try:
+                self.setMetric(*self.pending)
+            except Exception as err:
+                self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
@@ -0,0 +1,260 @@
+"""@package docstring
+In-process h264 frame counting and MP4 muxing.
+
+H264Output is a picamera custom output. It parses the h264 byte stream into NAL units while it is
+being recorded, groups them into frames (access units) that are timestamped on arrival, and writes
+them straight into an MP4 file. The MP4 therefore has the real frame timing, without a decode pass
+(ffprobe -count_frames) or boxing afterwards (MP4Box).
+
+MP4 layout: ftyp, mdat (64-bit size, patched on close), moov (appended on close).
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import struct
+
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+START_CODE = b'\x00\x00\x01'
+MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def box(box_type, *payloads):
+    data = b''.join(payloads)
+    return struct.pack('>I', 8 + len(data)) + box_type + data
+
+
+def full_box(box_type, version, flags, *payloads):
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+class MP4Writer:
+    """
+    Writes h264 frames to an MP4 file with a single video track, one frame per chunk.
+    Frames are lists of NAL units (without start codes), timestamps are in seconds.
+    """
+    timescale = 90000
+
+    def __init__(self, filename, frame_size):
+        self.filename = filename
+        self.width, self.height = frame_size
+        self.file = open(filename, 'wb')
+        self.file.write(box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso2', b'avc1', b'mp41'))
+        self.mdat_offset = self.file.tell()
+        self.file.write(struct.pack('>I4sQ', 1, b'mdat', 0))  # 64-bit size, patched on close
+        self.sizes = []
+        self.offsets = []
+        self.timestamps = []
+        self.keyframes = []
+
+    def addFrame(self, nal_units, timestamp, keyframe):
+        self.offsets.append(self.file.tell())
+        sample = b''.join(struct.pack('>I', len(nal)) + nal for nal in nal_units)
+        self.file.write(sample)
+        self.sizes.append(len(sample))
+        self.timestamps.append(timestamp)
+        if keyframe:
+            self.keyframes.append(len(self.sizes))  # 1-based sample number
+
+    def durations(self):
+        # frame durations in timescale units, the last frame lasts as long as the average frame
+        ticks = [round((t - self.timestamps[0])*self.timescale) for t in self.timestamps]
+        deltas = [max(b - a, 1) for a, b in zip(ticks[:-1], ticks[1:])]
+        deltas.append(round(sum(deltas)/len(deltas)) if deltas else self.timescale)
+        return deltas
+
+    def close(self, sps, pps):
+        try:
+            end = self.file.tell()
+            self.file.seek(self.mdat_offset + 8)
+            self.file.write(struct.pack('>Q', end - self.mdat_offset))
+            self.file.seek(end)
+            if self.sizes and sps is not None and pps is not None:
+                self.file.write(self.moov(sps, pps))
+        finally:
+            self.file.close()
+
+    def moov(self, sps, pps):
+        deltas = self.durations()
+        duration = sum(deltas)
+        # run length encoded frame durations
+        stts = []
+        for d in deltas:
+            if stts and stts[-1][1] == d:
+                stts[-1][0] += 1
+            else:
+                stts.append([1, d])
+
+        avcC = box(b'avcC', bytes([1, sps[1], sps[2], sps[3], 0xFF, 0xE1]), struct.pack('>H', len(sps)), sps,
+                   bytes([1]), struct.pack('>H', len(pps)), pps)
+        avc1 = box(b'avc1', bytes(6), struct.pack('>H', 1), bytes(16), struct.pack('>HH', self.width, self.height),
+                   struct.pack('>IIIH', 0x00480000, 0x00480000, 0, 1), bytes(32), struct.pack('>Hh', 0x18, -1), avcC)
+        stbl = box(b'stbl',
+                   full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+                   full_box(b'stts', 0, 0, struct.pack('>I', len(stts)), b''.join(struct.pack('>II', n, d) for n, d in stts)),
+                   full_box(b'stss', 0, 0, struct.pack('>I', len(self.keyframes)), b''.join(struct.pack('>I', k) for k in self.keyframes)),
+                   full_box(b'stsc', 0, 0, struct.pack('>IIII', 1, 1, 1, 1)),
+                   full_box(b'stsz', 0, 0, struct.pack('>II', 0, len(self.sizes)), b''.join(struct.pack('>I', s) for s in self.sizes)),
+                   full_box(b'co64', 0, 0, struct.pack('>I', len(self.offsets)), b''.join(struct.pack('>Q', o) for o in self.offsets)))
+        minf = box(b'minf',
+                   full_box(b'vmhd', 0, 1, bytes(8)),
+                   box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+                   stbl)
+        mdia = box(b'mdia',
+                   full_box(b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, self.timescale, duration), struct.pack('>HH', 0x55C4, 0)),
+                   full_box(b'hdlr', 0, 0, bytes(4), b'vide', bytes(12), b'VideoHandler\x00'),
+                   minf)
+        tkhd = full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, duration), bytes(8), struct.pack('>hhhH', 0, 0, 0, 0),
+                        MATRIX, struct.pack('>II', self.width << 16, self.height << 16))
+        mvhd = full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, self.timescale, duration, 0x00010000, 0x0100),
+                        bytes(10), MATRIX, bytes(24), struct.pack('>I', 2))
+        return box(b'moov', mvhd, box(b'trak', tkhd, mdia))
+
+
+class H264Output:
+    """
+    Custom picamera output, e.g. camera.start_recording(H264Output('clip.mp4', size), format='h264', ...)
+    Parses the stream into NAL units as it arrives, counts frames, collects their arrival times and
+    muxes them into an MP4 file. Call close() after stop_recording.
+    """
+    def __init__(self, filename, frame_size, clock=time.monotonic):
+        self.clock = clock
+        self.writer = MP4Writer(filename, frame_size)
+        self.buffer = bytearray()
+        self.nal_start = None  # start of the current NAL unit in the buffer
+        self.nal_time = None  # arrival time of the current NAL unit
+        self.search_from = 0
+        self.sps = self.pps = None
+        self.prefix = []  # SEI units, belonging to the next frame
+        self.frame = None  # NAL units of the current frame
+        self.frame_time = None
+        self.keyframe = False
+        self.frames = 0
+        self.timestamps = []
+
+    def write(self, buf):
+        t = self.clock()
+        self.buffer += buf
+        while True:
+            i = self.buffer.find(START_CODE, self.search_from)
+            if i < 0:
+                # a start code may be split over two writes
+                self.search_from = max(len(self.buffer) - 2, 0 if self.nal_start is None else self.nal_start)
+                break
+            if self.nal_start is not None:
+                # strip the leading zero of a 4 byte start code, and trailing zero bytes
+                self.handleNAL(bytes(self.buffer[self.nal_start:i]).rstrip(b'\x00'), self.nal_time)
+            self.nal_start = self.search_from = i + len(START_CODE)
+            self.nal_time = t
+        # drop parsed data
+        if self.nal_start is not None and self.nal_start > 0:
+            del self.buffer[:self.nal_start]
+            self.search_from -= self.nal_start
+            self.nal_start = 0
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def handleNAL(self, nal, t):
+        if len(nal) == 0:
+            return
+        nal_type = nal[0] & 0x1F
+        if nal_type == NAL_SPS:
+            self.sps = nal
+        elif nal_type == NAL_PPS:
+            self.pps = nal
+        elif nal_type == NAL_SEI:
+            self.prefix.append(nal)
+        elif nal_type in (NAL_SLICE, NAL_IDR_SLICE):
+            # first_mb_in_slice == 0, i.e. exp-Golomb code '1', marks the first slice of a new frame
+            if len(nal) > 1 and nal[1] & 0x80:
+                self.finishFrame()
+                self.frame = self.prefix + [nal]
+                self.prefix = []
+                self.frame_time = t
+                self.keyframe = nal_type == NAL_IDR_SLICE
+            elif self.frame is not None:
+                self.frame.append(nal)
+        # access unit delimiters, filler data etc. are dropped
+
+    def finishFrame(self):
+        if self.frame is not None:
+            self.writer.addFrame(self.frame, self.frame_time, self.keyframe)
+            self.timestamps.append(self.frame_time)
+            self.frames += 1
+            self.frame = None
+
+    def fps(self):
+        # real frame rate, based on arrival times
+        if self.frames < 2:
+            return 0.0
+        return (self.frames - 1)/(self.timestamps[-1] - self.timestamps[0])
+
+    def close(self):
+        if self.nal_start is not None:
+            self.handleNAL(bytes(self.buffer[self.nal_start:]).rstrip(b'\x00'), self.nal_time)
+        self.finishFrame()
+        self.writer.close(self.sps, self.pps)
+
+
+class SegmentedH264Output(H264Output):
+    """
+    Splits the recording into MP4 segments named <prefix>_partNNN.mp4. A new segment is started
+    at the first keyframe after the current segment reached segment_size bytes, so that every
+    segment can be played on its own; set the encoder intra_period accordingly.
+    Finished segments are pushed to storage, a SegmentUploader, together with the upload function.
+    When a frame does not fit in the storage budget, the output waits at most timeout seconds,
+    which stalls the encoder. If there is still no space, frames are dropped until the next
+    keyframe that fits.
+    """
+    def __init__(self, filename_prefix, frame_size, segment_size, storage, upload, timeout=5, clock=time.monotonic):
+        self.filename_prefix = filename_prefix
+        self.frame_size = frame_size
+        self.segment_size = segment_size
+        self.storage = storage
+        self.upload = upload
+        self.timeout = timeout
+        self.segments = 0
+        self.dropping = False
+        self.dropped = 0
+        super().__init__(self.segmentFileName(), frame_size, clock)
+
+    def segmentFileName(self):
+        return '{}_part{:03d}.mp4'.format(self.filename_prefix, self.segments)
+
+    def nextSegment(self):
+        self.writer.close(self.sps, self.pps)
+        self.storage.push(self.writer.filename, self.upload)
+        self.segments += 1
+        self.writer = MP4Writer(self.segmentFileName(), self.frame_size)
+
+    def finishFrame(self):
+        if self.frame is None:
+            return
+        if self.keyframe and self.writer.sizes and self.writer.file.tell() >= self.segment_size:
+            self.nextSegment()
+        frame_size = sum(len(nal) + 4 for nal in self.frame)
+        # do not wait while dropping, to catch up as soon as possible
+        timeout = 0 if self.dropping else self.timeout
+        if (self.dropping and not self.keyframe) or not self.storage.waitForSpace(self.writer.file.tell() + frame_size, timeout):
+            self.dropping = True
+            self.dropped += 1
+            self.frame = None
+            return
+        self.dropping = False
+        super().finishFrame()
+
+    def close(self):
+        super().close()
+        if self.writer.sizes:
+            self.storage.push(self.writer.filename, self.upload)
+            self.segments += 1
+        else:
+            os.remove(self.writer.filename)
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Headless application, runs a timelapse experiment without GUI, preview or plots.
+Usage: python3 headless.py [--simulate] [--coordinator host:port] exp_1.ini
+"""
+import sys
+from checkOS import is_raspberry_pi
+
+simulate = '--simulate' in sys.argv
+if not simulate and not is_raspberry_pi():
+    print("ERROR: this app is for raspberrypi")
+    exit()
+
+from PyQt5.QtCore import Qt, QThread, QTimer, QSettings, QCoreApplication
+from log import LogFile
+from imageProcessor import ImageProcessor
+from autoFocus import AutoFocus
+from voiceCoil import VoiceCoil
+from heater import Heater
+from timeLapse import TimeLapse
+from sysTemp import SystemTemperatures
+from sensorPoller import SensorPoller
+from governor import ProcessingGovernor
+from timeSeries import TimeSeriesRecorder
+from notifier import Notifier
+import instrumentation
+import os
+import signal
+import argparse
+import pigpio
+
+
+'''
+headless application
+'''
+parser = argparse.ArgumentParser(description="Run a timelapse experiment without GUI")
+parser.add_argument("settings_file", help="timelapse settings file, e.g. exp_1.ini")
+parser.add_argument("--simulate", action="store_true", help="run on simulated camera, voice coil and heater")
+parser.add_argument("--coordinator", help="host:port of the coordinator that starts the experiment, see coordinator.py")
+parser.add_argument("--unit", help="name of this unit at the coordinator, default the host name")
+args = parser.parse_args()
+if not os.path.isfile(args.settings_file):
+    print("ERROR: timelapse settings file {} not found".format(args.settings_file))
+    exit()
+
+settings = QSettings("settings.ini", QSettings.IniFormat)
+if settings.value('processing/worker_process', False, type=bool):
+    # fork the processing worker first, before pigpio and Qt start their threads
+    from processWorker import new_worker, ProcessImageProcessor
+    worker = new_worker()
+if simulate:
+    from simulator import SimulatedPi, SimulatedVideoStream
+    pio = SimulatedPi()
+else:
+    from pyqtpicam import PiVideoStream
+    pio = pigpio.pi()
+if not pio.connected:
+    print("ERROR: pigpio daemon is not started")
+    exit()
+
+# Create objects
+app = QCoreApplication(sys.argv)
+lw = LogFile()
+vs = SimulatedVideoStream(pio) if simulate else PiVideoStream()
+if settings.value('processing/worker_process', False, type=bool):
+    ip = ProcessImageProcessor(worker)
+else:
+    ip = ImageProcessor()
+vc = VoiceCoil(pio)
+af = AutoFocus(display=False)
+tl = TimeLapse()
+sp = SensorPoller()
+htr = Heater(pio, 2000, poller=sp)
+st = SystemTemperatures(interval=10, alarm_temperature=55, poller=None if simulate else sp)
+gv = ProcessingGovernor(ip, af)
+# the quality of every frame and the heater readings as 10 s means, about 280 kB a day on the RAM disk
+ts = TimeSeriesRecorder(intervals={'quality': 10, 'temperature': 10})
+nt = Notifier(os.path.sep.join([settings.value('temp_folder'), 'spool']))
+
+# Connect logging signals
+lw.setLogFileName(os.path.sep.join([settings.value('temp_folder'),"temp.log"]))
+vs.postMessage.connect(lw.append)
+ip.postMessage.connect(lw.append)
+af.postMessage.connect(lw.append)
+vc.postMessage.connect(lw.append)
+htr.postMessage.connect(lw.append)
+tl.postMessage.connect(lw.append)
+st.postMessage.connect(lw.append)
+sp.postMessage.connect(lw.append)
+gv.postMessage.connect(lw.append)
+ts.postMessage.connect(lw.append)
+nt.postMessage.connect(lw.append)
+
+# Logging and progress also go to the coordinator, which hands out the capture windows
+if args.coordinator:
+    from coordinator import CoordinatorClient
+    cc = CoordinatorClient(args.coordinator, args.unit)
+    cc.postMessage.connect(lw.append)
+    for obj in (vs, ip, af, vc, htr, tl, st, cc):
+        obj.postMessage.connect(cc.log)
+    tl.coordinated = True
+    tl.progressUpdate.connect(cc.progress)
+    tl.requestWindow.connect(cc.requestWindow)
+    tl.releaseWindow.connect(cc.releaseWindow)
+    tl.cancelWindow.connect(cc.cancelWindow)
+    cc.windowGranted.connect(tl.grantedSlot, type=Qt.QueuedConnection)
+
+# Hot-path instrumentation, summaries go to the log and the stats file
+if settings.value('instrumentation/enabled', False, type=bool):
+    instrumentation.enable()
+    sr = instrumentation.StatsReporter(interval=int(settings.value('instrumentation/interval', 60)),
+                                       stats_file=settings.value('instrumentation/stats_file'))
+    sr.postMessage.connect(lw.append)
+
+# Start video stream, nobody looks at the frames so skip drawing overlays
+ip.setOverlay(False)
+sp.start()
+vs.initStream()
+ip.start(QThread.HighPriority)
+
+# Connect processing signals, all queued otherwise messages get lost in the long run...
+# The voice coil value takes over the role of the VC spinbox in the GUI
+vs.frame.connect(ip.update, type=Qt.BlockingQueuedConnection)
+if not simulate:
+    # the camera zoom moves the frames over the sample, see PiVideoStream.setZoom
+    vs.roiChanged.connect(ip.setCaptureROI)
+ip.quality.connect(af.imageQualityUpdate, type=Qt.BlockingQueuedConnection)
+af.setFocus.connect(vc.setVal, type=Qt.QueuedConnection)
+tl.setLogFileName.connect(lw.setLogFileName, type=Qt.QueuedConnection)
+tl.setImageStoragePath.connect(vs.setStoragePath, type=Qt.QueuedConnection)
+tl.startCamera.connect(vs.initStream, type=Qt.QueuedConnection)
+tl.stopCamera.connect(vs.pause, type=Qt.QueuedConnection)
+tl.setFocusTarget.connect(ip.setFocusTarget, type=Qt.QueuedConnection)
+tl.startAutoFocus.connect(lambda: af.start(tl.focus if tl.focus is not None else vc.value), type=Qt.QueuedConnection)
+af.focussed.connect(tl.focussedSlot, type=Qt.QueuedConnection)
+tl.takeImage.connect(lambda highRes: vs.takeImage(highRes=highRes), type=Qt.QueuedConnection)
+tl.subscribeHighRes.connect(vs.subscribeHighRes, type=Qt.QueuedConnection)
+tl.unsubscribeHighRes.connect(vs.unsubscribeHighRes, type=Qt.QueuedConnection)
+tl.setClipUploader.connect(vs.setClipUploader, type=Qt.QueuedConnection)
+tl.recordClip.connect(lambda dur: vs.recordClip(duration=dur), type=Qt.QueuedConnection)
+tl.setFocusWithOffset.connect(lambda offset: vc.setVal((tl.focus if tl.focus is not None else focus) + offset), type=Qt.QueuedConnection)
+vs.captured.connect(tl.capturedSlot, type=Qt.QueuedConnection)
+vs.frame.connect(tl.imageUpdate, type=Qt.QueuedConnection)
+htr.reading.connect(tl.temperatureUpdate, type=Qt.QueuedConnection)
+
+# Metrics time series, record is thread safe, so it is called directly from the emitting threads
+tl.setMetricsPath.connect(ts.setPath, type=Qt.QueuedConnection)
+ip.quality.connect(lambda value: ts.record('quality', value), type=Qt.DirectConnection)
+htr.reading.connect(lambda value: ts.record('temperature', value), type=Qt.DirectConnection)
+af.focussed.connect(lambda value: ts.record('focus', value), type=Qt.DirectConnection)
+vs.captured.connect(lambda: ts.record('voice_coil', vc.value), type=Qt.DirectConnection)
+
+# Notifications are spooled and mailed by the notifier thread, never in the timelapse rounds
+tl.notify.connect(nt.notify, type=Qt.QueuedConnection)
+vs.captured.connect(lambda: lw.append("main: info; voice coil={:.1f} temperature={:.1f}".format(vc.value, htr.temperature)), type=Qt.QueuedConnection)
+tl.setTemperature.connect(htr.setTemperature, type=Qt.QueuedConnection)
+st.alarm.connect(gv.throttle)
+st.alarmRemoved.connect(gv.restore)
+
+# Connect closing signals
+def close():
+    if instrumentation.enabled:
+        sr.stop()
+    sp.stop()
+    htr.stop()
+    ip.stop()
+    vs.stop()
+    vc.stop()
+    af.stop()
+    tl.stop()
+    ts.close()
+    nt.stop()
+    app.quit()
+
+st.failure.connect(close, type=Qt.QueuedConnection)
+tl.finished.connect(close, type=Qt.QueuedConnection)
+
+# Start the show, using the last settings of the GUI
+ip.enhancer.setRotateAngle(float(settings.value('mainwindow/rotate', 0.0)))
+ip.enhancer.setGamma(float(settings.value('mainwindow/gamma', 1.0)))
+ip.enhancer.setClaheClipLimit(float(settings.value('mainwindow/clahe', 0.0)))
+ip.enhancer.setBlend(0.25)
+ip.enhancer.setKsize(5)
+ip.setFocusTarget(int(settings.value('mainwindow/Focus target', 0)))
+focus = float(settings.value('mainwindow/VC', 0.0))
+vc.setVal(focus)
+vs.setStoragePath(settings.value('temp_folder'))
+nt.start()
+
+# reload settings.ini and the experiment file on SIGHUP, e.g. kill -HUP <pid>
+def reloadConfig(signum, frame):
+    vs.reloadConfig()
+    tl.reloadConfig()
+
+signal.signal(signal.SIGHUP, reloadConfig)
+# let the interpreter run now and then, so that the signal is handled while Qt waits for events
+keepAlive = QTimer()
+keepAlive.timeout.connect(lambda: None)
+keepAlive.start(500)
+if args.coordinator:
+    cc.start.connect(lambda delay_s: QTimer.singleShot(round(1000*delay_s), lambda: tl.start(os.path.abspath(args.settings_file))))
+else:
+    QTimer.singleShot(0, lambda: tl.start(os.path.abspath(args.settings_file)))
+app.exec_()
@@ -3,9 +3,12 @@
 ## Heater
 # MCP9800 temp sensor communicating via I2C_SDA, I2C_SCL, and alert pin on GPIO.
 # Resistive heater using PWM on GPIO .
+# The PID controller runs fast while tracking a setpoint change, and at interval at steady state, see pidController.py
+# With a SensorPoller, the sensor is read on the poller thread, and update uses the latest reading.
 #
 import pigpio
-from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import QObject, QThread, QTimer, QSettings, pyqtSignal, pyqtSlot
+from pidController import PIDController
 import time
 
 class Heater(QThread):
@@ -24,7 +27,7 @@ class Heater(QThread):
     prevEror = None
     kP, kI, kD = 1.0, 0.1, 0.5    
 
-    def __init__(self, pio, interval=1000, setPoint=None):
+    def __init__(self, pio, interval=1000, setPoint=None, poller=None):
         super().__init__()
         if not isinstance(pio, pigpio.pi):
             raise TypeError("Heater constructor attribute is not a pigpio.pi instance!")
@@ -33,7 +36,16 @@ class Heater(QThread):
         if setPoint is not None and not (20 < setPoint < 100):
             raise ValueError("Heater setpoint value is unreasonable")
         self.pio = pio  # reference to pigpio
-        self.interval = interval  # timer interval, i.e. update period [ms]
+        self.interval = interval  # timer interval at steady state, i.e. update period [ms]
+        settings = QSettings("settings.ini", QSettings.IniFormat)
+        self.controller = PIDController(kP=settings.value('heater/kP', self.kP, type=float),
+                                        kI=settings.value('heater/kI', self.kI, type=float),
+                                        kD=settings.value('heater/kD', self.kD, type=float),
+                                        tau_d=settings.value('heater/tau_d', 5.0, type=float),
+                                        fast_period=min(settings.value('heater/fast_interval', 500, type=int), interval)/1000,
+                                        slow_period=interval/1000,
+                                        band=settings.value('heater/band', 0.25, type=float))
+        self.update_time = None
         self.setTemperature(setPoint)
         self.timer = QTimer()
         self.timer_temperature_message = QTimer()
@@ -45,6 +57,10 @@ class Heater(QThread):
         self.pio.set_PWM_dutycycle(self.pwm_pin, 0) # PWM off
         self.MCP9800Handle = self.pio.i2c_open(self.i2cBus, self.MCP9800Address)  # open device on bus
         self.pio.i2c_write_byte_data(self.MCP9800Handle, 0x01, 0b01100000)  # write config register resolution = 10 bit, see p18 of datasheet
+        self.poller = poller
+        if self.poller is not None:
+            # read as often as the controller updates, fast while tracking, slow at steady state
+            self.poller.addSensor('heater', self.readTemperature, lambda: 1000*self.controller.period())
         self.timer.timeout.connect(self.update)
         self.timer.start(self.interval)
         self.timer_temperature_message.timeout.connect(self.send_temperature_message)
@@ -54,26 +70,31 @@ class Heater(QThread):
     def send_temperature_message(self):
         self.postMessage.emit("{}: info; T={}°C".format(self.__class__.__name__, self.temperature))
         
+    def readTemperature(self):
+        data = self.pio.i2c_read_word_data(self.MCP9800Handle, 0x0)
+        return round((data & 0xFF) + (data >> 12)*2**-4, 1)  # MSB and LSB seem flipped
+
     @pyqtSlot()
     def update(self):        
         try:
             if self.pio is not None:
-                data = self.pio.i2c_read_word_data(self.MCP9800Handle, 0x0)
-                self.temperature = round((data & 0xFF) + (data >> 12)*2**-4, 1)  # MSB and LSB seem flipped
+                if self.poller is None:
+                    t, self.temperature = time.monotonic(), self.readTemperature()
+                else:
+                    reading = self.poller.latest('heater')
+                    if reading is None or reading[0] == self.update_time:
+                        return # no new reading yet
+                    t, self.temperature = reading
                 self.reading.emit(self.temperature)
 
-                # simple PID control
+                # PID control, with the real time since the previous update
                 if self.setPoint is not None:
-                    deltaTime = self.interval/1000
-                    self.error = self.setPoint - self.temperature
-                    self.deltaError = (self.error - self.prevError)/deltaTime if self.prevError is not None else 0
-                    self.intError += self.error * deltaTime
-
-                    actuator = round(self.kP * self.error + \
-                                     self.kI * self.intError + \
-                                     self.kD * self.deltaError, 1)
-                    actuator = actuator if actuator > 0 else 0
-                    self.setVal(actuator)
+                    deltaTime = t - self.update_time if self.update_time is not None else self.timer.interval()/1000
+                    self.setVal(round(self.controller.update(self.setPoint, self.temperature, deltaTime), 1))
+                    interval = round(1000*self.controller.period())
+                    if interval != self.timer.interval():
+                        self.timer.setInterval(interval)
+                self.update_time = t
                     
         except Exception as err:
             self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))            
@@ -82,14 +103,12 @@ class Heater(QThread):
     @pyqtSlot(float)
     def setVal(self, val):
         try:
-            if val < 0 or val > 100:
-                raise ValueError('Value must be a nonnegative percentage')
-            else:
-                # val specifies percentage of full current
-                pwm_val = round((val/100)*self.PWM_dutycyle_range, 1)
-##                self.postMessage.emit("{}: info; heater value = {}".format(self.__class__.__name__, pwm_val))
-                if self.pio is not None:
-                    self.pio.set_PWM_dutycycle(self.pwm_pin, pwm_val)
+            # val specifies percentage of full current, clamped to [0, 100]
+            val = min(max(val, 0), 100)
+            pwm_val = round((val/100)*self.PWM_dutycyle_range, 1)
+##            self.postMessage.emit("{}: info; heater value = {}".format(self.__class__.__name__, pwm_val))
+            if self.pio is not None:
+                self.pio.set_PWM_dutycycle(self.pwm_pin, pwm_val)
         except Exception as err:
             self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
 
@@ -97,8 +116,9 @@ class Heater(QThread):
     def setTemperature(self, val):
         # if set to None, PID temperature control is stopped
         self.setPoint = val
-        self.prevError = None
-        self.intError = 0
+        self.controller.reset()
+        if hasattr(self, 'timer'):
+            self.timer.setInterval(round(1000*self.controller.period())) # track the new setpoint fast
         self.postMessage.emit("{}: info; heater temperature setpoint = {}°C".format(self.__class__.__name__, self.setPoint))
         
        
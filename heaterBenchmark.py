@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Heater controller benchmark.
+
+The temperature controller is run against the first order thermal plant of the simulator,
+in simulated time, with the MCP9800 quantization and measurement noise. The setpoint steps from
+ambient to the first setpoint, and halfway to the second. For every step the rise time, overshoot,
+settle time, and steady state error are reported, together with the number of sensor reads.
+The former fixed period controller (unbounded integral, unfiltered derivative, and outputs above
+100% rejected by setVal) is included as reference. Results are written to a JSON file.
+
+Usage: python3 heaterBenchmark.py [--setpoints 32,37] [--kP 1,5] [--kI 0.1] [--kD 0.5]
+"""
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from simulator import ThermalModel
+from pidController import PIDController
+
+
+class LegacyController:
+    """ The controller as it was in Heater.update, with a fixed period. """
+    def __init__(self, kP=1.0, kI=0.1, kD=0.5, period=2.0):
+        self.kP, self.kI, self.kD = kP, kI, kD
+        self.fixed_period = period
+        self.reset()
+
+    def reset(self):
+        self.prev_error = None
+        self.int_error = 0
+        self.output = 0.0
+
+    def update(self, setpoint, measurement, dt):
+        error = setpoint - measurement
+        delta_error = (error - self.prev_error)/dt if self.prev_error is not None else 0
+        self.prev_error = error
+        self.int_error += error*dt
+        actuator = max(round(self.kP*error + self.kI*self.int_error + self.kD*delta_error, 1), 0)
+        if actuator <= 100:  # setVal raised on larger values, leaving the output as it was
+            self.output = actuator
+        return self.output
+
+    def period(self):
+        return self.fixed_period
+
+
+def step_metrics(t, T, T_start, setpoint, band):
+    """ Rise time (10-90%), overshoot, settle time and steady state error of a single step, None when not reached. """
+    t, T = np.asarray(t) - t[0], np.asarray(T)
+    span = setpoint - T_start
+    rise = (T - T_start)/span
+    reached = np.any(rise >= 0.1) and np.any(rise >= 0.9)
+    t_10 = t[np.argmax(rise >= 0.1)] if reached else None
+    t_90 = t[np.argmax(rise >= 0.9)] if reached else None
+    outside = np.nonzero(np.abs(T - setpoint) > band)[0]
+    settled = len(outside) == 0 or outside[-1] < len(t) - 1
+    tail = t >= 0.8*t[-1]
+    return {'rise_s': round(float(t_90 - t_10), 1) if reached else None,
+            'overshoot': round(float(max(np.sign(span)*(T - setpoint).max(), 0)), 2),
+            'settle_s': round(float(t[outside[-1] + 1] if len(outside) else 0), 1) if settled else None,
+            'steady_state_error': round(float(np.mean(np.abs(T[tail] - setpoint))), 3)}
+
+
+def simulate(controller, setpoints, step_duration, band, resolution, noise, rng, plant_args):
+    sim_time = [0.0]
+    plant = ThermalModel(clock=lambda: sim_time[0], **plant_args)
+    controller.reset()
+    results = []
+    reads = 0
+    for setpoint in setpoints:
+        T_start = plant.update()
+        t_log, T_log = [], []
+        t_end = sim_time[0] + step_duration
+        dt = controller.period()
+        while sim_time[0] < t_end:
+            # MCP9800 reading, quantized
+            measurement = np.round((plant.update() + noise*rng.standard_normal())/resolution)*resolution
+            reads += 1
+            plant.setPower(controller.update(setpoint, measurement, dt))
+            dt = controller.period()
+            # integrate the plant finely, for the metrics
+            for i in range(10):
+                sim_time[0] += dt/10
+                t_log.append(sim_time[0])
+                T_log.append(plant.update())
+        metrics = step_metrics(t_log, T_log, T_start, setpoint, band)
+        metrics['setpoint'] = setpoint
+        results.append(metrics)
+    return {'steps': results, 'reads': reads}
+
+
+def list_of(type_):
+    return lambda s: [type_(v) for v in s.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the heater controller against a simulated thermal plant")
+    parser.add_argument("--setpoints", type=list_of(float), default=[32, 37], help="successive setpoints [°C]")
+    parser.add_argument("--step_duration", type=float, default=1800, help="duration of every setpoint [s]")
+    parser.add_argument("--kP", type=list_of(float), default=[1.0, 10.0])
+    parser.add_argument("--kI", type=list_of(float), default=[0.1])
+    parser.add_argument("--kD", type=list_of(float), default=[0.5])
+    parser.add_argument("--tau_d", type=float, default=5.0, help="derivative filter time constant [s]")
+    parser.add_argument("--fast_period", type=float, default=0.5, help="control period while tracking [s]")
+    parser.add_argument("--slow_period", type=float, default=2.0, help="control period at steady state [s]")
+    parser.add_argument("--band", type=float, default=0.25, help="settle band [°C]")
+    parser.add_argument("--resolution", type=float, default=0.25, help="sensor resolution [°C]")
+    parser.add_argument("--noise", type=float, default=0.05, help="sensor noise [°C]")
+    parser.add_argument("--T_amb", type=float, default=21.0, help="ambient temperature [°C]")
+    parser.add_argument("--K", type=float, default=0.4, help="plant gain [°C/%%]")
+    parser.add_argument("--tau", type=float, default=120.0, help="plant time constant [s]")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="heater_bench.json", help="JSON results file")
+    args = parser.parse_args()
+
+    plant_args = {'T_amb': args.T_amb, 'K': args.K, 'tau': args.tau}
+    controllers = []
+    for kP, kI, kD in itertools.product(args.kP, args.kI, args.kD):
+        gains = {'kP': kP, 'kI': kI, 'kD': kD}
+        controllers.append(('legacy', gains, LegacyController(period=args.slow_period, **gains)))
+        controllers.append(('pid', gains, PIDController(tau_d=args.tau_d, fast_period=args.fast_period, slow_period=args.slow_period,
+                                                        band=args.band, **gains)))
+    report = {'time': round(time.time()), 'args': vars(args), 'results': []}
+    for name, gains, controller in controllers:
+        result = simulate(controller, args.setpoints, args.step_duration, args.band, args.resolution, args.noise,
+                          np.random.default_rng(args.seed), plant_args)
+        result.update({'controller': name, 'gains': gains})
+        report['results'].append(result)
+        print("{:>6} kP={kP} kI={kI} kD={kD}, {} reads".format(name, result['reads'], **gains))
+        for s in result['steps']:
+            print("    to {:.1f}°C: rise {} s, overshoot {} °C, settle {} s, steady state error {} °C".format(
+                s['setpoint'], s['rise_s'], s['overshoot'], s['settle_s'], s['steady_state_error']))
+
+    with open(args.output, 'w') as f:
+        # strict JSON, values that were not reached are null
+        json.dump(report, f, indent=2, allow_nan=False)
+    print("results written to {}".format(args.output))
@@ -70,7 +70,7 @@ class ImageEnhancer(QObject):
             if self.cropRect[3] == 0:
                 self.cropRect[3] = self.image.shape[1]
 
-            # Convert to gray scale
+            # Convert to gray scale, a YUVFrame from the camera is the Y plane already
             if len(self.image.shape) > 2:  # if color image
                 self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
 
@@ -14,6 +14,7 @@ from PyQt5.QtCore import pyqtSignal, pyqtSlot, QThread, QEventLoop
 from fps import FPS
 from wait import wait_signal
 from rectangle import Rectangle
+import instrumentation
 
 def union(a,b):
     x = min(a[0], b[0])
@@ -45,6 +46,7 @@ class ImageProcessor(QThread):
     image = None
     imageQuality = 0
     ROI = None
+    ROIShape = None
     finished = pyqtSignal()
     postMessage = pyqtSignal(str)
     frame = pyqtSignal(np.ndarray)
@@ -57,6 +59,14 @@ class ImageProcessor(QThread):
         super().__init__()
 
         self.focusTarget = 0
+        self.drawOverlay = True
+        # processing cost, lowered by the governor when the CPU gets hot
+        self.decimation = 1 # process every n-th frame
+        self.segmentDecimation = 1 # segment every n-th processed frame, for focus target 2
+        self.laplacianKsize = 5 # aperture of the variance of Laplacian focus metric
+        self.frameCount = 0
+        self.gridROIs = None
+        self.captureROI = None # region of the camera (x, y, w, h) in capture frame coordinates
         
         self.enhancer.postMessage.connect(self.relayMessage)
         self.segmenter.postMessage.connect(self.relayMessage)
@@ -71,7 +81,10 @@ class ImageProcessor(QThread):
     # Note that we need this wrapper around the Thread run function, since the latter will not accept any parameters
     def update(self, image=None):
         try:
-            
+            self.frameCount += 1
+            if self.frameCount % self.decimation:
+                return # decimated
+
             if self.isRunning():
                 # thread is already running
                 # drop frame
@@ -99,48 +112,9 @@ class ImageProcessor(QThread):
                     self.finished.emit()
                     return
 
-                # Set general ROI
-                if self.ROI is None:
-                    ROI_leg = int(min(self.image.shape)/4)
-                    x, y = int(self.image.shape[1]/2), int(self.image.shape[0]/2)
-                    self.ROI = Rectangle(x - ROI_leg, y - ROI_leg, x + ROI_leg, y + ROI_leg)
+                # Enhance image and compute image quality
+                self.image, self.imageQuality = self.process(self.image)
 
-                # Enhance image
-                self.image = self.enhancer.start(self.image)
-                
-                if self.focusTarget == 0:
-                    # Compute variance of Laplacian in RoI
-                    img = self.image[self.ROI.y1:self.ROI.y2, self.ROI.x1:self.ROI.x2]
-                    self.imageQuality = cv2.Laplacian(img, ddepth=cv2.CV_32F, ksize=5).var()
-                    # draw ROI in image
-                    cv2.rectangle(self.image, self.ROI.p1, self.ROI.p2, (0, 255, 0), 2)                    
-                elif self.focusTarget == 1:
-                    # Segment image according to grid
-                    ROIs, self.imageQuality = self.segmenter.start(self.image)
-                    # draw ROIs in image
-                    for rois in ROIs:
-                        for roi in rois:
-                            cv2.rectangle(self.image, roi.p1, roi.p2, (0, 255, 0), 2)
-                elif self.focusTarget == 2:
-                    self.imageQuality, nr_of_rois = 0, 0
-                    # Segment image according to intersection of ROI and grid
-                    ROIs, _ = self.segmenter.start(self.image)                    
-                    for rois in ROIs:
-                        for roi in rois:
-                            roi_intersection = roi & self.ROI
-                            # xclude grid RoIS that go outside main ROI
-                            if roi_intersection is not None and roi_intersection.area == roi.area:
-                                # Compute variance of Laplacian in Grid RoIs
-                                img = self.image[roi.y1:roi.y2, roi.x1:roi.x2]
-                                self.imageQuality += cv2.Laplacian(img, ddepth=cv2.CV_32F, ksize=5).var()
-                                nr_of_rois += 1
-                                # draw ROIs in image                                
-                                cv2.rectangle(self.image, roi.p1, roi.p2, (0, 255, 0), 2)
-                    if nr_of_rois > 0:
-                        self.imageQuality = int(self.imageQuality/nr_of_rois)
-                else:
-                    raise ValueError("focusTarget unknown")
-                    
             except Exception as err:
                 self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))            
             else:
@@ -148,6 +122,80 @@ class ImageProcessor(QThread):
                 self.frame.emit(self.image)
                 self.quality.emit(self.imageQuality)
                 
+    def process(self, image):
+        '''
+        Enhance the image and compute the image quality according to the focus target.
+        Runs in the calling thread, so it can also be used without starting the worker, e.g. for benchmarking.
+        '''
+        # Set general ROI, again when the frame size changes, e.g. with a new camera region of interest
+        if self.ROI is None or self.ROIShape != image.shape[:2]:
+            self.ROIShape = image.shape[:2]
+            self.gridROIs = None
+            ROI_leg = int(min(image.shape)/4)
+            x, y = int(image.shape[1]/2), int(image.shape[0]/2)
+            self.ROI = Rectangle(x - ROI_leg, y - ROI_leg, x + ROI_leg, y + ROI_leg)
+
+        # Enhance image
+        with instrumentation.span('enhance'):
+            image = self.enhancer.start(image)
+        # without enhancement steps, the image may still be the read-only camera buffer
+        if self.drawOverlay and not image.flags.writeable:
+            image = image.copy()
+        return image, self.measure(image)
+
+    def measure(self, image):
+        '''
+        Compute the image quality of an enhanced image according to the focus target, and draw the RoIs used.
+        '''
+        if self.focusTarget == 0:
+            # Compute variance of Laplacian in RoI
+            with instrumentation.span('metric'):
+                img = image[self.ROI.y1:self.ROI.y2, self.ROI.x1:self.ROI.x2]
+                imageQuality = cv2.Laplacian(img, ddepth=cv2.CV_32F, ksize=self.laplacianKsize).var()
+            # draw ROI in image
+            if self.drawOverlay:
+                with instrumentation.span('overlay'):
+                    cv2.rectangle(image, self.ROI.p1, self.ROI.p2, (0, 255, 0), 2)
+        elif self.focusTarget == 1:
+            # Segment image according to grid
+            with instrumentation.span('segment'):
+                ROIs, imageQuality = self.segmenter.start(image)
+            # draw ROIs in image
+            if self.drawOverlay:
+                with instrumentation.span('overlay'):
+                    for rois in ROIs:
+                        for roi in rois:
+                            cv2.rectangle(image, roi.p1, roi.p2, (0, 255, 0), 2)
+        elif self.focusTarget == 2:
+            imageQuality = 0
+            # Segment image according to intersection of ROI and grid, the grid may be reused for a few frames
+            if self.gridROIs is None or (self.frameCount//self.decimation) % self.segmentDecimation == 0:
+                with instrumentation.span('segment'):
+                    self.gridROIs, _ = self.segmenter.start(image)
+            ROIs = self.gridROIs
+            # xclude grid RoIS that go outside main ROI
+            inner_rois = []
+            for rois in ROIs:
+                for roi in rois:
+                    roi_intersection = roi & self.ROI
+                    if roi_intersection is not None and roi_intersection.area == roi.area:
+                        inner_rois.append(roi)
+            # Compute variance of Laplacian in Grid RoIs
+            with instrumentation.span('metric'):
+                for roi in inner_rois:
+                    img = image[roi.y1:roi.y2, roi.x1:roi.x2]
+                    imageQuality += cv2.Laplacian(img, ddepth=cv2.CV_32F, ksize=self.laplacianKsize).var()
+            # draw ROIs in image
+            if self.drawOverlay:
+                with instrumentation.span('overlay'):
+                    for roi in inner_rois:
+                        cv2.rectangle(image, roi.p1, roi.p2, (0, 255, 0), 2)
+            if len(inner_rois) > 0:
+                imageQuality = int(imageQuality/len(inner_rois))
+        else:
+            raise ValueError("focusTarget unknown")
+        return imageQuality
+
     @pyqtSlot()
     def stop(self):
         self.postMessage.emit("{}: info; stopping".format(__class__.__name__))
@@ -171,5 +219,35 @@ class ImageProcessor(QThread):
 
     @pyqtSlot(int)
     def setFocusTarget(self, val):
-        self.focusTarget = val           
+        self.focusTarget = val
+        self.gridROIs = None # segment again, the grid of a previous target may be stale
+
+    @pyqtSlot(tuple)
+    def setCaptureROI(self, roi):
+        # the frames show another region of the sample, see PiVideoStream.roiChanged,
+        # so place the ROI and segment the grid again, also when the frame size stays the same
+        if roi != self.captureROI:
+            self.captureROI = roi
+            self.ROI = None
+            self.gridROIs = None
+
+    @pyqtSlot(bool)
+    def setOverlay(self, val):
+        # draw ROIs in the emitted frames, not needed when nobody looks at them
+        self.drawOverlay = val
+
+    @pyqtSlot(int)
+    def setDecimation(self, val):
+        self.decimation = max(val, 1)
+
+    @pyqtSlot(int)
+    def setSegmentDecimation(self, val):
+        self.segmentDecimation = max(val, 1)
+
+    @pyqtSlot(int)
+    def setLaplacianKsize(self, val):
+        if val in (1, 3, 5, 7):
+            self.laplacianKsize = val
+        else:
+            raise ValueError('Laplacian ksize must be 1, 3, 5 or 7')           
 
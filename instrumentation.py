@@ -0,0 +1,208 @@
+"""@package docstring
+Hot-path instrumentation with rolling latency histograms.
+
+Wrap a stage of the processing chain in a span:
+
+    with instrumentation.span('enhance'):
+        image = enhancer.start(image)
+
+When instrumentation is disabled, span() returns a shared no-op context manager, so the
+overhead is a function call. When enabled, durations are measured with perf_counter_ns and
+recorded in an HDR-style log-linear histogram per stage, with a relative precision of about 1.5%.
+The histograms are rolling: only the last nr_of_windows windows of window_s seconds are kept.
+StatsReporter periodically posts a summary to the log and writes it to a JSON stats file.
+
+Note that recording is not locked, in the rare event that two threads record the same stage at
+the same moment, a count may get lost, which is acceptable for statistics.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
+
+enabled = False
+window_s = 10  # length of a histogram window [s]
+nr_of_windows = 6  # number of windows in the rolling histogram
+stages = {}
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of durations in ns. Values below 2**sub_bits are counted exactly,
+    above that every power of two is split in 2**(sub_bits-1) buckets.
+    """
+    sub_bits = 7
+    half = 1 << (sub_bits - 1)
+    size = half*40  # covers durations below 2**45 ns (about 9.8 hours), longer ones go in the last bucket
+
+    def __init__(self):
+        self.counts = [0]*self.size
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        magnitude = max(value.bit_length() - self.sub_bits, 0)
+        return min(magnitude*self.half + (value >> magnitude), self.size - 1)
+
+    def lower_bound(self, index):
+        magnitude = max((index >> (self.sub_bits - 1)) - 1, 0)
+        return (index - magnitude*self.half) << magnitude
+
+    def record(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def clear(self):
+        self.counts = [0]*self.size
+        self.count = self.total = self.max = 0
+
+    def add(self, other):
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0
+        threshold = q/100*self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if c and cumulative >= threshold:
+                # report the middle of the bucket
+                return min((self.lower_bound(i) + self.lower_bound(i + 1))/2, self.max)
+        return self.max
+
+
+class Stage:
+    """
+    Rolling set of histograms of a single stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.windows = [LatencyHistogram() for i in range(nr_of_windows)]
+        self.window_nr = int(time.monotonic()//window_s)
+
+    def advance(self):
+        window_nr = int(time.monotonic()//window_s)
+        if window_nr != self.window_nr:
+            # clear the windows that have expired since the last call
+            for nr in range(max(self.window_nr + 1, window_nr - nr_of_windows + 1), window_nr + 1):
+                self.windows[nr % nr_of_windows].clear()
+            self.window_nr = window_nr
+        return window_nr
+
+    def record(self, value):
+        self.windows[self.advance() % nr_of_windows].record(value)
+
+    def histogram(self):
+        # merge the windows that have not expired
+        self.advance()
+        merged = LatencyHistogram()
+        for h in self.windows:
+            merged.add(h)
+        return merged
+
+    def summary(self):
+        h = self.histogram()
+        return {'n': h.count,
+                'rate_per_s': round(h.count/(nr_of_windows*window_s), 2),
+                'mean_ms': round(h.total/h.count/1e6, 3) if h.count else 0,
+                'p50_ms': round(h.percentile(50)/1e6, 3),
+                'p95_ms': round(h.percentile(95)/1e6, 3),
+                'p99_ms': round(h.percentile(99)/1e6, 3),
+                'max_ms': round(h.max/1e6, 3)}
+
+
+class _Span:
+    __slots__ = ('stage', 't')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, time.perf_counter_ns() - self.t)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_span = _NoSpan()
+
+
+def span(stage):
+    """ Context manager that records the duration of the enclosed code under stage. """
+    return _Span(stage) if enabled else _no_span
+
+
+def record(stage, value):
+    """ Record a duration in ns, e.g. measured across threads or callbacks. """
+    if enabled:
+        try:
+            stages[stage].record(value)
+        except KeyError:
+            stages.setdefault(stage, Stage(stage)).record(value)
+
+
+def enable(val=True):
+    global enabled
+    enabled = val
+
+
+def summary():
+    return {name: stage.summary() for name, stage in list(stages.items())}
+
+
+class StatsReporter(QObject):
+    """
+    Periodically post the latency summary of every stage and write it to a JSON stats file.
+    """
+    postMessage = pyqtSignal(str)
+
+    def __init__(self, interval=60, stats_file=None):
+        super().__init__()
+        self.stats_file = stats_file
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update)
+        self.timer.start(1000*interval)
+
+    @pyqtSlot()
+    def update(self):
+        try:
+            stats = summary()
+            for name, s in stats.items():
+                self.postMessage.emit("{}: info; {} n={:d} p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms max={:.1f}ms".format(
+                    self.__class__.__name__, name, s['n'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+            if self.stats_file is not None:
+                # write to a temporary file first, so readers never see a partial file
+                temp_file_name = self.stats_file + '.tmp'
+                with open(temp_file_name, 'w') as f:
+                    json.dump({'time': round(time.time(), 1), 'window_s': window_s*nr_of_windows, 'stages': stats}, f, indent=1)
+                os.replace(temp_file_name, self.stats_file)
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
+    @pyqtSlot()
+    def stop(self):
+        self.timer.stop()
+        self.update()
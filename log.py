@@ -4,7 +4,7 @@ Logging object
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import time
-from PyQt5.QtCore import pyqtSlot, QSettings
+from PyQt5.QtCore import pyqtSlot, QSettings, QObject
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QTextEdit
 
 
@@ -32,3 +32,29 @@ class LogWindow(QWidget):
     @pyqtSlot(str)
     def setLogFileName(self, s):
         self.log_file_name = s
+
+
+class LogFile(QObject):
+    """
+    Window-less counterpart of LogWindow, used when running headless.
+    Messages are printed to stdout and appended to the log file.
+    """
+
+    def __init__(self, echo=True):
+        super().__init__()
+        self.log_file_name = None
+        self.echo = echo
+
+    @pyqtSlot(str)
+    def append(self, s):
+        if self.echo:
+            print(s)
+        if self.log_file_name is not None:
+            with open(self.log_file_name, 'a+') as log_file:
+                s = s if '\n' in s else s + '\n'
+                s = str(round(time.time(),1)) + ";" + s
+                log_file.write(s)
+
+    @pyqtSlot(str)
+    def setLogFileName(self, s):
+        self.log_file_name = s
@@ -1,8 +1,11 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import sys
 from checkOS import is_raspberry_pi
 
-if not is_raspberry_pi():
+# run on simulated hardware with: python3 main.py --simulate
+simulate = '--simulate' in sys.argv
+if not simulate and not is_raspberry_pi():
     print("ERROR: this app is for raspberrypi")
     exit()
 
@@ -11,13 +14,18 @@ from PyQt5.QtWidgets import QApplication
 from mainWindow import MainWindow
 from log import LogWindow     
 from imageProcessor import ImageProcessor
-from pyqtpicam import PiVideoStream
 from autoFocus import AutoFocus
 from voiceCoil import VoiceCoil
 from heater import Heater
 from timeLapse import TimeLapse
 from sysTemp import SystemTemperatures
+from sensorPoller import SensorPoller
+from governor import ProcessingGovernor
+from timeSeries import TimeSeriesRecorder
+from notifier import Notifier
+import instrumentation
 import os
+import signal
 import pigpio
 
 
@@ -25,7 +33,16 @@ import pigpio
 main application
 '''
 settings = QSettings("settings.ini", QSettings.IniFormat)
-pio = pigpio.pi()
+if settings.value('processing/worker_process', False, type=bool):
+    # fork the processing worker first, before pigpio and Qt start their threads
+    from processWorker import new_worker, ProcessImageProcessor
+    worker = new_worker()
+if simulate:
+    from simulator import SimulatedPi, SimulatedVideoStream
+    pio = SimulatedPi()
+else:
+    from pyqtpicam import PiVideoStream
+    pio = pigpio.pi()
 if not pio.connected:
     print("ERROR: pigpio daemon is not started")
     exit()
@@ -34,13 +51,21 @@ if not pio.connected:
 app = QApplication([])
 mw = MainWindow()
 lw = LogWindow()
-vs = PiVideoStream()
-ip = ImageProcessor()
+vs = SimulatedVideoStream(pio) if simulate else PiVideoStream()
+if settings.value('processing/worker_process', False, type=bool):
+    ip = ProcessImageProcessor(worker)
+else:
+    ip = ImageProcessor()
 vc = VoiceCoil(pio)
 af = AutoFocus(display=True)
 tl = TimeLapse()
-htr = Heater(pio, 2000)
-st = SystemTemperatures(interval=10, alarm_temperature=55)
+sp = SensorPoller()
+htr = Heater(pio, 2000, poller=sp)
+st = SystemTemperatures(interval=10, alarm_temperature=55, poller=None if simulate else sp)
+gv = ProcessingGovernor(ip, af)
+# the quality of every frame and the heater readings as 10 s means, about 280 kB a day on the RAM disk
+ts = TimeSeriesRecorder(intervals={'quality': 10, 'temperature': 10})
+nt = Notifier(os.path.sep.join([settings.value('temp_folder'), 'spool']))
 
 # Connect logging signals
 lw.setLogFileName(os.path.sep.join([settings.value('temp_folder'),"temp.log"]))
@@ -52,6 +77,18 @@ vc.postMessage.connect(lw.append)
 htr.postMessage.connect(lw.append)
 tl.postMessage.connect(lw.append)
 st.postMessage.connect(lw.append)
+sp.postMessage.connect(lw.append)
+gv.postMessage.connect(lw.append)
+ts.postMessage.connect(lw.append)
+nt.postMessage.connect(lw.append)
+
+# Hot-path instrumentation, summaries go to the log and the stats file
+if settings.value('instrumentation/enabled', False, type=bool):
+    instrumentation.enable()
+    sr = instrumentation.StatsReporter(interval=int(settings.value('instrumentation/interval', 60)),
+                                       stats_file=settings.value('instrumentation/stats_file'))
+    sr.postMessage.connect(lw.append)
+    mw.closed.connect(sr.stop)
 
 # Connect GUI signals
 mw.rotateSpinBox.valueChanged.connect(ip.enhancer.setRotateAngle)
@@ -73,38 +110,62 @@ htr.reading.connect(mw.temperatureUpdate)
 ip.frame.connect(mw.update)
 ip.quality.connect(mw.imageQualityUpdate)
 
-# Start video stream
+# Start sensor polling and video stream
+sp.start()
 vs.initStream()
 ip.start(QThread.HighPriority)
 
 # Connect processing signals, all queued otherwise messages get lost in the long run...
 vs.frame.connect(ip.update, type=Qt.BlockingQueuedConnection)
+if not simulate:
+    # the camera zoom moves the frames over the sample, see PiVideoStream.setZoom
+    vs.roiChanged.connect(ip.setCaptureROI)
 ip.quality.connect(af.imageQualityUpdate, type=Qt.BlockingQueuedConnection)
 af.setFocus.connect(mw.VCSpinBox.setValue, type=Qt.QueuedConnection)
 tl.setLogFileName.connect(lw.setLogFileName, type=Qt.QueuedConnection)
 tl.setImageStoragePath.connect(vs.setStoragePath, type=Qt.QueuedConnection)
 tl.startCamera.connect(vs.initStream, type=Qt.QueuedConnection)
-tl.stopCamera.connect(vs.stop, type=Qt.QueuedConnection)
+tl.stopCamera.connect(vs.pause, type=Qt.QueuedConnection)
 tl.setFocusTarget.connect(mw.focusTargetComboBox.setCurrentIndex, type=Qt.QueuedConnection)
 tl.setFocusTarget.connect(ip.setFocusTarget, type=Qt.QueuedConnection)
 tl.startAutoFocus.connect(lambda: af.start(mw.VCSpinBox.value()), type=Qt.QueuedConnection)
 af.focussed.connect(tl.focussedSlot, type=Qt.QueuedConnection)
-tl.takeImage.connect(lambda: vs.takeImage(), type=Qt.QueuedConnection)
+tl.takeImage.connect(lambda highRes: vs.takeImage(highRes=highRes), type=Qt.QueuedConnection)
+tl.subscribeHighRes.connect(vs.subscribeHighRes, type=Qt.QueuedConnection)
+tl.unsubscribeHighRes.connect(vs.unsubscribeHighRes, type=Qt.QueuedConnection)
+tl.setClipUploader.connect(vs.setClipUploader, type=Qt.QueuedConnection)
 tl.recordClip.connect(lambda dur: vs.recordClip(duration=dur), type=Qt.QueuedConnection)
 tl.setFocusWithOffset.connect(lambda offset: vc.setVal(mw.VCSpinBox.value() + offset), type=Qt.QueuedConnection)
 vs.captured.connect(tl.capturedSlot, type=Qt.QueuedConnection)
+vs.frame.connect(tl.imageUpdate, type=Qt.QueuedConnection)
+htr.reading.connect(tl.temperatureUpdate, type=Qt.QueuedConnection)
+
+# Metrics time series, record is thread safe, so it is called directly from the emitting threads
+tl.setMetricsPath.connect(ts.setPath, type=Qt.QueuedConnection)
+ip.quality.connect(lambda value: ts.record('quality', value), type=Qt.DirectConnection)
+htr.reading.connect(lambda value: ts.record('temperature', value), type=Qt.DirectConnection)
+af.focussed.connect(lambda value: ts.record('focus', value), type=Qt.DirectConnection)
+vs.captured.connect(lambda: ts.record('voice_coil', vc.value), type=Qt.DirectConnection)
+
+# Notifications are spooled and mailed by the notifier thread, never in the timelapse rounds
+tl.notify.connect(nt.notify, type=Qt.QueuedConnection)
 vs.captured.connect(lambda: lw.append("main: info; voice coil={:.1f} temperature={:.1f}".format(vc.value, htr.temperature)), type=Qt.QueuedConnection)
 tl.setTemperature.connect(htr.setTemperature, type=Qt.QueuedConnection)
+st.alarm.connect(gv.throttle)
+st.alarmRemoved.connect(gv.restore)
 
 # Connect closing signals
 st.failure.connect(mw.close, type=Qt.QueuedConnection)
 tl.finished.connect(mw.close)
+mw.closed.connect(sp.stop)
 mw.closed.connect(htr.stop)
 mw.closed.connect(ip.stop)
 mw.closed.connect(vs.stop)
 mw.closed.connect(vc.stop)
 mw.closed.connect(af.stop)
 mw.closed.connect(tl.stop)
+mw.closed.connect(ts.close)
+mw.closed.connect(nt.stop)
 mw.closed.connect(lw.close)
     
 # Start the show
@@ -115,6 +176,18 @@ ip.enhancer.setBlend(0.25)
 ip.enhancer.setKsize(5)
 vc.setVal(mw.VCSpinBox.value())
 vs.setStoragePath(settings.value('temp_folder'))
+nt.start()
+
+# reload settings.ini and the experiment file on SIGHUP, e.g. kill -HUP <pid>
+def reloadConfig(signum, frame):
+    vs.reloadConfig()
+    tl.reloadConfig()
+
+signal.signal(signal.SIGHUP, reloadConfig)
+# let the interpreter run now and then, so that the signal is handled while Qt waits for events
+keepAlive = QTimer()
+keepAlive.timeout.connect(lambda: None)
+keepAlive.start(500)
 ### set max parameters from here?
 ##frame_size_str = self.settings.value('camera/frame_size')
 #mw.cropXp1Spinbox.setMaximum
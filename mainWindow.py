@@ -18,6 +18,7 @@ from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as Navigatio
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import time
+import instrumentation
 
 
 current_milli_time = lambda: int(round(time.time() * 1000))
@@ -186,6 +187,7 @@ class MainWindow(QWidget):
     def update(self, image=None):
         self.kickTimer() # Measure time delay
 ##        self.postMessage.emit(self.name + ": height " + str(image.shape[0]))
+        t = time.perf_counter_ns()
         if image is not None:  # we have a new image
             self.image = image
             if self.imageScalingFactor > 0 and self.imageScalingFactor < 1:  # Crop the image to create a zooming effect
@@ -207,6 +209,7 @@ class MainWindow(QWidget):
             qImage = QImage(image.data, width, height, width * 3, QImage.Format_RGB888)  # Convert from OpenCV to PixMap
             self.PixImage.setPixmap(QPixmap(qImage))
             self.PixImage.show()
+            instrumentation.record('display', time.perf_counter_ns() - t)
 
     @pyqtSlot(int, np.ndarray, np.ndarray)
     def updatePlot(self, figType, quadrant, x, y):
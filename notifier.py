@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+E-mail notifications, delivered in the background.
+
+notify() only writes the message to a spool folder and returns, so acquisition timing never
+depends on mail delivery. A worker thread delivers the spooled messages in order, over a single
+SMTP connection that is kept open between messages, and closed after idle_s seconds without mail.
+Messages with a key are coalesced: a new message replaces an undelivered one with the same key,
+e.g. only the latest progress is sent after the network was down. When delivery fails, the
+messages stay in the spool, also across restarts, and delivery is retried with a back-off from
+retry_min_s to retry_max_s seconds.
+SMTP settings are read from connections.ini, see config.CONNECTIONS, with smtp/ssl=false for a
+server without TLS, e.g. the local stand-in below.
+
+Usage: python3 notifier.py --sink [--port 8025]   a local SMTP stand-in, that prints the messages it receives
+       python3 notifier.py --test [--port 8025]   deliver, coalesce and spool through the stand-in
+"""
+import os
+import ssl
+import sys
+import glob
+import json
+import time
+import shutil
+import smtplib
+import argparse
+import tempfile
+import threading
+import socketserver
+from PyQt5.QtCore import QThread, QCoreApplication, Qt, pyqtSignal, pyqtSlot
+from config import Config, ConfigError, CONNECTIONS
+
+
+class Notifier(QThread):
+    postMessage = pyqtSignal(str)
+
+    def __init__(self, spool_folder, connections=None, idle_s=60, retry_min_s=30, retry_max_s=1800, timeout_s=10):
+        super().__init__()
+        self.spool_folder = spool_folder
+        os.makedirs(spool_folder, exist_ok=True)
+        self.connections = connections # read from connections.ini in run when None
+        self.idle_s = idle_s
+        self.retry_min_s, self.retry_max_s = retry_min_s, retry_max_s
+        self.timeout_s = timeout_s
+        self.server = None
+        self.last_used = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.event = threading.Event() # set when a message is spooled
+
+    @pyqtSlot(str, str, str)
+    def notify(self, recipient, message, key=''):
+        """ Spool message for recipient; with a key, it replaces an undelivered message with the same key. """
+        try:
+            with self.lock:
+                if key:
+                    for filename in glob.glob(os.path.join(self.spool_folder, '*_{}.json'.format(key))):
+                        os.remove(filename)
+                self.count += 1
+                name = '{:016d}_{:06d}_{}.json'.format(round(time.time()*1000), self.count % 1000000, key)
+                # write to a temporary file first, so the worker never reads a partial message
+                with open(os.path.join(self.spool_folder, name + '.tmp'), 'w') as f:
+                    json.dump({'to': recipient, 'message': message}, f)
+                os.replace(os.path.join(self.spool_folder, name + '.tmp'), os.path.join(self.spool_folder, name))
+            self.event.set()
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
+    def pending(self):
+        return sorted(glob.glob(os.path.join(self.spool_folder, '*.json')))
+
+    def connect(self):
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] == 250:
+                    return
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.disconnect()
+        host, port = self.connections['smtp/host'], self.connections['smtp/port']
+        if not host:
+            raise ConnectionError("no SMTP host in connections.ini")
+        if self.connections['smtp/ssl']:
+            self.server = smtplib.SMTP_SSL(host, port, timeout=self.timeout_s, context=ssl.create_default_context())
+        else:
+            self.server = smtplib.SMTP(host, port, timeout=self.timeout_s)
+        if self.connections['smtp/login']:
+            self.server.login(self.connections['smtp/login'], self.connections['smtp/password'])
+
+    def disconnect(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def deliver(self, filename):
+        try:
+            with open(filename) as f:
+                mail = json.load(f)
+        except FileNotFoundError:
+            return # replaced by a newer message with the same key
+        except ValueError:
+            self.postMessage.emit("{}: error; dropped unreadable message {}".format(self.__class__.__name__, filename))
+            os.remove(filename)
+            return
+        self.connect()
+        sender = self.connections['smtp/login'] or 'picroscope@localhost'
+        self.server.sendmail(sender, mail['to'], mail['message'].encode('utf-8'))
+        self.last_used = time.monotonic()
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        self.postMessage.emit("{}: info; notification sent to {}".format(self.__class__.__name__, mail['to']))
+
+    def run(self):
+        if self.connections is None:
+            try:
+                self.connections = Config('connections.ini', CONNECTIONS)
+            except ConfigError as err:
+                # keep spooling, nothing is delivered until the settings are fixed
+                self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+                self.connections = {key: None for key in CONNECTIONS}
+        delay_s = self.retry_min_s
+        while not self.isInterruptionRequested():
+            try:
+                for filename in self.pending():
+                    if self.isInterruptionRequested():
+                        break
+                    self.deliver(filename)
+                delay_s = self.retry_min_s
+            except Exception as err:
+                self.disconnect()
+                self.postMessage.emit("{}: error; delivery failed, {} message(s) spooled, retry in {} s, type: {}, args: {}".format(
+                    self.__class__.__name__, len(self.pending()), delay_s, type(err), err.args))
+                self.wait_s(delay_s, wake=False)
+                delay_s = min(2*delay_s, self.retry_max_s)
+                continue
+            if self.server is not None and time.monotonic() - self.last_used > self.idle_s:
+                self.disconnect()
+            self.wait_s(1)
+
+    def wait_s(self, seconds, wake=True):
+        # until stop, or with wake, a new message; new messages do not cut a retry delay short
+        t_end = time.monotonic() + seconds
+        while not self.isInterruptionRequested() and time.monotonic() < t_end:
+            if self.event.wait(0.1):
+                if wake:
+                    break
+                time.sleep(0.1)
+        self.event.clear()
+
+    @pyqtSlot()
+    def stop(self):
+        self.postMessage.emit("{}: info; stopping, {} message(s) spooled".format(self.__class__.__name__, len(self.pending())))
+        self.requestInterruption()
+        self.wait()
+        self.disconnect()
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """ Just enough SMTP for smtplib: EHLO, AUTH (anything goes), MAIL, RCPT, DATA, NOOP, RSET and QUIT. """
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.reply('220 localhost SMTP stand-in')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif verb == 'HELO' or verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'AUTH':
+                if command.upper().split()[1:] == ['PLAIN']:
+                    self.reply('334 ')
+                    self.rfile.readline()
+                elif command.upper().split()[1] == 'LOGIN':
+                    for prompt in ('334 VXNlcm5hbWU6', '334 UGFzc3dvcmQ6'):
+                        self.reply(prompt)
+                        self.rfile.readline()
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip('<>'), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip('<>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line == b'.\r\n':
+                        break
+                    data.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                self.server.received(sender, recipients, b''.join(data).decode('utf-8', errors='replace'))
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """ Local SMTP stand-in, that keeps the messages it receives, and counts the connections. """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=8025, verbose=True):
+        super().__init__(('localhost', port), SinkHandler)
+        self.messages = []
+        self.connections = 0
+        self.verbose = verbose
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    def received(self, sender, recipients, data):
+        self.messages.append({'from': sender, 'to': recipients, 'data': data})
+        if self.verbose:
+            print("{} -> {}:\n{}".format(sender, ', '.join(recipients), data))
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def self_test(port):
+    """ Spool while the server is down, coalesce progress, deliver over one connection when it is up. """
+    app = QCoreApplication(sys.argv)
+    spool_folder = tempfile.mkdtemp()
+    connections = {'smtp/host': 'localhost', 'smtp/port': port, 'smtp/ssl': False, 'smtp/login': None, 'smtp/password': None}
+    notifier = Notifier(spool_folder, connections, retry_min_s=1, retry_max_s=1)
+    notifier.postMessage.connect(print, type=Qt.DirectConnection)
+    notifier.start()
+    t = time.perf_counter()
+    notifier.notify('user@localhost', "Subject: Experiment started \n\n .")
+    for progress in range(10, 100, 10):
+        notifier.notify('user@localhost', "Subject: Progress = {}% \n\n ...".format(progress), 'progress')
+    notifier.notify('user@localhost', "Subject: Experiment finalized \n\n  Done.")
+    print("11 notifications took {:.2f} ms".format(1e3*(time.perf_counter() - t)))
+    time.sleep(1.5)
+    spooled = len(notifier.pending())
+    sink = SMTPSink(port, verbose=False)
+    sink.start()
+    t_end = time.monotonic() + 10
+    while notifier.pending() and time.monotonic() < t_end:
+        time.sleep(0.1)
+    notifier.stop()
+    sink.shutdown()
+    shutil.rmtree(spool_folder)
+    subjects = [m['data'].splitlines()[0] for m in sink.messages]
+    print("spooled while offline: {}, delivered: {} over {} connection(s)".format(spooled, subjects, sink.connections))
+    ok = spooled == 3 and subjects == ["Subject: Experiment started ", "Subject: Progress = 90% ", "Subject: Experiment finalized "] \
+         and sink.connections == 1
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local SMTP stand-in and notifier self test")
+    parser.add_argument("--sink", action="store_true", help="run the SMTP stand-in")
+    parser.add_argument("--test", action="store_true", help="test the notifier against the SMTP stand-in")
+    parser.add_argument("--port", type=int, default=8025)
+    args = parser.parse_args()
+    if args.test:
+        sys.exit(0 if self_test(args.port) else 1)
+    elif args.sink:
+        sink = SMTPSink(args.port)
+        print("SMTP stand-in listening on localhost:{}".format(args.port))
+        try:
+            sink.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.print_help()
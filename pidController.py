@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+## PID controller
+# Output clamping with anti-windup, a low-pass filtered derivative on the measurement, and a
+# control period that is short while tracking a setpoint change and long at steady state.
+# Plain python, so that it can be benchmarked against simulator.ThermalModel, see heaterBenchmark.py
+#
+
+
+class PIDController:
+    """
+    u = kP*e + kI*integral(e) + kD*d(-y)/dt, clamped to [out_min, out_max].
+    The integral is frozen while the output saturates in the direction of the error (conditional
+    integration), so it does not wind up during a long heat-up. The derivative acts on the
+    measurement, so a setpoint change gives no kick, and is filtered with time constant tau_d,
+    to suppress the sensor quantization.
+    The period is fast_period until the error stayed within band for settle_count updates,
+    then slow_period, until the error leaves the band again.
+    """
+    def __init__(self, kP=1.0, kI=0.1, kD=0.5, out_min=0.0, out_max=100.0, tau_d=5.0,
+                 fast_period=0.5, slow_period=2.0, band=0.25, settle_count=10):
+        self.kP, self.kI, self.kD = kP, kI, kD
+        self.out_min, self.out_max = out_min, out_max
+        self.tau_d = tau_d  # [s]
+        self.fast_period, self.slow_period = fast_period, slow_period  # [s]
+        self.band = band
+        self.settle_count = settle_count
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0  # integral term, including kI
+        self.derivative = 0.0  # filtered derivative of the measurement
+        self.prev_measurement = None
+        self.error = None
+        self.settled = 0  # number of successive updates within band
+
+    def update(self, setpoint, measurement, dt):
+        """ Return the new output, dt [s] is the time since the previous update. """
+        self.error = setpoint - measurement
+        if self.prev_measurement is not None and dt > 0:
+            alpha = self.tau_d/(self.tau_d + dt)
+            self.derivative = alpha*self.derivative + (1 - alpha)*(measurement - self.prev_measurement)/dt
+        self.prev_measurement = measurement
+        self.settled = self.settled + 1 if abs(self.error) <= self.band else 0
+
+        unclamped = self.kP*self.error + self.integral - self.kD*self.derivative
+        output = min(max(unclamped, self.out_min), self.out_max)
+        # anti-windup, only integrate when not saturated, or when the error drives out of saturation
+        if output == unclamped or (unclamped > self.out_max) != (self.error > 0):
+            self.integral = min(max(self.integral + self.kI*self.error*dt, self.out_min), self.out_max)
+        return output
+
+    def period(self):
+        """ Time [s] until the next update. """
+        return self.slow_period if self.settled >= self.settle_count else self.fast_period
@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Image processing in a worker process.
+
+In a single process the GIL serializes the Python parts of the capture loop, the image processor,
+the grid segmentation and the GUI. ProcessImageProcessor has the signals and slots of
+ImageProcessor, but enhancement, segmentation and metrics run in a worker process.
+Frames go through a ring of slots in shared memory, every slot has a header with the sequence
+number and shape of its frame, so that a reader detects a slot that was overwritten. The worker
+writes the processed frame back into the same slot, and returns the sequence number and image
+quality over a queue. Settings of the processor and its enhancer are sent along with a frame when
+they changed.
+The worker process is forked, so it has to be started before any other thread, see new_worker:
+main.py and headless.py start it before pigpio and Qt start theirs, and hand it to the processor.
+
+Enable with processing/worker_process=true in settings.ini.
+
+The benchmark compares the threaded path with the worker process, while a Python thread stands in
+for the capture loop and the GUI. Reported are the processing throughput and latency, and the
+iterations per second left for the Python thread.
+
+Usage: python3 processWorker.py [--size 640x480] [--count 50] [--depth 2] [--focus_target 1] [--output worker_bench.json]
+"""
+import os
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from PyQt5.QtCore import QSettings
+from imageProcessor import ImageProcessor
+
+HEADER = 4 # int64 per slot: sequence number, height, width, channels
+
+
+class FrameRing:
+    """
+    Slots of slot_bytes bytes in shared memory, frame seq goes into slot seq % slots.
+    Creates the shared memory, or attaches to it by name.
+    """
+    def __init__(self, slots=4, slot_bytes=640*480*3, name=None):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=slots*(8*HEADER + slot_bytes))
+        self.name = self.shm.name
+        self.headers = np.ndarray((slots, HEADER), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((slots, slot_bytes), dtype=np.uint8, buffer=self.shm.buf, offset=8*HEADER*slots)
+        if name is None:
+            self.headers[:, 0] = -1
+
+    def write(self, seq, image):
+        if image.nbytes > self.slot_bytes:
+            raise ValueError("frame of {} bytes does not fit in a slot of {} bytes".format(image.nbytes, self.slot_bytes))
+        slot = seq % self.slots
+        height, width = image.shape[:2]
+        self.headers[slot, 0] = -1 # invalid while writing
+        self.data[slot, :image.nbytes] = np.asarray(image).reshape(-1)
+        self.headers[slot, 1:] = (height, width, image.shape[2] if image.ndim > 2 else 1)
+        self.headers[slot, 0] = seq
+
+    def read(self, seq):
+        """ View on frame seq, None if its slot holds another frame. """
+        slot = seq % self.slots
+        slot_seq, height, width, channels = self.headers[slot]
+        if slot_seq != seq:
+            return None
+        image = self.data[slot, :height*width*channels]
+        return image.reshape((height, width, channels) if channels > 1 else (height, width))
+
+    def close(self, unlink=False):
+        # views on the buffer have to go before it can be closed
+        self.headers = self.data = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def processor_state(processor):
+    """ Settings of an ImageProcessor and its enhancer, that the worker applies to its own processor. """
+    enhancer = processor.enhancer
+    return {'focusTarget': processor.focusTarget,
+            'captureROI': processor.captureROI,
+            'drawOverlay': processor.drawOverlay,
+            'decimation': processor.decimation,
+            'segmentDecimation': processor.segmentDecimation,
+            'laplacianKsize': processor.laplacianKsize,
+            'rotAngle': enhancer.rotAngle,
+            'gamma': enhancer.gamma,
+            'clipLimit': enhancer.clahe.getClipLimit() if enhancer.clahe is not None else 0.0,
+            'ksize': enhancer.ksize,
+            'alpha': enhancer.alpha,
+            'cropRect': list(enhancer.cropRect)}
+
+
+def apply_state(processor, state):
+    if state['focusTarget'] != processor.focusTarget:
+        processor.gridROIs = None # as in ImageProcessor.setFocusTarget
+    processor.setCaptureROI(state['captureROI'])
+    for name in ('focusTarget', 'drawOverlay', 'decimation', 'segmentDecimation', 'laplacianKsize'):
+        setattr(processor, name, state[name])
+    enhancer = processor.enhancer
+    enhancer.rotAngle = state['rotAngle']
+    enhancer.gamma = state['gamma']
+    enhancer.setClaheClipLimit(state['clipLimit'])
+    enhancer.ksize = state['ksize']
+    enhancer.alpha = state['alpha']
+    enhancer.cropRect = state['cropRect']
+
+
+def work(name, slots, slot_bytes, tasks, results):
+    """ Worker process: process the frames of the ring, until a None task arrives. """
+    ring = FrameRing(slots, slot_bytes, name)
+    processor = ImageProcessor()
+    messages = []
+    processor.postMessage.connect(messages.append)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, frameCount, state = task
+            quality = None
+            try:
+                if state is not None:
+                    apply_state(processor, state)
+                processor.frameCount = frameCount
+                image = ring.read(seq)
+                if image is None:
+                    messages.append("{}: error; frame {} was overwritten before it was processed".format(ImageProcessor.__name__, seq))
+                else:
+                    image, quality = processor.process(image)
+                    ring.write(seq, image)
+            except Exception as err:
+                messages.append("{}: error; type: {}, args: {}".format(ImageProcessor.__name__, type(err), err.args))
+            results.put((seq, quality, messages[:]))
+            messages.clear()
+    finally:
+        ring.close()
+
+
+class FrameWorker:
+    """
+    Parent side of the worker process: submit frames, and collect the results in order.
+    """
+    def __init__(self, slots=4, slot_bytes=640*480*3, timeout=10.0):
+        # forked rather than spawned, since spawning re-runs the main script
+        context = multiprocessing.get_context('fork')
+        self.ring = FrameRing(slots, slot_bytes)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.timeout = timeout
+        self.seq = 0
+        self.state = None
+        self.process = context.Process(target=work, args=(self.ring.name, slots, slot_bytes, self.tasks, self.results), daemon=True)
+        self.process.start()
+
+    def submit(self, image, frameCount=0, state=None):
+        """ Pass a frame to the worker, return its sequence number. """
+        self.seq += 1
+        self.ring.write(self.seq, image)
+        self.tasks.put((self.seq, frameCount, state if state != self.state else None))
+        self.state = state
+        return self.seq
+
+    def result(self, seq):
+        """ Processed frame (a copy), image quality and messages of frame seq; older results are skipped. """
+        while True:
+            result_seq, quality, messages = self.results.get(timeout=self.timeout)
+            if result_seq == seq:
+                break
+        image = self.ring.read(seq) if quality is not None else None
+        return (None if image is None else image.copy()), quality, messages
+
+    def stop(self):
+        if self.process.is_alive():
+            self.tasks.put(None)
+            self.process.join(self.timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.ring.close(unlink=True)
+
+
+def new_worker(slots=4):
+    """ FrameWorker with slots for frames of frame_size in settings.ini; call it before any thread is started. """
+    settings = QSettings("settings.ini", QSettings.IniFormat)
+    width, height = [int(v) for v in settings.value('frame_size', '640x480').split('x')]
+    return FrameWorker(slots, width*height*3)
+
+
+class ProcessImageProcessor(ImageProcessor):
+    """
+    ImageProcessor that hands the processing to a worker process, started with new_worker. The
+    thread only submits the frame and waits for the result, without holding the GIL.
+    """
+    def __init__(self, worker):
+        super().__init__()
+        self.worker = worker
+
+    def process(self, image):
+        seq = self.worker.submit(image, self.frameCount, processor_state(self))
+        image, quality, messages = self.worker.result(seq)
+        for message in messages:
+            self.postMessage.emit(message)
+        if image is None:
+            raise RuntimeError("frame {} not processed".format(seq))
+        return image, quality
+
+    def stop(self):
+        super().stop()
+        self.worker.stop()
+
+
+def python_load(stop, counter):
+    # stands in for the Python parts of the capture loop and the GUI
+    while not stop.is_set():
+        sum(range(1000))
+        counter[0] += 1
+
+
+def run_pipeline(submit, result, frames, depth):
+    """ Keep depth frames in flight, return the latency of every frame [s] and the total duration [s]. """
+    in_flight = []
+    latencies = []
+    t_start = time.perf_counter()
+    for frame in frames:
+        in_flight.append((submit(frame), time.perf_counter()))
+        if len(in_flight) >= depth:
+            handle, t = in_flight.pop(0)
+            result(handle)
+            latencies.append(time.perf_counter() - t)
+    for handle, t in in_flight:
+        result(handle)
+        latencies.append(time.perf_counter() - t)
+    return latencies, time.perf_counter() - t_start
+
+
+def benchmark(name, submit, result, frames, depth):
+    stop, counter = threading.Event(), [0]
+    load = threading.Thread(target=python_load, args=(stop, counter))
+    load.start()
+    latencies, duration = run_pipeline(submit, result, frames, depth)
+    stop.set()
+    load.join()
+    stats = latency_stats(latencies)
+    stats['throughput_fps'] = round(len(frames)/duration, 2)
+    stats['python_load_per_s'] = round(counter[0]/duration, 1)
+    print("{:>7}: p50={:8.2f} ms, p95={:8.2f} ms, {:7.1f} fps, python load {:9.1f} it/s".format(
+        name, stats['p50_ms'], stats['p95_ms'], stats['throughput_fps'], stats['python_load_per_s']))
+    return stats
+
+
+if __name__ == "__main__":
+    from benchmark import synthetic_frames, latency_stats, new_enhancer, frame_size_from_string, git_commit
+    from concurrent.futures import ThreadPoolExecutor
+    parser = argparse.ArgumentParser(description="Benchmark the worker process against the threaded image processor")
+    parser.add_argument("--size", default="640x480", help="frame size")
+    parser.add_argument("--count", type=int, default=50, help="number of frames")
+    parser.add_argument("--depth", type=int, default=2, help="number of frames in flight")
+    parser.add_argument("--focus_target", type=int, default=1)
+    parser.add_argument("--output", default="worker_bench.json", help="JSON results file")
+    args = parser.parse_args()
+
+    settings = QSettings("settings.ini", QSettings.IniFormat)
+    frame_size = frame_size_from_string(args.size)
+    frames = synthetic_frames(frame_size, args.count)
+    report = {'commit': git_commit(), 'time': round(time.time()), 'cpus': os.cpu_count(), 'args': vars(args), 'results': {}}
+
+    processor = ImageProcessor()
+    processor.enhancer = new_enhancer(settings)
+    processor.setFocusTarget(args.focus_target)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        report['results']['thread'] = benchmark('thread', lambda f: executor.submit(processor.process, f.copy()),
+                                                lambda future: future.result(), frames, args.depth)
+
+    worker = FrameWorker(max(args.depth + 1, 2), frame_size[0]*frame_size[1]*3)
+    try:
+        state = processor_state(processor)
+        report['results']['process'] = benchmark('process', lambda f: worker.submit(f, 0, state),
+                                                 worker.result, frames, args.depth)
+    finally:
+        worker.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(args.output))
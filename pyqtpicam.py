@@ -11,6 +11,14 @@ Note that there are different image sizes involved:
 1. captureFrameSize: image capture frame size, obtained from the sensor mode
 2. videoFrameSize: video capture frame size
 3. frameSize: size of frames that get emitted to the processing chain.
+With camera/hardware_roi, the crop rectangle (in capture frame coordinates) sets the camera zoom,
+so that the GPU crops and resizes, and only the region of interest is transferred. The emitted
+frames then fit within frameSize, with the aspect ratio of the region of interest.
+Note that the zoom also applies to snapshots and video clips.
+4. highResFrameSize: size of the on-demand stream (splitter port 3), that runs while a stage
+subscribes to it, e.g. the timelapse for its snapshots. While a stage subscribes, the metric
+stream is at metricFrameSize (camera/metric_frame_size) from the next initStream on, as the detail
+comes from the high resolution stream. Stills are only taken from it when the caller asks.
 """
 import os
 import cv2
@@ -19,12 +27,16 @@ import warnings
 import traceback
 import numpy as np
 from fps import FPS
+import instrumentation
 from picamera import PiCamera
 from picamera.array import PiRGBArray, PiYUVArray, PiArrayOutput
 from PyQt5.QtCore import QThread, QSettings, pyqtSlot, QTimer, QEventLoop, pyqtSignal
 from wait import wait_signal, wait_ms
 from io import BytesIO
-from subprocess import run, check_output
+from h264Mux import H264Output, SegmentedH264Output
+from clipStorage import SegmentUploader
+from yuvFrame import YUVFrame, color
+from config import Config, CAMERA
 
 
 def raw_frame_size(frame_size, splitter=False):
@@ -60,6 +72,11 @@ def frame_size_from_sensor_mode(sensorMode):
         raise ValueError
     return frameSize
 
+def fit_frame_size(width, height, frame_size):
+    # largest even size with the aspect ratio of width x height, that fits in frame_size
+    scale = min(frame_size[0]/width, frame_size[1]/height)
+    return (max(round(width*scale/2)*2, 2), max(round(height*scale/2)*2, 2))
+
 def frame_size_from_string(frameSizeStr):
     (width, height) = frameSizeStr.split('x')
     return (int(width), int(height))
@@ -71,7 +88,8 @@ class PiYArray(PiArrayOutput):
     """
     def __init__(self, camera, size=None):
         super(PiYArray, self).__init__(camera, size)
-        self.fwidth, self.fheight = raw_frame_size(self.size or self.camera.resolution)
+        self.width, self.height = self.size or self.camera.resolution
+        self.fwidth, self.fheight = raw_frame_size((self.width, self.height))
         self.y_len = self.fwidth * self.fheight
 ##        uv_len = (fwidth // 2) * (fheight // 2)
 ##        if len(data) != (y_len + 2 * uv_len):
@@ -81,7 +99,65 @@ class PiYArray(PiArrayOutput):
     def flush(self):
         super(PiYArray, self).flush()
         a = np.frombuffer(self.getvalue()[:self.y_len], dtype=np.uint8)
-        self.array = a[:self.y_len].reshape((self.fheight, self.fwidth))
+        # without the padding of the rows and columns, as YUVFrame
+        self.array = a[:self.y_len].reshape((self.fheight, self.fwidth))[:self.height, :self.width]
+
+
+class PiYUVFrameArray(PiArrayOutput):
+    """
+    Produces a YUVFrame from a YUV capture: the Y plane without copy, and BGR only on demand.
+    """
+    def __init__(self, camera, size=None):
+        super(PiYUVFrameArray, self).__init__(camera, size)
+        self.width, self.height = self.size or self.camera.resolution
+        self.fwidth, self.fheight = raw_frame_size((self.width, self.height))
+
+    def flush(self):
+        super(PiYUVFrameArray, self).flush()
+        self.array = YUVFrame(self.getvalue(), self.width, self.height, self.fwidth, self.fheight)
+
+
+class HighResStream(QThread):
+    """
+    Larger frames from splitter port 3, next to the metric stream on port 1.
+    The port is only in use while the thread runs, the latest frame is kept in image.
+    """
+    frame = pyqtSignal(np.ndarray)
+    postMessage = pyqtSignal(str)
+    image = None
+
+    def __init__(self, camera, monochrome):
+        super().__init__()
+        self.camera = camera
+        self.monochrome = monochrome
+        self.size = None
+
+    def run(self):
+        captureStream = None
+        try:
+            if self.monochrome:
+                rawCapture = PiYArray(self.camera, size=self.size)
+            else:
+                rawCapture = PiYUVFrameArray(self.camera, size=self.size)
+            captureStream = self.camera.capture_continuous(rawCapture, 'yuv', use_video_port=True, splitter_port=3, resize=self.size)
+            for f in captureStream:
+                if self.isInterruptionRequested():
+                    break
+                rawCapture.seek(0)
+                self.image = f.array
+                self.frame.emit(self.image)
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+        finally:
+            self.image = None
+            if captureStream is not None:
+                captureStream.close() # releases splitter port 3
+
+    @pyqtSlot()
+    def stop(self):
+        if self.isRunning():
+            self.requestInterruption()
+            self.wait()
 
 
 ## PiVideoStream class streams camera images to a numpy array
@@ -96,14 +172,20 @@ class PiVideoStream(QThread):
     finished = pyqtSignal()
     postMessage = pyqtSignal(str)
     frame = pyqtSignal(np.ndarray)
+    highResFrame = pyqtSignal(np.ndarray) # only while subscribed, see subscribeHighRes
     progress = pyqtSignal(int)       
     captured = pyqtSignal()
+    roiChanged = pyqtSignal(tuple) # (x, y, w, h) of the emitted frames, in capture frame coordinates
     
-    camera = PiCamera()
+    camera = None
     videoStream = BytesIO()
     
     storagePath = None
     cropRect = [0] * 4
+    clipUpload = None
+    segmentUploader = None
+    session = None # locked exposure and white balance of the first calibration
+    paused = False
 
     ## @param ins is the number of instances created. This may not exceed 1.
     ins = 0
@@ -122,85 +204,155 @@ class PiVideoStream(QThread):
             self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
         else:
             warnings.filterwarnings('default', category=DeprecationWarning)
-            self.settings = QSettings("settings.ini", QSettings.IniFormat)
+            self.camera = PiCamera()
+            self.config = Config("settings.ini", CAMERA)
+            self.config.postMessage.connect(self.postMessage)
+            self.config.changed.connect(self.settingsChanged)
             self.loadSettings()
+            # apply crop changes after the spinboxes came to rest
+            self.roiTimer = QTimer(self)
+            self.roiTimer.setSingleShot(True)
+            self.roiTimer.timeout.connect(self.applyROI)
+            # on-demand high resolution stream, and the stages that subscribed to it
+            self.highRes = HighResStream(self.camera, self.monochrome)
+            self.highRes.frame.connect(self.highResFrame)
+            self.highRes.postMessage.connect(self.postMessage)
+            self.subscribers = set()
 ##            self.initStream()            
             
     def loadSettings(self):
-        self.postMessage.emit("{}: info; loading camera settings from {}".format(self.__class__.__name__, self.settings.fileName()))
+        self.postMessage.emit("{}: info; loading camera settings from {}".format(self.__class__.__name__, self.config.file_name))
 
         # load
-        self.monochrome = self.settings.value('camera/monochrome', False, type=bool)
-        self.sensorMode = int(self.settings.value('camera/sensor_mode'))
-        self.frameRate = int(self.settings.value('camera/frame_rate'))
+        self.monochrome = self.config['camera/monochrome']
+        self.sensorMode = self.config['camera/sensor_mode']
+        self.frameRate = self.config['camera/frame_rate']
+        self.pauseFrameRate = self.config['camera/pause_frame_rate']
 
         # set frame sizes
-        self.frameSize = frame_size_from_string(self.settings.value('frame_size'))
+        self.frameSize = self.config['frame_size']
         self.captureFrameSize = frame_size_from_sensor_mode(self.sensorMode)
-        self.videoFrameSize = frame_size_from_string(self.settings.value('camera/video_frame_size'))
+        self.videoFrameSize = self.config['camera/video_frame_size']
+        self.highResFrameSize = self.config['camera/high_res_frame_size']
+        self.metricFrameSize = self.config['camera/metric_frame_size'] or self.frameSize
+
+        # segmented clip recording, see clipStorage.py
+        self.segmentFolder = self.config['storage/segment_folder']
+        self.storageBudget = int(self.config['storage/tmpfs_budget_mb']*2**20)
+        self.segmentSize = min(int(self.config['storage/segment_size_mb']*2**20), self.storageBudget//2)
+
+        self.hardwareROI = self.config['camera/hardware_roi']
+        self.streamSize = self.frameSize
+        self.highResStreamSize = self.highResFrameSize
 
         if not self.monochrome:
             self.frameSize = self.frameSize + (3,)
 
+    def sessionKey(self):
+        # camera settings that the calibration depends on
+        return (self.sensorMode, self.captureFrameSize, self.frameRate, self.config['camera/effect'],
+                self.config['camera/iso'], self.config['camera/video_denoise'])
+
+    @pyqtSlot()
+    def reloadConfig(self):
+        """ Read settings.ini again, e.g. on SIGHUP, see main.py. """
+        self.config.reload()
+
+    @pyqtSlot(list)
+    def settingsChanged(self, keys):
+        # after config.reload(), loadSettings resets the stream sizes, so apply the zoom again;
+        # a running stream restarts with the new settings, with a new calibration if needed
+        self.loadSettings()
+        if self.isRunning():
+            self.initStream()
+        elif self.session is not None:
+            self.setZoom()
+
     @pyqtSlot()
     def initStream(self):
+        """
+        Start the stream. The first time, the camera is set up and the exposure and white balance
+        are locked after the automatic gain control settled. These values are kept in a session,
+        and as long as the camera settings do not change, the camera keeps them, so that
+        the next call (e.g. resuming from pause) starts the stream without calibration.
+        """
         if self.isRunning():
             self.requestInterruption()
             wait_signal(self.finished, 10000)            
-        # Set camera parameters
-        self.camera.exposure_mode = 'backlight' # 'auto'
-        self.camera.awb_mode = 'flash' # 'auto'
-        self.camera.meter_mode = 'backlit' # 'average'
-        self.camera.sensor_mode = self.sensorMode
-        self.camera.resolution = self.captureFrameSize
-        self.camera.framerate = self.frameRate
-        self.camera.image_effect = self.settings.value('camera/effect')
-        self.camera.iso = int(self.settings.value('camera/iso')) # should force unity analog gain       
-        self.camera.video_denoise = self.settings.value('camera/video_denoise', False, type=bool)
-
-        # Wait for the automatic gain control to settle
-        wait_ms(3000)
-
-        # Now fix the values
-        self.camera.shutter_speed = self.camera.exposure_speed
-        self.camera.exposure_mode = 'off'
-        g = self.camera.awb_gains
-        self.camera.awb_mode = 'off'
-        self.camera.awb_gains = g        
+        max_age = self.config['camera/session_max_age'] # [s], 0 is forever
+        if self.session is None or self.session['key'] != self.sessionKey() or \
+           (max_age > 0 and time.monotonic() - self.session['time'] > max_age):
+            # Set camera parameters
+            self.camera.exposure_mode = 'backlight' # 'auto'
+            self.camera.awb_mode = 'flash' # 'auto'
+            self.camera.meter_mode = 'backlit' # 'average'
+            self.camera.sensor_mode = self.sensorMode
+            self.camera.resolution = self.captureFrameSize
+            self.camera.framerate = self.frameRate
+            self.camera.image_effect = self.config['camera/effect']
+            self.camera.iso = self.config['camera/iso'] # should force unity analog gain       
+            self.camera.video_denoise = self.config['camera/video_denoise']
 
-##            # Setup video port, GPU resizes frames, and compresses to mjpeg stream
-##            self.camera.start_recording(self.videoStream, format='mjpeg', splitter_port=1, resize=self.frameSize)
+            # Wait for the automatic gain control to settle
+            wait_ms(3000)
 
-        # Setup capture from video port 1
-        if self.monochrome:
-            self.rawCapture = PiYArray(self.camera, size=self.frameSize)
-            self.captureStream = self.camera.capture_continuous(self.rawCapture, 'yuv', use_video_port=True, splitter_port=1, resize=self.frameSize)
+            # Now fix the values
+            self.camera.shutter_speed = self.camera.exposure_speed
+            self.camera.exposure_mode = 'off'
+            g = self.camera.awb_gains
+            self.camera.awb_mode = 'off'
+            self.camera.awb_gains = g        
+            self.session = {'key': self.sessionKey(), 'time': time.monotonic(),
+                            'shutter_speed': self.camera.shutter_speed, 'awb_gains': g}
+            self.postMessage.emit("{}: info; camera calibrated, shutter speed = {} us, awb gains = ({:.2f}, {:.2f})".format(
+                __class__.__name__, self.session['shutter_speed'], float(g[0]), float(g[1])))
         else:
-            self.rawCapture = PiRGBArray(self.camera, size=self.frameSize)
-            self.captureStream = self.camera.capture_continuous(self.rawCapture, 'bgr', use_video_port=True, splitter_port=1, resize=self.frameSize)
+            # Restore the frame rate of pause, and the locked values, in case they were changed
+            self.camera.framerate = self.frameRate
+            self.camera.shutter_speed = self.session['shutter_speed']
+            self.camera.awb_gains = self.session['awb_gains']
+        self.paused = False
+
         # init crop rectangle
         if self.cropRect[2] == 0:
             self.cropRect[2] = self.camera.resolution[1]
         if self.cropRect[3] == 0:
             self.cropRect[3] = self.camera.resolution[0]
+        self.setZoom()
+
+##            # Setup video port, GPU resizes frames, and compresses to mjpeg stream
+##            self.camera.start_recording(self.videoStream, format='mjpeg', splitter_port=1, resize=self.frameSize)
+
+        # Setup capture from video port 1
+        # in color mode, capture YUV as well, processing only needs the Y plane, see yuvFrame.py
+        if self.monochrome:
+            self.rawCapture = PiYArray(self.camera, size=self.streamSize)
+        else:
+            self.rawCapture = PiYUVFrameArray(self.camera, size=self.streamSize)
+        self.captureStream = self.camera.capture_continuous(self.rawCapture, 'yuv', use_video_port=True, splitter_port=1, resize=self.streamSize)
             
         # start the thread
         self.start(QThread.HighPriority)
         msg = "{}: info; video stream initialized with frame size = {} and {:d} channels".format(\
             __class__.__name__, str(self.camera.resolution), 1 if self.monochrome else 3)
         self.postMessage.emit(msg)
+        if self.subscribers:
+            self.startHighRes()
 
     @pyqtSlot()
     def run(self):
         try:
             self.fps = FPS().start()
+            t = time.perf_counter_ns()
             for f in self.captureStream:
                 if self.isInterruptionRequested():
                     break
                 self.rawCapture.seek(0) 
                 img = f.array # grab the frame from the stream
+                instrumentation.record('capture', time.perf_counter_ns() - t)
                 self.frame.emit(img)#cv2.resize(img, self.frameSize[:2]))
                 self.fps.update()                
+                t = time.perf_counter_ns()
 
 ##                # Grab jpeg from an mpeg video stream
 ##                self.videoStream.seek(0)
@@ -229,7 +381,15 @@ class PiVideoStream(QThread):
     @pyqtSlot()
     def stop(self):
         self.postMessage.emit("{}: info; stopping".format(__class__.__name__))
+        self.stopStream()
+        if self.segmentUploader is not None:
+            # upload the segments that are still queued, e.g. of the last clip before a shutdown
+            self.segmentUploader.stop()
+            self.segmentUploader = None
+
+    def stopStream(self):
         try:
+            self.highRes.stop()
             if self.isRunning():
                 self.requestInterruption()
                 wait_signal(self.finished, 10000)
@@ -238,9 +398,83 @@ class PiVideoStream(QThread):
             print(msg)
         finally:
             self.quit() # Note that thread quit is required, otherwise strange things happen.
-       
+
+    @pyqtSlot()
+    def pause(self):
+        """
+        Stop the stream and release the capture port, but keep the camera and its calibration,
+        so that initStream resumes without waiting for the gain to settle. The sensor keeps running
+        while paused, at pause_frame_rate, to save power between rounds.
+        """
+        self.stopStream()
+        try:
+            self.captureStream.close() # closes the encoder of splitter port 1
+            self.camera.framerate = self.pauseFrameRate
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+        self.paused = True
+        self.postMessage.emit("{}: info; paused".format(__class__.__name__))
+
+    def roi(self):
+        """ Region of interest (x, y, w, h) in capture frame coordinates, the full frame without hardware ROI. """
+        width, height = self.camera.resolution
+        if not self.hardwareROI:
+            return (0, 0, width, height)
+        y1, x1, y2, x2 = self.cropRect
+        x1, y1 = min(max(x1, 0), width - 2), min(max(y1, 0), height - 2)
+        x2, y2 = min(max(x2, x1 + 2), width), min(max(y2, y1 + 2), height)
+        return (x1, y1, x2 - x1, y2 - y1)
+
+    def setZoom(self):
+        # zoom to the region of interest, and let the GPU resize it to fit in frameSize
+        x, y, w, h = self.roi()
+        width, height = self.camera.resolution
+        self.camera.zoom = (x/width, y/height, w/width, h/height)
+        # while a stage subscribes to the high resolution stream, the metric stream can be smaller
+        frameSize = self.metricFrameSize if self.subscribers else self.frameSize[:2]
+        if self.hardwareROI:
+            self.streamSize = fit_frame_size(w, h, frameSize)
+            self.highResStreamSize = fit_frame_size(w, h, self.highResFrameSize)
+        else:
+            # the full frame, at the configured sizes
+            self.streamSize = frameSize
+            self.highResStreamSize = self.highResFrameSize
+        self.roiChanged.emit((x, y, w, h))
+
+    @pyqtSlot()
+    def applyROI(self):
+        # the stream size changes with the region of interest, so restart a running stream
+        if self.isRunning():
+            self.initStream()
+
     @pyqtSlot(str)
-    def takeImage(self, filename_prefix=None):
+    def subscribeHighRes(self, stage):
+        """ Run the high resolution stream for stage, with the stream, from now on or from the next initStream. """
+        self.subscribers.add(stage)
+        if self.isRunning():
+            self.startHighRes()
+
+    def startHighRes(self):
+        if not self.highRes.isRunning():
+            self.highRes.size = self.highResStreamSize
+            self.highRes.start()
+            self.postMessage.emit("{}: info; high resolution stream started with frame size = {} for {}".format(
+                __class__.__name__, self.highResStreamSize, ', '.join(sorted(self.subscribers))))
+
+    @pyqtSlot(str)
+    def unsubscribeHighRes(self, stage):
+        """ Stop the high resolution stream when the last stage unsubscribed. """
+        self.subscribers.discard(stage)
+        if not self.subscribers and self.highRes.isRunning():
+            self.highRes.stop()
+            self.postMessage.emit("{}: info; high resolution stream stopped".format(__class__.__name__))
+
+    @pyqtSlot(str, bool)
+    def takeImage(self, filename_prefix=None, highRes=False):
+        """
+        Save a still, captured from the still port at the full capture frame size, or with highRes,
+        the latest frame of the high resolution stream when a stage keeps it running.
+        """
         if filename_prefix is not None:
             (head, tail) = os.path.split(filename_prefix)
             if not os.path.exists(head):
@@ -252,12 +486,20 @@ class PiVideoStream(QThread):
             if self.storagePath is not None:
                 filename = os.path.sep.join([self.storagePath, filename])
         try:
-            self.camera.capture(filename, use_video_port=False, splitter_port=0, format='png')
+            image = None
+            if highRes and self.highRes.isRunning():
+                if self.highRes.image is None:
+                    wait_signal(self.highResFrame, 2000) # the stream just started
+                image = self.highRes.image
+            if image is not None:
+                cv2.imwrite(filename, color(image))
+            else:
+                self.camera.capture(filename, use_video_port=False, splitter_port=0, format='png')
         except Exception as err:
             self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
 
         self.captured.emit()
-        self.postMessage.emit("{}: info; image written to {}".format(__class__.__name__, filename))
+        self.postMessage.emit("{}: info; image written to {}, region of interest = {}".format(__class__.__name__, filename, self.roi()))
 
     @pyqtSlot(str, int)
     def recordClip(self, filename_prefix=None, duration=10):
@@ -265,10 +507,11 @@ class PiVideoStream(QThread):
         Captures a videoclip of duration at resolution videoFrameSize.
         The GPU resizes the captured video to the intended resolution.
         Note that while it seems possble to change the sensormode, reverting to the original mode fails when capturing an image.
-        In many cases, the intended framerate is not achieved. For that reason, ffprobe counts
-        the total number of frames that were actually taken.        
-        Next, the h264 video file is boxed using MP4box.
-        For some reason, changing the framerate with MP4Box did not work out.        
+        In many cases, the intended framerate is not achieved. For that reason, H264Output counts
+        the frames and records their arrival times while recording, and muxes them into an MP4 file
+        with the real frame timing. The frame count is added to the file name.
+        When a clip uploader is set, the clip is recorded in segments that are uploaded while
+        recording continues, within the storage budget, see clipStorage.py.
         """
         if filename_prefix is not None:
             (head, tail) = os.path.split(filename_prefix)
@@ -285,18 +528,29 @@ class PiVideoStream(QThread):
         self.postMessage.emit("{}: info; starting recording for {} s".format(__class__.__name__, duration))
         
         try:
-            # GPU resizes frames, and compresses to h264 stream
-            self.camera.start_recording(filename + '.h264', format='h264', splitter_port=2, resize=self.videoFrameSize, sps_timing=True)
+            # GPU resizes frames, and compresses to h264 stream, which is muxed into an MP4 file while recording
+            if self.clipUpload is None:
+                output = H264Output(filename + '.mp4', self.videoFrameSize)
+                self.camera.start_recording(output, format='h264', splitter_port=2, resize=self.videoFrameSize, sps_timing=True)
+            else:
+                if self.segmentUploader is None:
+                    self.segmentUploader = SegmentUploader(self.storageBudget, log=self.postMessage.emit)
+                if not os.path.exists(self.segmentFolder):
+                    os.makedirs(self.segmentFolder)
+                output = SegmentedH264Output(os.path.sep.join([self.segmentFolder, os.path.basename(filename)]), self.videoFrameSize,
+                                             self.segmentSize, self.segmentUploader, self.clipUpload)
+                # a keyframe every second, so that segments can be cut at about the intended size
+                self.camera.start_recording(output, format='h264', splitter_port=2, resize=self.videoFrameSize, sps_timing=True,
+                                            intra_period=self.frameRate)
             wait_ms(duration*1000)
             self.camera.stop_recording(splitter_port=2)
-            
-            # Wrap an MP4 box around the video
-            nr_of_frames = check_output(["ffprobe", "-v", "error", "-count_frames", "-select_streams", "v:0", "-show_entries", "stream=nb_read_frames", "-of", "default=nokey=1:noprint_wrappers=1", filename + '.h264'])
-            real_fps = duration/float(nr_of_frames)
-            self.postMessage.emit("{}: info; video clip captured with real framerate: {} fps".format(__class__.__name__, real_fps))
-##            run(["MP4Box", "-fps", str(self.frameRate), "-add", filename + '.h264:fps=' + str(real_fps), "-new", filename + '.mp4'])
-            run(["MP4Box", "-fps", str(self.frameRate), "-add", filename + ".h264", "-new", filename + "_{}fr.mp4".format(int(nr_of_frames))])
-            run(["rm", filename + '.h264'])
+            output.close()
+            if self.clipUpload is None:
+                os.rename(filename + '.mp4', filename + "_{}fr.mp4".format(output.frames))
+            else:
+                self.postMessage.emit("{}: info; video clip recorded in {:d} segments, {:d} frames, {:d} frames dropped".format(
+                    __class__.__name__, output.segments, output.frames, output.dropped))
+            self.postMessage.emit("{}: info; video clip captured with real framerate: {:.2f} fps".format(__class__.__name__, output.fps()))
         except Exception as err:
             self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))            
             
@@ -306,18 +560,25 @@ class PiVideoStream(QThread):
     @pyqtSlot(str)
     def setStoragePath(self, path):
         self.storagePath = path
+
+    @pyqtSlot(object)
+    def setClipUploader(self, upload):
+        # upload(filename) function for clip segments, None records clips as a single file
+        self.clipUpload = upload
         
     @pyqtSlot(int)
     def setCropXp1(self, val):
         if 0 <= val <= self.cropRect[3]:        
             self.cropRect[1] = val
+            self.cropChanged()
         else:
             raise ValueError('crop x1')
             
     @pyqtSlot(int)
     def setCropXp2(self, val):
-        if self.cropRect[1] < val < self.camera.resolution[1]:            
+        if self.cropRect[1] < val <= self.camera.resolution[0]:            
             self.cropRect[3] = val
+            self.cropChanged()
         else:
             raise ValueError('crop x2')
             
@@ -325,13 +586,19 @@ class PiVideoStream(QThread):
     def setCropYp1(self, val):
         if 0 <= val <= self.cropRect[2]:        
             self.cropRect[0] = val            
+            self.cropChanged()
         else:
             raise ValueError('crop y1')
             
     @pyqtSlot(int)
     def setCropYp2(self, val):
-        if self.cropRect[0] < val < self.camera.resolution[0]:
+        if self.cropRect[0] < val <= self.camera.resolution[1]:
             self.cropRect[2] = val            
+            self.cropChanged()
         else:
             raise ValueError('crop y2')   
 
+    def cropChanged(self):
+        if self.hardwareROI:
+            self.roiTimer.start(500)
+
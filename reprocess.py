@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Offline reprocessing of archived timelapse frames.
+
+The frames (PNG, or .dlt, see deltaStorage.py) of one or more folders, e.g. the offset folders of a
+finished experiment, are run through ImageEnhancer, ImageSegmenter and the focus metrics of the
+three ImageProcessor focus targets, with the enhancer settings of settings.ini, as live.
+The files are handed to a pool of worker processes, at most prefetch files are in flight, so the
+memory use does not grow with the number of files. Workers read the files themselves.
+
+One CSV row per frame is written, and flushed, as soon as it is done: file, offset folder,
+timestamp [ms] (from the file name), the quality of every focus target, the number of grid ROIs,
+the grid dimensions and the grid pitch [pixels]. The error messages of a frame go in the error
+column, without metrics. Frames that are in the output already without an error are skipped,
+so an interrupted run resumes where it stopped, and retries the failed frames. With --npz the columns are also written to a
+numpy .npz file at the end.
+
+Usage: python3 reprocess.py folder [folder ...] [--output metrics.csv] [--workers 4] [--prefetch 8] [--npz metrics.npz]
+"""
+import os
+import csv
+import glob
+import time
+import argparse
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from PyQt5.QtCore import QSettings
+from imageProcessor import ImageProcessor
+from deltaStorage import read_frame, EXTENSION
+
+COLUMNS = ['filename', 'offset', 'timestamp_ms', 'quality_0', 'quality_1', 'quality_2',
+           'roi_count', 'grid_columns', 'grid_rows', 'pitch_x', 'pitch_y', 'error']
+
+processor = None # of the worker process
+errors = [] # error messages of the frame in progress
+
+
+def list_frames(folders):
+    files = []
+    for folder in folders:
+        files += sorted(glob.glob(os.path.join(folder, '*.png')) + glob.glob(os.path.join(folder, '*' + EXTENSION)))
+    # absolute paths, so that a resumed run finds its frames, however the folders were typed
+    return [os.path.abspath(f) for f in files]
+
+
+def done_frames(filename):
+    """ Files that are in the output already, without an error. """
+    if not os.path.isfile(filename):
+        return set()
+    with open(filename, newline='') as f:
+        return {os.path.abspath(row['filename']) for row in csv.DictReader(f) if not row['error']}
+
+
+def init_worker(settings_file):
+    # one processor per worker process, with the enhancer configured as in main.py
+    global processor
+    settings = QSettings(settings_file, QSettings.IniFormat)
+    processor = ImageProcessor()
+    processor.setOverlay(False)
+    processor.enhancer.setRotateAngle(float(settings.value('mainwindow/rotate', 0.0)))
+    processor.enhancer.setGamma(float(settings.value('mainwindow/gamma', 1.0)))
+    processor.enhancer.setClaheClipLimit(float(settings.value('mainwindow/clahe', 0.0)))
+    processor.enhancer.setBlend(0.25)
+    processor.enhancer.setKsize(5)
+    # the enhancer and segmenter report errors by message, and return their previous results
+    processor.postMessage.connect(collect_error)
+
+
+def collect_error(text):
+    if 'error;' in text:
+        errors.append(text)
+
+
+def pitch(starts):
+    return round(float(np.median(np.diff(starts))), 2) if len(starts) > 1 else ''
+
+
+def reprocess(filename):
+    """ Metrics of a single frame, as a CSV row. """
+    name = os.path.basename(filename)
+    row = {'filename': filename, 'offset': os.path.basename(os.path.dirname(filename)),
+           'timestamp_ms': name[:16] if name[:16].isdigit() else '', 'error': ''}
+    try:
+        image = read_frame(filename) if filename.endswith(EXTENSION) else cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError("cannot read {}".format(filename))
+        # a new frame size resets the ROIs, the enhancer crop and the grid are reset for every frame,
+        # so a frame that fails does not get the results of the previous frame of this worker
+        processor.enhancer.cropRect = [0, 0, 0, 0]
+        processor.segmenter.ROIs, processor.segmenter.imageQuality = [], 0
+        del errors[:]
+        processor.setFocusTarget(0)
+        enhanced, row['quality_0'] = processor.process(image)
+        processor.setFocusTarget(1)
+        row['quality_1'] = processor.measure(enhanced)
+        # ROIs[i][j] is the j-th row of the i-th column of the grid
+        ROIs = processor.segmenter.ROIs
+        # reuse this grid for focus target 2, instead of segmenting again
+        processor.setFocusTarget(2)
+        processor.gridROIs, processor.frameCount, processor.segmentDecimation = ROIs, 1, 2
+        row['quality_2'] = processor.measure(enhanced)
+        row['grid_columns'] = len(ROIs)
+        row['grid_rows'] = len(ROIs[0]) if ROIs else 0
+        row['roi_count'] = row['grid_columns']*row['grid_rows']
+        row['pitch_x'] = pitch([rois[0].x1 for rois in ROIs]) if ROIs else ''
+        row['pitch_y'] = pitch([roi.y1 for roi in ROIs[0]]) if ROIs else ''
+        if errors:
+            raise RuntimeError(*errors)
+    except Exception as err:
+        # no metrics for a failed frame
+        row = {column: row[column] for column in ('filename', 'offset', 'timestamp_ms')}
+        row['error'] = "type: {}, args: {}".format(type(err), err.args)
+    return row
+
+
+def write_npz(csv_file, npz_file):
+    with open(csv_file, newline='') as f:
+        rows = list(csv.DictReader(f))
+    columns = {}
+    for column in COLUMNS:
+        values = [row[column] for row in rows]
+        try:
+            columns[column] = np.array([float(v) if v != '' else np.nan for v in values])
+        except ValueError:
+            columns[column] = np.array(values)
+    np.savez(npz_file, **columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reprocess archived timelapse frames")
+    parser.add_argument("folders", nargs='+', help="folders with frames, e.g. the offset folders of an experiment")
+    parser.add_argument("--output", default="metrics.csv", help="CSV file, appended to when it exists")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--prefetch", type=int, default=None, help="maximum number of files in flight, default 2 per worker")
+    parser.add_argument("--settings", default="settings.ini", help="settings file with the enhancer settings")
+    parser.add_argument("--npz", help="also write the columns to this .npz file")
+    args = parser.parse_args()
+    prefetch = args.prefetch or 2*args.workers
+
+    done = done_frames(args.output)
+    files = [f for f in list_frames(args.folders) if f not in done]
+    print("{} frames to process, {} done before".format(len(files), len(done)))
+
+    t_start = time.perf_counter()
+    count = 0
+    new_file = not os.path.isfile(args.output)
+    with open(args.output, 'a', newline='') as f, \
+         ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.settings,)) as executor:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        if new_file:
+            writer.writeheader()
+        pending = set()
+        remaining = iter(files)
+        try:
+            while True:
+                # keep at most prefetch files in flight
+                for filename in remaining:
+                    pending.add(executor.submit(reprocess, filename))
+                    if len(pending) >= prefetch:
+                        break
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    row = future.result()
+                    writer.writerow(row)
+                    count += 1
+                    if row['error']:
+                        print("{}: {}".format(row['filename'], row['error']))
+                f.flush()
+                if count % 100 < len(finished):
+                    print("{}/{} frames, {:.1f} frames/s".format(count, len(files), count/(time.perf_counter() - t_start)))
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            print("interrupted after {} frames, run again to resume".format(count))
+            raise SystemExit(1)
+
+    print("{} frames in {:.1f} s, written to {}".format(count, time.perf_counter() - t_start, args.output))
+    if args.npz:
+        write_npz(args.output, args.npz)
+        print("columns written to {}".format(args.npz))
@@ -0,0 +1,119 @@
+"""@package docstring
+Schedulers for the rounds of a timelapse experiment.
+
+ActivityScheduler adapts the wait between rounds to the activity in the sample, so that storage
+and upload volume follow the biology rather than the clock.
+RoundScheduler keeps the rounds on a fixed time grid, independent of their duration.
+StabilityGate tells whether the temperature has settled, so that rounds do not chase thermal drift.
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import time
+from collections import deque
+import cv2
+import numpy as np
+
+
+class ActivityScheduler:
+    """
+    The activity score is the mean absolute difference between downsampled grey frames of
+    successive rounds, relative to the mean intensity. When the score exceeds high, the wait is
+    divided by factor, below low it is multiplied by factor, within [wait_min_s, wait_max_s].
+    """
+    def __init__(self, wait_s, wait_min_s, wait_max_s, low=0.01, high=0.05, factor=2.0, width=64):
+        self.wait_min_s = wait_min_s
+        self.wait_max_s = wait_max_s
+        self.wait_s = min(max(wait_s, wait_min_s), wait_max_s)
+        self.low = low
+        self.high = high
+        self.factor = factor
+        self.width = width
+        self.previous = None
+
+    def downsample(self, image):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        height = max(round(self.width*image.shape[0]/image.shape[1]), 1)
+        # area interpolation averages, which also suppresses the pixel noise
+        return cv2.resize(image, (self.width, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def score(self, image):
+        """ Activity since the previous frame, None for the first frame. """
+        current = self.downsample(image)
+        previous, self.previous = self.previous, current
+        if previous is None or previous.shape != current.shape:
+            return None
+        return float(np.mean(np.abs(current - previous))/max(np.mean(current), 1.0))
+
+    def update(self, score):
+        """ Adapt and return the wait [s] before the next round. """
+        if score is not None:
+            if score > self.high:
+                self.wait_s = max(self.wait_s/self.factor, self.wait_min_s)
+            elif score < self.low:
+                self.wait_s = min(self.wait_s*self.factor, self.wait_max_s)
+        return self.wait_s
+
+
+class RoundScheduler:
+    """
+    Schedules rounds at absolute start times on the monotonic clock, every start is a period after
+    the previous scheduled start. The variable duration of a round therefore does not add to the
+    period, and sampling times do not drift. When a round overruns the next start time, policy
+    'skip' skips to the first start time that is still ahead, which keeps the sampling uniform,
+    policy 'compress' starts the next round immediately, to catch up with the schedule.
+    """
+    policies = ('skip', 'compress')
+
+    def __init__(self, policy='skip', clock=time.monotonic):
+        if policy not in self.policies:
+            raise ValueError("unknown scheduling policy {}, choose from {}".format(policy, ', '.join(self.policies)))
+        self.policy = policy
+        self.clock = clock
+        self.start_time = self.clock()
+        self.scheduled = self.start_time  # start time of the current round
+        self.rounds = 0
+        self.skipped = 0
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def lateness(self):
+        """ Count a round that starts now, and return how late [s] it is. """
+        self.rounds += 1
+        return self.clock() - self.scheduled
+
+    def next(self, period_s):
+        """ Schedule the next round a period after the current one, return the delay [s] until it starts. """
+        self.scheduled += period_s
+        now = self.clock()
+        if now > self.scheduled and self.policy == 'skip' and period_s > 0:
+            missed = int((now - self.scheduled)//period_s) + 1
+            self.scheduled += missed*period_s
+            self.skipped += missed
+        return max(self.scheduled - now, 0.0)
+
+
+class StabilityGate:
+    """
+    Temperature stability gate. Readings are kept for window_s seconds; the temperature is stable
+    when the readings cover the window, and all of them are within tolerance of the setpoint.
+    """
+    def __init__(self, setpoint, window_s=60, tolerance=0.25, clock=time.monotonic):
+        self.setpoint = setpoint
+        self.window_s = window_s
+        self.tolerance = tolerance
+        self.clock = clock
+        self.readings = deque()
+
+    def append(self, temperature):
+        t = self.clock()
+        self.readings.append((t, temperature))
+        # keep one reading older than the window, to know that the window is covered
+        while len(self.readings) > 1 and self.readings[1][0] <= t - self.window_s:
+            self.readings.popleft()
+
+    def stable(self):
+        if not self.readings or self.readings[0][0] > self.clock() - self.window_s:
+            return False
+        return all(abs(T - self.setpoint) <= self.tolerance for t, T in self.readings)
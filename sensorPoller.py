@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+## Sensor poller
+# Reads slow sensors (I2C, sysfs) on a dedicated thread, so that the event loops that carry the
+# frame traffic never wait for them. Every sensor has its own period; the sensors that are due are
+# read in one pass. Timestamped readings go into a ring buffer per sensor, that consumers read
+# without waiting for a sensor, the lock is only held to copy a reading.
+#
+import time
+import threading
+import traceback
+from PyQt5.QtCore import QThread, pyqtSignal, pyqtSlot
+
+
+class RingBuffer:
+    """
+    Fixed size buffer of (monotonic time, value) readings, safe to use from several threads.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.readings = [None]*size
+        self.count = 0  # number of readings ever appended
+        self.lock = threading.Lock()
+
+    def append(self, t, value):
+        with self.lock:
+            self.readings[self.count % self.size] = (t, value)
+            self.count += 1
+
+    def latest(self):
+        """ The last (t, value) reading, None if there is none yet. """
+        with self.lock:
+            return self.readings[(self.count - 1) % self.size] if self.count else None
+
+    def since(self, t):
+        """ Readings newer than t, oldest first. """
+        with self.lock:
+            readings = [self.readings[i % self.size] for i in range(max(self.count - self.size, 0), self.count)]
+        return [r for r in readings if r[0] > t]
+
+
+class ThermalZone:
+    """
+    Temperature [°C] from a sysfs thermal zone, the file is kept open and re-read.
+    """
+    def __init__(self, path="/sys/class/thermal/thermal_zone0/temp"):
+        self.file = open(path, 'r')
+
+    def __call__(self):
+        self.file.seek(0)
+        return round(int(self.file.read())/1000, 1)
+
+    def close(self):
+        self.file.close()
+
+
+class SensorPoller(QThread):
+    postMessage = pyqtSignal(str)
+
+    def __init__(self, size=256):
+        super().__init__()
+        self.size = size
+        self.sensors = {}  # name -> [read function, period [ms] or function that returns it, next due time]
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def addSensor(self, name, read, period_ms):
+        """
+        Poll read() every period_ms, read is called on the poller thread. period_ms may be a function,
+        that is called after every read, for a period that adapts, e.g. to a controller. A read with
+        a close method, e.g. ThermalZone, is closed on stop.
+        """
+        with self.lock:
+            self.buffers.setdefault(name, RingBuffer(self.size))
+            self.sensors[name] = [read, period_ms, time.monotonic()]
+
+    def latest(self, name):
+        return self.buffers[name].latest() if name in self.buffers else None
+
+    def since(self, name, t):
+        return self.buffers[name].since(t) if name in self.buffers else []
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            t = time.monotonic()
+            with self.lock:
+                due = [(name, sensor) for name, sensor in self.sensors.items() if sensor[2] <= t]
+            for name, sensor in due:
+                try:
+                    value = sensor[0]()
+                    self.buffers[name].append(time.monotonic(), value)
+                except Exception as err:
+                    traceback.print_exc()
+                    self.postMessage.emit("{}: error; {}, type: {}, args: {}".format(self.__class__.__name__, name, type(err), err.args))
+                # keep the schedule, unless we fell behind
+                period_s = (sensor[1]() if callable(sensor[1]) else sensor[1])/1000
+                sensor[2] = max(sensor[2] + period_s, t)
+            with self.lock:
+                next_due = min((sensor[2] for sensor in self.sensors.values()), default=t + 0.1)
+            # sleep in short steps, to respond to stop in time
+            self.msleep(min(max(round(1000*(next_due - time.monotonic())), 1), 100))
+
+    @pyqtSlot()
+    def stop(self):
+        self.postMessage.emit("{}: info; stopping worker".format(self.__class__.__name__))
+        self.requestInterruption()
+        self.wait()
+        with self.lock:
+            for sensor in self.sensors.values():
+                if hasattr(sensor[0], 'close'):
+                    sensor[0].close()
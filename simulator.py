@@ -0,0 +1,347 @@
+"""@package docstring
+Simulated hardware backends, to run and benchmark the processing chain off-device.
+
+There are three backends:
+1. SimulatedPi replaces pigpio.pi, and implements the subset of calls used by VoiceCoil and Heater.
+   The voice coil value is tracked from the PWM and direction pins, the MCP9800 temperature
+   sensor reads from a first order thermal model that is driven by the heater PWM.
+2. ThermalModel is the thermal plant of the heated sample holder.
+3. SimulatedVideoStream replaces PiVideoStream, and renders a synthetic counting chamber grid,
+   blurred as a function of the distance between the voice coil value and the true focus.
+
+Usage: python3 main.py --simulate
+"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import cv2
+import math
+import time
+import numpy as np
+import pigpio
+from PyQt5.QtCore import QThread, QSettings, pyqtSlot, pyqtSignal
+from fps import FPS
+import instrumentation
+from wait import wait_signal, wait_ms
+from voiceCoil import VoiceCoil
+from heater import Heater
+from clipStorage import SegmentUploader
+
+
+class ThermalModel:
+    """
+    First order thermal plant, T' = (T_amb + K*u - T)/tau, with u the heater power [%].
+    The model is evaluated lazily with an exact step response, using a monotonic clock.
+    Set time_scale > 1 to let the simulated time run faster than the wall clock.
+    """
+    def __init__(self, T_amb=21.0, K=0.4, tau=120.0, time_scale=1.0, clock=time.monotonic):
+        self.T_amb = T_amb  # ambient temperature [°C]
+        self.K = K  # static gain [°C/%]
+        self.tau = tau  # time constant [s]
+        self.time_scale = time_scale
+        self.clock = clock
+        self.T = T_amb
+        self.u = 0.0
+        self.t = self.clock()
+
+    def step(self, dt):
+        # exact solution for a piecewise constant input
+        T_ss = self.T_amb + self.K*self.u
+        self.T = T_ss + (self.T - T_ss)*math.exp(-dt/self.tau)
+        return self.T
+
+    def update(self):
+        t = self.clock()
+        self.step((t - self.t)*self.time_scale)
+        self.t = t
+        return self.T
+
+    def setPower(self, u):
+        self.update()  # integrate up to now with the previous input
+        self.u = min(max(u, 0.0), 100.0)
+
+
+class SimulatedPi(pigpio.pi):
+    """
+    Stand-in for pigpio.pi, no daemon is required.
+    """
+    def __init__(self, thermal_model=None):
+        # deliberately skip pigpio.pi.__init__, which connects to the daemon
+        self.connected = True
+        self.levels = {}
+        self.pwm_duty = {}
+        self.pwm_range = {}
+        self.thermal_model = ThermalModel() if thermal_model is None else thermal_model
+
+    def stop(self):
+        self.connected = False
+
+    def set_mode(self, gpio, mode):
+        self.levels[gpio] = 0
+        return 0
+
+    def write(self, gpio, level):
+        self.levels[gpio] = level
+        return 0
+
+    def hardware_PWM(self, gpio, PWMfreq, PWMduty):
+        self.pwm_duty[gpio] = PWMduty/1e6
+        return 0
+
+    def set_PWM_frequency(self, user_gpio, frequency):
+        return frequency
+
+    def set_PWM_range(self, user_gpio, range_):
+        self.pwm_range[user_gpio] = range_
+        return 0
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        self.pwm_duty[user_gpio] = dutycycle/self.pwm_range.get(user_gpio, 255)
+        if user_gpio == Heater.pwm_pin:
+            self.thermal_model.setPower(100*self.pwm_duty[user_gpio])
+        return 0
+
+    def i2c_open(self, i2c_bus, i2c_address, i2c_flags=0):
+        return 0
+
+    def i2c_close(self, handle):
+        return 0
+
+    def i2c_write_byte_data(self, handle, reg, byte_val):
+        return 0
+
+    def i2c_read_word_data(self, handle, reg):
+        # MCP9800 ambient temperature register, with flipped MSB and LSB, see Heater.update
+        T = self.thermal_model.update()
+        T_int = int(T)
+        T_frac = int((T - T_int)*16)
+        return (T_int & 0xFF) | ((T_frac & 0xF) << 12)
+
+    def voice_coil_value(self):
+        # voice coil value in percentage of full current, with polarity, see VoiceCoil.setVal
+        value = 100*self.pwm_duty.get(VoiceCoil.pwm_pin, 0.0)
+        return -value if self.levels.get(VoiceCoil.dir_pin, 0) == 1 else value
+
+
+def counting_chamber_grid(frame_size, pitch=50, line_width=2, triple_every=4, background=200, line_level=60):
+    """
+    Render an in-focus counting chamber, i.e. a grid of squares with triple lines around groups of squares.
+    frame_size is a (width, height) tuple, the result is a uint8 image of shape (height, width).
+    """
+    width, height = frame_size
+    image = np.full((height, width), background, dtype=np.uint8)
+    for axis, length in ((0, height), (1, width)):
+        for i, pos in enumerate(range(pitch//2, length, pitch)):
+            offsets = (-2*line_width, 0, 2*line_width) if i % triple_every == 0 else (0,)
+            for offset in offsets:
+                p1, p2 = max(pos + offset, 0), min(pos + offset + line_width, length)
+                if axis == 0:
+                    image[p1:p2, :] = line_level
+                else:
+                    image[:, p1:p2] = line_level
+    return image
+
+
+def blurred_frame(grid, focus_error, sigma_0=0.5, sigma_per_unit=4.0, noise=2.0, rng=None):
+    """
+    Defocus the grid with a Gaussian blur, sigma grows linearly with the focus error [voice coil %].
+    """
+    sigma = sigma_0 + sigma_per_unit*abs(focus_error)
+    image = cv2.GaussianBlur(grid, (0, 0), sigma)
+    if noise > 0:
+        rng = np.random.default_rng() if rng is None else rng
+        image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+    return image
+
+
+def frame_size_from_string(frameSizeStr):
+    (width, height) = frameSizeStr.split('x')
+    return (int(width), int(height))
+
+
+class SimulatedVideoStream(QThread):
+    """
+    Simulated counterpart of PiVideoStream, with the same signals and slots.
+    Frames are rendered at frameSize and paced at the configured frame rate.
+    """
+    finished = pyqtSignal()
+    postMessage = pyqtSignal(str)
+    frame = pyqtSignal(np.ndarray)
+    highResFrame = pyqtSignal(np.ndarray)
+    progress = pyqtSignal(int)
+    captured = pyqtSignal()
+
+    storagePath = None
+    cropRect = [0] * 4
+    clipUpload = None
+    segmentUploader = None
+
+    def __init__(self, pio, focus=None, seed=None):
+        super().__init__()
+        if not isinstance(pio, SimulatedPi):
+            raise TypeError("SimulatedVideoStream constructor attribute is not a SimulatedPi instance!")
+        self.pio = pio
+        self.settings = QSettings("settings.ini", QSettings.IniFormat)
+        # true focus position in voice coil %, default to the last focus used in the GUI
+        self.focus = float(self.settings.value('mainwindow/VC', 0.0)) if focus is None else focus
+        self.rng = np.random.default_rng(seed)
+        self.subscribers = set()
+        self.loadSettings()
+
+    def loadSettings(self):
+        self.postMessage.emit("{}: info; loading camera settings from {}".format(self.__class__.__name__, self.settings.fileName()))
+        self.monochrome = self.settings.value('camera/monochrome', False, type=bool)
+        self.frameRate = int(self.settings.value('camera/frame_rate'))
+        self.frameSize = frame_size_from_string(self.settings.value('frame_size'))
+        self.videoFrameSize = frame_size_from_string(self.settings.value('camera/video_frame_size'))
+        self.grid = counting_chamber_grid(self.frameSize)
+        self.videoGrid = counting_chamber_grid(self.videoFrameSize, pitch=int(50*self.videoFrameSize[0]/self.frameSize[0]))
+        self.highResFrameSize = frame_size_from_string(self.settings.value('camera/high_res_frame_size', '1640x1232'))
+        self.highResGrid = counting_chamber_grid(self.highResFrameSize, pitch=int(50*self.highResFrameSize[0]/self.frameSize[0]))
+
+    def render(self, grid):
+        img = blurred_frame(grid, self.pio.voice_coil_value() - self.focus, rng=self.rng)
+        return img if self.monochrome else cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+    @pyqtSlot()
+    def initStream(self):
+        if self.isRunning():
+            self.requestInterruption()
+            wait_signal(self.finished, 10000)
+        if self.cropRect[2] == 0:
+            self.cropRect[2] = self.frameSize[1]
+        if self.cropRect[3] == 0:
+            self.cropRect[3] = self.frameSize[0]
+        self.start(QThread.HighPriority)
+        msg = "{}: info; simulated video stream initialized with frame size = {} and {:d} channels".format(\
+            self.__class__.__name__, str(self.frameSize), 1 if self.monochrome else 3)
+        self.postMessage.emit(msg)
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            self.fps = FPS().start()
+            period = 1.0/self.frameRate
+            next_time = time.monotonic()
+            while not self.isInterruptionRequested():
+                with instrumentation.span('capture'):
+                    img = self.render(self.grid)
+                self.frame.emit(img)
+                if self.subscribers:
+                    self.highResFrame.emit(self.render(self.highResGrid))
+                self.fps.update()
+                next_time += period
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    self.msleep(int(1000*delay))
+                else:
+                    next_time = time.monotonic()  # running late, do not try to catch up
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+        finally:
+            self.fps.stop()
+            msg = "{}: info; finished, approx. processing speed: {:.2f} fps".format(self.__class__.__name__, self.fps.fps())
+            self.postMessage.emit(msg)
+            self.finished.emit()
+
+    @pyqtSlot()
+    def reloadConfig(self):
+        # read settings.ini again, and restart a running stream with the new frame sizes
+        self.settings.sync()
+        self.loadSettings()
+        if self.isRunning():
+            self.initStream()
+
+    @pyqtSlot()
+    def stop(self):
+        self.postMessage.emit("{}: info; stopping".format(self.__class__.__name__))
+        if self.isRunning():
+            self.requestInterruption()
+            wait_signal(self.finished, 10000)
+        self.quit()
+        if self.segmentUploader is not None:
+            self.segmentUploader.stop()
+            self.segmentUploader = None
+
+    @pyqtSlot()
+    def pause(self):
+        # nothing to calibrate, pausing is stopping the stream
+        self.postMessage.emit("{}: info; paused".format(self.__class__.__name__))
+        if self.isRunning():
+            self.requestInterruption()
+            wait_signal(self.finished, 10000)
+        self.quit()
+
+    @pyqtSlot(str)
+    def subscribeHighRes(self, stage):
+        self.subscribers.add(stage)
+
+    @pyqtSlot(str)
+    def unsubscribeHighRes(self, stage):
+        self.subscribers.discard(stage)
+
+    def filename(self, filename_prefix, suffix=''):
+        if filename_prefix is not None:
+            (head, tail) = os.path.split(filename_prefix)
+            if not os.path.exists(head):
+                os.makedirs(head)
+            return os.path.sep.join([head, '{:016d}'.format(round(time.time() * 1000)) + suffix + tail])
+        filename = '{:016d}'.format(round(time.time() * 1000)) + suffix
+        if self.storagePath is not None:
+            filename = os.path.sep.join([self.storagePath, filename])
+        return filename
+
+    @pyqtSlot(str, bool)
+    def takeImage(self, filename_prefix=None, highRes=False):
+        filename = self.filename(filename_prefix) + '.png'
+        try:
+            cv2.imwrite(filename, self.render(self.highResGrid if highRes and self.subscribers else self.videoGrid))
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+        self.captured.emit()
+        self.postMessage.emit("{}: info; image written to {}".format(self.__class__.__name__, filename))
+
+    @pyqtSlot(str, int)
+    def recordClip(self, filename_prefix=None, duration=10):
+        filename = self.filename(filename_prefix, '_{}s'.format(round(duration))) + '.mp4'
+        self.postMessage.emit("{}: info; starting recording for {} s".format(self.__class__.__name__, duration))
+        try:
+            writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), self.frameRate, self.videoFrameSize, isColor=True)
+            for i in range(int(duration*self.frameRate)):
+                writer.write(cv2.cvtColor(blurred_frame(self.videoGrid, self.pio.voice_coil_value() - self.focus, rng=self.rng), cv2.COLOR_GRAY2BGR))
+                wait_ms(int(1000/self.frameRate))
+            writer.release()
+            if self.clipUpload is not None:
+                # no segmentation, the whole clip is handed to the uploader
+                if self.segmentUploader is None:
+                    self.segmentUploader = SegmentUploader(int(float(self.settings.value('storage/tmpfs_budget_mb', 32))*2**20),
+                                                           log=self.postMessage.emit)
+                self.segmentUploader.push(filename, self.clipUpload)
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+        self.captured.emit()
+        self.postMessage.emit("{}: info; video written to {}".format(self.__class__.__name__, filename))
+
+    @pyqtSlot(str)
+    def setStoragePath(self, path):
+        self.storagePath = path
+
+    @pyqtSlot(object)
+    def setClipUploader(self, upload):
+        self.clipUpload = upload
+
+    @pyqtSlot(int)
+    def setCropXp1(self, val):
+        self.cropRect[1] = val
+
+    @pyqtSlot(int)
+    def setCropXp2(self, val):
+        self.cropRect[3] = val
+
+    @pyqtSlot(int)
+    def setCropYp1(self, val):
+        self.cropRect[0] = val
+
+    @pyqtSlot(int)
+    def setCropYp2(self, val):
+        self.cropRect[2] = val
@@ -3,6 +3,7 @@
 import os
 import traceback
 from PyQt5.QtCore import QTimer, QObject, pyqtSlot, pyqtSignal
+from sensorPoller import ThermalZone
 
 ## @brief Periodically read temperatures and signal an alarm if threshold is exceeded
 ## @author Jeroen Veen
@@ -13,9 +14,13 @@ class SystemTemperatures(QObject):
     alarmRemoved = pyqtSignal()
     failure = pyqtSignal()
 
-    def __init__(self, interval=1, alarm_temperature = 50, failure_temperature = 75):
+    def __init__(self, interval=1, alarm_temperature = 50, failure_temperature = 75, poller=None):
         super().__init__()
         self.interval = 1000*interval
+        # with a SensorPoller, the thermal zone file is kept open and read on the poller thread
+        self.poller = poller
+        if self.poller is not None:
+            self.poller.addSensor('cpu', ThermalZone(), self.interval)
         self.threshold = alarm_temperature
         self.fail_threshold = failure_temperature
         self.timer.timeout.connect(self.update)
@@ -25,7 +30,13 @@ class SystemTemperatures(QObject):
 
     def update(self):
         try:
-            cpu_temp = float(self.get_cpu_tempfunc())
+            if self.poller is None:
+                cpu_temp = float(self.get_cpu_tempfunc())
+            else:
+                reading = self.poller.latest('cpu')
+                if reading is None:
+                    return
+                cpu_temp = reading[1]
             self.postMessage.emit('{}: info; T_CPU={:.1f}°C'.format(self.__class__.__name__, cpu_temp))
             if (cpu_temp > self.fail_threshold):
                 self.failure.emit()
@@ -51,10 +62,9 @@ class SystemTemperatures(QObject):
 
     @pyqtSlot()
     def stop(self):
-        self.msg("info;stopping")
+        self.postMessage.emit("{}: info; stopping".format(self.__class__.__name__))
         if self.timer.isActive():
             self.timer.stop()
-        self.signals.finished.emit()
 
     ## @brief Return CPU temperature as a string, based on https://github.com/gavinlyonsrepo/raspberrypi_tempmon
     def get_cpu_tempfunc(self):
@@ -5,23 +5,27 @@
 import os, glob
 import re
 import time
-import traceback
 import numpy as np
-import smtplib, ssl
 from webdav3.client import Client
 from webdav3.exceptions import WebDavException
 from PyQt5.QtCore import QSettings, QObject, QTimer, QEventLoop, pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import QDialog, QFileDialog #, QPushButton, QLabel, QSpinBox, QDoubleSpinBox, QVBoxLayout, QGridLayout
 from wait import wait_signal, wait_ms
+from scheduler import ActivityScheduler, RoundScheduler, StabilityGate
+from deltaStorage import DeltaWriter, EXTENSION
+from config import Config, ConfigError, TIMELAPSE, CONNECTIONS
 import subprocess
-    
+
 class TimeLapse(QObject):
     postMessage = pyqtSignal(str)
     setLogFileName = pyqtSignal(str)
     setImageStoragePath = pyqtSignal(str)
+    setMetricsPath = pyqtSignal(str)
     stopCamera = pyqtSignal()
     startCamera = pyqtSignal()
-    takeImage = pyqtSignal()
+    takeImage = pyqtSignal(bool) # high resolution
+    subscribeHighRes = pyqtSignal(str)
+    unsubscribeHighRes = pyqtSignal(str)
     recordClip = pyqtSignal(int)
     startAutoFocus = pyqtSignal()
     focussed = pyqtSignal() # repeater signal
@@ -31,14 +35,26 @@ class TimeLapse(QObject):
     finished = pyqtSignal()
     setFocusWithOffset = pyqtSignal(float)
     setTemperature = pyqtSignal(float)
+    setClipUploader = pyqtSignal(object)
+    activityFrame = pyqtSignal() # repeater signal
+    requestWindow = pyqtSignal()
+    releaseWindow = pyqtSignal()
+    cancelWindow = pyqtSignal()
+    windowGranted = pyqtSignal() # repeater signal
+    temperatureReading = pyqtSignal() # repeater signal
+    notify = pyqtSignal(str, str, str) # recipient, message, key, see notifier.py
 
     focus = None
+    gate = None
+    coordinated = False # rounds wait for a window from the coordinator, see coordinator.py
+    granted = False
+    scheduler = None
+    activityFrameRequested = False
     
     def __init__(self):
         super().__init__()
 
         self.settings = QSettings('settings.ini', QSettings.IniFormat)
-        self.conn_settings = QSettings('connections.ini', QSettings.IniFormat)
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.run)
         self.isInterruptionRequested = False        
@@ -47,29 +63,43 @@ class TimeLapse(QObject):
         pass
 
     @pyqtSlot()
-    def start(self):
-
+    @pyqtSlot(str)
+    def start(self, timelapse_setting_file_name=None):
+        ''' Start a timelapse experiment, if no settings file is given a file dialog is opened
+        '''
         try:
             # open timelapse settings file
-            dlg = QFileDialog()
-            timelapse_setting_file_name = QFileDialog.getOpenFileName(dlg, 'Open timelapse settings file', os.getcwd(), "Ini file (*.ini)")[0]
+            if timelapse_setting_file_name is None:
+                dlg = QFileDialog()
+                timelapse_setting_file_name = QFileDialog.getOpenFileName(dlg, 'Open timelapse settings file', os.getcwd(), "Ini file (*.ini)")[0]
             if timelapse_setting_file_name == "" or timelapse_setting_file_name == None:
                 self.postMessage.emit('{}: error; not a timelapse settings file selected'.format(self.__class__.__name__))            
                 return
 
             self.postMessage.emit('{}: info; loading settings from {}'.format(self.__class__.__name__, timelapse_setting_file_name))          
-            self.timelapse_settings = QSettings(timelapse_setting_file_name, QSettings.IniFormat)
-
-            if not self.timelapse_settings.value('filetype') == 'timelapse':
-                self.postMessage.emit('{}: error; not a timelapse settings file selected'.format(self.__class__.__name__))            
+            # parse and check the settings once for the whole experiment, see config.py
+            try:
+                self.config = Config(timelapse_setting_file_name, TIMELAPSE)
+                self.connections = Config('connections.ini', CONNECTIONS)
+            except ConfigError as err:
+                self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
                 return
-
-            if self.timelapse_settings.contains('temperature'):
-                self.setTemperature.emit(float(self.timelapse_settings.value('temperature')))
+            self.config.postMessage.connect(self.postMessage)
+            if self.config['acquisition/segmented'] and not self.config.contains('connections/storage'):
+                self.postMessage.emit('{}: warning; acquisition/segmented without connections/storage, clips are recorded as single files'.format(
+                    self.__class__.__name__))
+
+            self.gate = None
+            if self.config.contains('temperature'):
+                self.setTemperature.emit(self.config['temperature'])
+                # rounds wait for the temperature to settle
+                self.gate = StabilityGate(self.config['temperature'],
+                                          window_s=self.config['run/stability_window'],
+                                          tolerance=self.config['run/stability_tolerance'])
 
             # set logging file
             self.local_storage_path = self.settings.value('temp_folder')
-            self.log_file_name = os.path.sep.join([self.local_storage_path, self.timelapse_settings.value('id') + ".log"])
+            self.log_file_name = os.path.sep.join([self.local_storage_path, self.config['id'] + ".log"])
             self.setLogFileName.emit(self.log_file_name)
             wait_ms(100)
 
@@ -91,18 +121,33 @@ class TimeLapse(QObject):
                                                                                   self.local_image_storage_path))
             self.setImageStoragePath.emit(self.local_image_storage_path)
 
+            # metrics time series of this experiment, see timeSeries.py
+            self.local_metrics_path = os.path.sep.join([self.local_storage_path, 'metrics'])
+            if not os.path.exists(self.local_metrics_path):
+                os.makedirs(self.local_metrics_path)
+            for f in glob.glob(os.path.sep.join([self.local_metrics_path, '*'])):
+                os.remove(f)
+            self.setMetricsPath.emit(self.local_metrics_path)
+
+            # keyframes of delta storage, one per offset, kept between rounds, see deltaStorage.py
+            self.local_keyframe_path = os.path.sep.join([self.local_storage_path, 'keyframes'])
+            if not os.path.exists(self.local_keyframe_path):
+                os.makedirs(self.local_keyframe_path)
+            for f in glob.glob(os.path.sep.join([self.local_keyframe_path, '*'])):
+                os.remove(f)
+
             # set op connectivity
-            if self.timelapse_settings.contains('connections/storage'):
-                if self.timelapse_settings.value('connections/storage') == 'rclone':
+            if self.config.contains('connections/storage'):
+                if self.config['connections/storage'] == 'rclone':
                     # rclone to path provided in connections.ini file
-                    self.server_storage_path = self.conn_settings.value('rclone/storage_path') + ':' + self.timelapse_settings.value('id')
+                    self.server_storage_path = self.connections['rclone/storage_path'] + ':' + self.config['id']
 
                     try:
                         subprocess.run(["rclone", "mkdir", self.server_storage_path])
                         subprocess.run(["rclone", "copy", "--no-traverse", self.local_storage_path, self.server_storage_path])
 
                         # create directory structure on server
-                        for offset in self.timelapse_settings.value('acquisition/offsets'):
+                        for offset in self.config['acquisition/offsets']:
                             subprocess.run(["rclone", "mkdir", os.path.sep.join([self.server_storage_path, offset])])
                         
                     except Exception as err:
@@ -110,14 +155,14 @@ class TimeLapse(QObject):
 
                     self.postMessage.emit('{}: info; rclone connection to {}'.format(self.__class__.__name__, self.server_storage_path))
                     
-                elif self.timelapse_settings.value('connections/storage') == 'wbedav':
+                elif self.config['connections/storage'] == 'wbedav':
                     # open WebDAV connection to server, using credentials from connections.ini file
-                    self.server_storage_path = os.path.sep.join([self.conn_settings.value('webdav/storage_path'),
-                                                                 self.timelapse_settings.value('id')])
+                    self.server_storage_path = os.path.sep.join([self.connections['webdav/storage_path'],
+                                                                 self.config['id']])
                     
-                    options = {'webdav_hostname': self.conn_settings.value('webdav/hostname'),
-                               'webdav_login': self.conn_settings.value('webdav/login'),
-                               'webdav_password': self.conn_settings.value('webdav/password')
+                    options = {'webdav_hostname': self.connections['webdav/hostname'],
+                               'webdav_login': self.connections['webdav/login'],
+                               'webdav_password': self.connections['webdav/password']
                                }
                     try:
                         self.webdav_client = Client(options)
@@ -127,14 +172,14 @@ class TimeLapse(QObject):
 
                     # copy files to server
                     self.webdav_client.push(local_directory=self.local_storage_path, remote_directory=self.server_storage_path)
-                    self.server_log_file_name = os.path.sep.join([self.server_storage_path, self.timelapse_settings.value('id') + ".log"])
+                    self.server_log_file_name = os.path.sep.join([self.server_storage_path, self.config['id'] + ".log"])
 
                     # create directory structure on server
-                    for offset in self.timelapse_settings.value('acquisition/offsets'):
+                    for offset in self.config['acquisition/offsets']:
                         self.webdav_client.mkdir(os.path.sep.join([self.server_storage_path, offset]))
 
                     self.postMessage.emit('{}: info; WebDAV connection to {}: {}'.format(self.__class__.__name__,
-                                                                                     self.conn_settings.value('webdav/hostname'),
+                                                                                     self.connections['webdav/hostname'],
                                                                                      self.server_storage_path))
                 else:
                     self.postMessage.emit('{}: error; unknown remote'.format(self.__class__.__name__))
@@ -144,11 +189,19 @@ class TimeLapse(QObject):
 
 
         # get timelapse schedule
-        t = time.strptime(self.timelapse_settings.value('run/duration')[1],'%H:%M:%S')
-        days = int(self.timelapse_settings.value('run/duration')[0].split('d')[0])
-        self.run_duration_s = ((24*days + t.tm_hour)*60 + t.tm_min)*60 + t.tm_sec
-        t = time.strptime(self.timelapse_settings.value('run/wait'),'%H:%M:%S')
-        self.run_wait_s = (t.tm_hour*60 + t.tm_min)*60 + t.tm_sec
+        self.run_duration_s = self.config['run/duration']
+        self.run_wait_s = self.config['run/wait']
+
+        # adapt the wait to the activity in the sample
+        self.scheduler = None
+        self.delta_writers = {} # per offset, for delta storage of snapshots
+        if self.config['run/adaptive']:
+            self.scheduler = ActivityScheduler(self.run_wait_s,
+                                               self.run_wait_s if self.config['run/wait_min'] is None else self.config['run/wait_min'],
+                                               self.run_wait_s if self.config['run/wait_max'] is None else self.config['run/wait_max'],
+                                               low=self.config['run/activity_low'],
+                                               high=self.config['run/activity_high'])
+            self.run_wait_s = self.scheduler.wait_s
 
         message = """Subject: Experiment started \n\n ."""
         # do something fancy here in future: https://realpython.com/python-send-email/#sending-fancy-emails
@@ -157,12 +210,19 @@ class TimeLapse(QObject):
         self.postMessage.emit('{}: info; run duration: {} s, run wait: {} s'.format(self.__class__.__name__,
                                                                                     self.run_duration_s,
                                                                                     self.run_wait_s))
-        # start timer
+        # start timer, rounds start at fixed times from now on, see scheduler.py
         self.prev_note_nr = 0 # for logging
-        self.start_time_s = time.time()
+        self.round_scheduler = RoundScheduler(self.config['run/behind'])
         self.timer.start(0)
 
         
+    @pyqtSlot()
+    def reloadConfig(self):
+        """ Read the experiment and connections files again; the settings read per round apply from the next round. """
+        for config in (getattr(self, 'config', None), getattr(self, 'connections', None)):
+            if config is not None:
+                config.reload()
+
     @pyqtSlot()
     def stop(self):
         try:
@@ -181,26 +241,90 @@ class TimeLapse(QObject):
         self.focus = val
         self.focussed.emit()
 
+    @pyqtSlot(float)
+    def temperatureUpdate(self, temperature):
+        if self.gate is not None:
+            self.gate.append(temperature)
+        self.temperatureReading.emit()
+
+    @pyqtSlot()
+    def grantedSlot(self):
+        self.granted = True
+        self.windowGranted.emit()
+
+    @pyqtSlot(np.ndarray)
+    def imageUpdate(self, image):
+        # only keep a frame when the activity scheduler asks for one
+        if self.activityFrameRequested:
+            self.activityFrameRequested = False
+            self.activityImage = image.copy()
+            self.activityFrame.emit()
+
         
     def run(self):
         ''' Timer call back function, als initiates next one-shot 
         '''
         try:
+            # wait until the temperature is stable, otherwise autofocus chases thermal drift
+            # before asking for a window, so that a unit waiting for its heater does not hold the window
+            if self.gate is not None:
+                start_wait_time_s = time.monotonic()
+                timeout_s = self.config['run/stability_timeout']
+                while not self.gate.stable() and time.monotonic() - start_wait_time_s < timeout_s:
+                    wait_signal(self.temperatureReading, 10000)
+                wait_time_s = time.monotonic() - start_wait_time_s
+                if self.gate.stable():
+                    self.postMessage.emit('{}: info; temperature stable after {:.1f} s'.format(self.__class__.__name__, wait_time_s))
+                else:
+                    self.postMessage.emit('{}: error; temperature not stable within {:.1f} s'.format(self.__class__.__name__, wait_time_s))
+
+            # wait for our turn, the coordinator spreads the rounds of several units
+            if self.coordinated:
+                self.granted = False
+                self.requestWindow.emit()
+                wait_signal(self.windowGranted, max(self.run_wait_s, 60)*1000)
+                if not self.granted:
+                    # withdraw the request, otherwise the coordinator grants it later to a unit that no longer waits
+                    self.cancelWindow.emit()
+                    self.postMessage.emit("{}: error; no capture window granted, round skipped".format(self.__class__.__name__))
+                    self.round_scheduler.skipped += 1
+                    self.scheduleNext(self.round_scheduler.elapsed())
+                    return
+
             # wake up peripherals
-            start_run_time_s = time.time()
+            start_run_time_s = time.monotonic()
+            lateness_s = self.round_scheduler.lateness()
+            self.postMessage.emit("{}: info; round {:d} started {:.1f}s late".format(self.__class__.__name__,
+                                                                                   self.round_scheduler.rounds, lateness_s))
+            # snapshots from the high resolution stream, the metric stream is smaller meanwhile, see pyqtpicam.py
+            highRes = self.config['acquisition/snapshot'] and self.config['acquisition/high_res_snapshot']
+            if highRes:
+                self.subscribeHighRes.emit('snapshot')
             self.startCamera.emit()
 
             # autofocus
-            if self.timelapse_settings.value('acquisition/autofocus', False, type=bool):
-                focusTarget = self.timelapse_settings.value('acquisition/focustarget', 0, type=int)
+            if self.config['acquisition/autofocus']:
+                focusTarget = self.config['acquisition/focustarget']
                 self.postMessage.emit('{}: info; using focus target {}'.format(self.__class__.__name__, focusTarget))
                 self.setFocusTarget.emit(focusTarget)
                 wait_ms(200) # wait to let grid detection fire up
                 self.startAutoFocus.emit()
                 wait_signal(self.focussed, 60000)
 
+            # score the activity since the previous round, at focus
+            activity_score = None
+            if self.scheduler is not None:
+                self.activityImage = None
+                self.activityFrameRequested = True
+                wait_signal(self.activityFrame, 5000)
+                self.activityFrameRequested = False
+                if self.activityImage is not None:
+                    activity_score = self.scheduler.score(self.activityImage)
+                    if activity_score is not None:
+                        self.postMessage.emit('{}: info; activity score: {:.4f}'.format(self.__class__.__name__, activity_score))
+
             # move through all offset
-            for offset_str in self.timelapse_settings.value('acquisition/offsets'):
+            for offset_str in self.config['acquisition/offsets']:
                 
                 # set offset                
                 offset = float(offset_str)
@@ -214,19 +338,29 @@ class TimeLapse(QObject):
                     os.remove(f)
                 
                 # take image or video
-                if self.timelapse_settings.value('acquisition/snapshot', False, type=bool):
-                    self.takeImage.emit()
+                if self.config['acquisition/snapshot']:
+                    self.takeImage.emit(highRes)
                     wait_signal(self.captured, 30000) # snapshot taken
-                if self.timelapse_settings.value('acquisition/videoclip', False, type=bool):
-                    duration = self.timelapse_settings.value('acquisition/clip_length', 10, type=int)
+                if self.config['acquisition/videoclip']:
+                    duration = self.config['acquisition/clip_length']
+                    if self.config['acquisition/segmented']:
+                        self.setClipUploader.emit(self.clipUploader(offset_str))
                     self.recordClip.emit(duration)                    
                     wait_signal(self.captured, (30+duration)*1000) # video taken
+
+                # replace snapshots by residuals to a keyframe of this offset, see deltaStorage.py
+                if self.config['acquisition/delta_storage']:
+                    if offset_str not in self.delta_writers:
+                        self.delta_writers[offset_str] = DeltaWriter(os.path.sep.join([self.local_keyframe_path, offset_str + EXTENSION]))
+                    writer = self.delta_writers[offset_str]
+                    for f in glob.glob(os.path.sep.join([self.local_image_storage_path, '*.png'])):
+                        writer.convert(f)
                     
                 # push capture to remote
-                if self.timelapse_settings.contains('connections/storage'):
-                    if self.timelapse_settings.value('connections/storage') == 'rclone':
+                if self.config.contains('connections/storage'):
+                    if self.config['connections/storage'] == 'rclone':
                         subprocess.run(["rclone", "copy", "--no-traverse", self.local_image_storage_path, os.path.sep.join([self.server_storage_path, offset_str])])
-                    elif self.timelapse_settings.value('connections/storage') == 'wbedav':
+                    elif self.config['connections/storage'] == 'wbedav':
                         self.webdav_client.push(remote_directory=os.path.sep.join([self.server_storage_path, offset_str]),
                                                 local_directory=self.local_image_storage_path)
                 val = self.focus + offset if self.focus is not None else offset
@@ -238,8 +372,10 @@ class TimeLapse(QObject):
             
             # wrap up current round of acquisition     
             self.stopCamera.emit()
-            elapsed_total_time_s = time.time() - self.start_time_s
-            elapsed_run_time_s = time.time() - start_run_time_s
+            if highRes:
+                self.unsubscribeHighRes.emit('snapshot')
+            elapsed_total_time_s = self.round_scheduler.elapsed()
+            elapsed_run_time_s = time.monotonic() - start_run_time_s
             self.postMessage.emit("{}: info; single run time={:.1f}s, total run time={:.1f}s".format(self.__class__.__name__,
                                                                                                      elapsed_run_time_s,
                                                                                                      elapsed_total_time_s))
@@ -257,51 +393,66 @@ class TimeLapse(QObject):
                 else:
                     message = """Subject: Experiment finalized \n\n  Done."""
                 # do something fancy here in future: https://realpython.com/python-send-email/#sending-fancy-emails
-                self.sendNotification(message)              
+                self.sendNotification(message, 'progress')
 
             # check if we still have time to do another round
-            if elapsed_total_time_s + self.run_wait_s < self.run_duration_s:
-                self.timer.setInterval(self.run_wait_s*1000)
-                self.postMessage.emit("{}: info; wait for {:.1f} s".format(self.__class__.__name__, self.run_wait_s))
-            else:
-                self.timer.stop()
-                self.postMessage.emit("{}: info; run finalized".format(self.__class__.__name__))
-                if self.timelapse_settings.value('shutdown', False, type=bool):
-                    self.postMessage.emit("{}: info; shutdown app".format(self.__class__.__name__))
-                    self.finished.emit()
+            # the wait is the period between the starts of successive rounds
+            if self.scheduler is not None:
+                self.run_wait_s = self.scheduler.update(activity_score)
+            self.scheduleNext(elapsed_total_time_s)
 
             # push log file
-            if self.timelapse_settings.contains('connections/storage'):
-                if self.timelapse_settings.value('connections/storage') == 'rclone':
+            if self.config.contains('connections/storage'):
+                if self.config['connections/storage'] == 'rclone':
                     print(["rclone", "copy", "--no-traverse", self.log_file_name, self.server_storage_path])
                     subprocess.run(["rclone", "copy", "--no-traverse", self.log_file_name, self.server_storage_path])
-                elif self.timelapse_settings.value('connections/storage') == 'wbedav':
+                    subprocess.run(["rclone", "copy", "--no-traverse", self.local_metrics_path, os.path.sep.join([self.server_storage_path, 'metrics'])])
+                elif self.config['connections/storage'] == 'wbedav':
                     self.webdav_client.push(remote_directory=self.server_storage_path, local_directory=self.local_storage_path)
                     
         except Exception as err:
             self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
-            
 
-    def sendNotification(self, message):
-##        if self.timelapse_settings.contains('connections/email'):
-        conn_settings = QSettings("connections.ini", QSettings.IniFormat)
-        context = ssl.create_default_context()  # Create a secure SSL context
-        try:
-            host = conn_settings.value('smtp/host')
-            port = conn_settings.value('smtp/port', 400, type=int)
+        if self.coordinated:
+            self.releaseWindow.emit()
             
-            with smtplib.SMTP_SSL(host, port, context=context) as server:
-                login = conn_settings.value('smtp/login')
-                password = conn_settings.value('smtp/password')
-                server.login(login, password)
-                server.sendmail(conn_settings.value('smtp/login'), \
-                                self.timelapse_settings.value('connections/email'), \
-                                message)
-                print(conn_settings.value('smtp/login'), \
-                                self.timelapse_settings.value('connections/email'), \
-                                message)
-            self.postMessage.emit("{}: info; notification send to {}".format(self.__class__.__name__, self.timelapse_settings.value('connections/email')))
-        except Exception as err:
-            traceback.print_exc()
-            self.signals.error.emit((type(err), err.args, traceback.format_exc()))            
-                          
+
+    def scheduleNext(self, elapsed_total_time_s):
+        ''' Start the timer for the next round, or finalize the run when there is no time left for another one
+        '''
+        skipped = self.round_scheduler.skipped
+        delay_s = self.round_scheduler.next(self.run_wait_s)
+        if self.round_scheduler.skipped > skipped:
+            self.postMessage.emit("{}: error; behind schedule, {:d} round(s) skipped".format(self.__class__.__name__,
+                                                                                            self.round_scheduler.skipped - skipped))
+        if elapsed_total_time_s + delay_s < self.run_duration_s:
+            self.timer.start(round(delay_s*1000))
+            self.postMessage.emit("{}: info; wait for {:.1f} s".format(self.__class__.__name__, delay_s))
+        else:
+            self.timer.stop()
+            self.postMessage.emit("{}: info; run finalized".format(self.__class__.__name__))
+            if self.config['shutdown']:
+                self.postMessage.emit("{}: info; shutdown app".format(self.__class__.__name__))
+                self.finished.emit()
+
+    def clipUploader(self, offset_str):
+        ''' Upload function for video clip segments at an offset, returns None without remote storage
+        '''
+        if self.config.contains('connections/storage'):
+            remote_path = os.path.sep.join([self.server_storage_path, offset_str])
+            if self.config['connections/storage'] == 'rclone':
+                # copy rather than move, the uploader deletes the segment
+                return lambda filename: subprocess.run(["rclone", "copyto", filename,
+                                                        os.path.sep.join([remote_path, os.path.basename(filename)])]).returncode == 0
+            elif self.config['connections/storage'] == 'wbedav':
+                def upload(filename):
+                    self.webdav_client.upload_sync(remote_path=os.path.sep.join([remote_path, os.path.basename(filename)]), local_path=filename)
+                    return True
+                return upload
+        return None
+
+    def sendNotification(self, message, key=''):
+        ''' Hand message to the notifier, that delivers it in the background; an undelivered message with the same key is replaced
+        '''
+        if self.config.contains('connections/email'):
+            self.notify.emit(self.config['connections/email'], message, key)
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+## Metrics time series
+# Image quality, voice coil position, focus and temperatures of an experiment are recorded in
+# compact binary files, so that plotting an experiment no longer means parsing the log.
+# Every channel has a file of its own, <channel>.ts, with a 16 byte header and fixed width
+# records of (unix time [s], value), appended only. Record i is at a known position, and a
+# channel is loaded as a numpy array in one call, see load. A record that was cut off, e.g. by
+# a power failure, is ignored.
+# Fast channels, e.g. the image quality of every processed frame, are averaged over an interval,
+# so that a run of days does not fill the RAM disk (16 bytes per record).
+#
+import os
+import glob
+import time
+import struct
+import threading
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
+
+MAGIC = b'RTSR'
+VERSION = 1
+HEADER = struct.Struct('<4sI8x') # magic, version, reserved
+RECORD = np.dtype([('t', '<f8'), ('value', '<f8')])
+EXTENSION = '.ts'
+
+
+def channels(folder):
+    """ Names of the channels recorded in folder. """
+    return sorted(os.path.basename(f)[:-len(EXTENSION)] for f in glob.glob(os.path.join(folder, '*' + EXTENSION)))
+
+
+def load(folder, channel):
+    """ Records of channel as a structured array with fields t [s] and value. """
+    filename = os.path.join(folder, channel + EXTENSION)
+    with open(filename, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a time series file".format(filename))
+        count = (os.path.getsize(filename) - HEADER.size)//RECORD.itemsize
+        return np.fromfile(f, dtype=RECORD, count=count)
+
+
+class TimeSeriesRecorder(QObject):
+    """
+    Appends values to the channel files in a folder. Values are buffered and flushed every
+    flush_interval ms. For the channels in intervals, the mean of the values of every interval [s]
+    is recorded, at the time of its first value. record may be called from any thread.
+    """
+    postMessage = pyqtSignal(str)
+
+    def __init__(self, flush_interval=5000, intervals=None):
+        super().__init__()
+        self.folder = None
+        self.files = {}
+        self.intervals = intervals or {}
+        self.sums = {} # channel: (time of the first value, sum, count) of the current interval
+        self.lock = threading.Lock()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(flush_interval)
+
+    @pyqtSlot(str)
+    def setPath(self, folder):
+        """ Record to folder from now on, channels that exist there are appended to. """
+        self.close()
+        with self.lock:
+            os.makedirs(folder, exist_ok=True)
+            self.folder = folder
+        self.postMessage.emit("{}: info; recording metrics to {}".format(self.__class__.__name__, folder))
+
+    def record(self, channel, value, t=None):
+        """ Append value, at time t [s] or now; nothing is recorded before setPath. """
+        if self.folder is None:
+            return
+        t = time.time() if t is None else t
+        try:
+            with self.lock:
+                if channel in self.intervals:
+                    t0, total, count = self.sums.pop(channel, (t, 0.0, 0))
+                    if t - t0 < self.intervals[channel]:
+                        self.sums[channel] = (t0, total + value, count + 1)
+                        return
+                    if count > 0:
+                        self.write(channel, t0, total/count)
+                    self.sums[channel] = (t, value, 1)
+                else:
+                    self.write(channel, t, value)
+        except Exception as err:
+            self.postMessage.emit("{}: error; type: {}, args: {}".format(self.__class__.__name__, type(err), err.args))
+
+    def write(self, channel, t, value):
+        # with the lock held
+        if channel not in self.files:
+            filename = os.path.join(self.folder, channel + EXTENSION)
+            new = not os.path.isfile(filename)
+            self.files[channel] = open(filename, 'ab')
+            if new:
+                self.files[channel].write(HEADER.pack(MAGIC, VERSION))
+        self.files[channel].write(np.array([(t, value)], dtype=RECORD).tobytes())
+
+    @pyqtSlot()
+    def flush(self):
+        with self.lock:
+            for f in self.files.values():
+                f.flush()
+
+    @pyqtSlot()
+    def close(self):
+        with self.lock:
+            # the means of the last, incomplete intervals
+            if self.folder is not None:
+                for channel, (t0, total, count) in self.sums.items():
+                    self.write(channel, t0, total/count)
+            self.sums = {}
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+            self.folder = None
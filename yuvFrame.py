@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+## YUV frames
+# In color mode the camera delivers I420 (YUV 4:2:0) frames, instead of letting the GPU convert to
+# BGR, only for the processing chain to convert back to luminance. A YUVFrame is the Y plane, a
+# view on the captured buffer without a copy, so the processing chain uses it as a gray image.
+# The BGR image is only computed, once, when a consumer asks for color, e.g. to save a frame.
+#
+import cv2
+import numpy as np
+
+
+class YUVFrame(np.ndarray):
+    """
+    Y plane of an I420 buffer, of width x height pixels. The buffer may be padded to
+    fwidth x fheight, as the camera delivers it.
+    """
+    def __new__(cls, buffer, width, height, fwidth=None, fheight=None):
+        fwidth, fheight = fwidth or width, fheight or height
+        y = np.frombuffer(buffer, dtype=np.uint8, count=fwidth*fheight).reshape((fheight, fwidth))
+        frame = y[:height, :width].view(cls)
+        frame.buffer = buffer
+        frame.rawSize = (fwidth, fheight)
+        return frame
+
+    def __array_finalize__(self, obj):
+        # arrays derived from a frame, e.g. slices, are plain luminance
+        self.buffer = None
+        self.rawSize = None
+        self.bgrImage = None
+
+    def bgr(self):
+        """ The frame as BGR image, converted at the first call. """
+        if self.bgrImage is None:
+            if self.buffer is None:
+                self.bgrImage = cv2.cvtColor(np.asarray(self), cv2.COLOR_GRAY2BGR)
+            else:
+                fwidth, fheight = self.rawSize
+                i420 = np.frombuffer(self.buffer, dtype=np.uint8, count=fwidth*fheight*3//2).reshape((fheight*3//2, fwidth))
+                self.bgrImage = cv2.cvtColor(i420, cv2.COLOR_YUV2BGR_I420)[:self.shape[0], :self.shape[1]]
+        return self.bgrImage
+
+
+def color(image):
+    """ BGR image of a YUVFrame, other images are returned as they are. """
+    return image.bgr() if isinstance(image, YUVFrame) else image